@@ -0,0 +1,8 @@
+# encoding: utf-8
+import os
+
+def resource_path(*parts):
+    """Path of a file installed with the gdan package, such as
+    resource_path('defaults', 'stddata.dot'). Used in place of
+    pkg_resources, which is slow to import"""
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), *parts)
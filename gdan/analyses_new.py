@@ -7,52 +7,88 @@ import sys
 import os
 import logging
 import re
-import csv
+import shutil
+import tempfile
 
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter, FileType, \
                      ArgumentTypeError
-from pkg_resources import resource_filename
 
-from firecloud.fiss import main as call_fiss, _confirm_prompt as ask
 from firecloud.fccore import __fcconfig as fcconfig
+from gdan import trace, resource_path
+from gdan.provision import Provisioner, ProvisioningError, SUCCEEDED
+from gdan.journal import Journal, file_fingerprint
+from gdan.sync import WorkspaceState, sync_acl, sync_attributes, \
+                      sync_configs, diff_loadfile, show_plan
+from gdan.loadfiles import attribute_loadfile, read_header, glob_loadfiles
+from gdan.fcclient import get_client
+from gdan.configcache import ConfigCache, DEFAULT_MAX_AGE
+from gdan.workflow import parse_dot
+from gdan.scheduler import Scheduler, DEFAULT_MAX_SUBMISSIONS, \
+                          DEFAULT_POLL_INTERVAL
+from gdan.history import History
+from gdan.resources import cohort_sizes, sized_attributes, \
+                          RESOURCE_ATTRIBUTES
+from gdan.selection import RuleSet, DEFAULT_RULES
+from gdan.template import Template, template_name
+from gdan.index import MetadataIndex, DEFAULT_TTL, get_index, set_index
 
-def get_configs(workflow):
-    for line in workflow:
-        config = line.strip()
-        if config.endswith(';') and '->' not in config:
-            yield config.rstrip(';').strip('"')
-    workflow.close()
-
-def fissfc(*args):
-    return call_fiss(["fissfc", "-V", "-y"] + list(args))
-
-def analyses_sset_list(project, space, user_ssets=None):
-    ssets = fissfc('sset_list', '-p', project, '-w', space)
-    for sset in ssets:
+def analyses_sset_list(project, space, user_ssets=None, rules=None):
+    """Yield the sample sets of project/space to analyze as their pages are
+    listed, or read from the index: those in user_ssets if given, otherwise
+    those rules select"""
+    if user_ssets is None:
+        rules = rules or RuleSet.from_file()
+    for sset in get_index().sset_iter(project, space):
         if user_ssets is not None:
             if sset in user_ssets:
                 yield sset
-        else:
-            sset_lower = sset.lower()
-            sset_cohort = sset_lower.split('-')[-2]
-            if sset_cohort in ('stes', 'gbmlgg', 'kipan', 'pangi'):
-                continue # Exclude aggregate cohorts other than coadread
-            if sset_lower.endswith('laml-tb'):
-                yield sset
-            elif sset_lower.endswith('skcm-tm'):
-                yield sset
-            elif sset_lower.endswith("-tp") and sset_cohort not in ('skcm',
-                                                                    'laml'):
-                yield sset
+        elif rules.match(sset):
+            yield sset
+
+class SampleSetCopyError(Exception):
+    """Raised when some sample sets of a batch could not be copied"""
+    def __init__(self, failed):
+        self.failed = failed
+        super(SampleSetCopyError, self).__init__(
+            '{} sample set(s) not copied: {}'.format(
+                len(failed), ', '.join(sorted(failed))))
+
+def copy_sample_sets(project, space, to_project, to_space, ssets):
+    """Copy ssets, with the samples and participants they refer to, from
+    project/space to to_project/to_space in a single request. Entities
+    already in the target are linked to rather than copied again, so those
+    shared between sample sets are copied once. If the request fails, each
+    sample set is copied on its own, so that failures are reported per set.
+    Returns the number of entities copied"""
+    client = get_client()
+    try:
+        copied = client.entity_copy(project, space, to_project, to_space,
+                                    'sample_set', ssets, True)
+    except Exception as e:
+        if len(ssets) == 1:
+            logging.error('\t%s: not copied (%s)', ssets[0], e)
+            raise SampleSetCopyError({ssets[0]: e})
+        logging.warning('Copying %d sample sets at once failed (%s), '
+                        'copying them one at a time', len(ssets), e)
+    else:
+        for sset in ssets:
+            logging.info('\t%s: copied', sset)
+        return len(copied.get('entitiesCopied', ()))
 
-def load_attributes(attributes):
-    attr_reader = csv.DictReader(attributes, dialect='excel-tab')
-    attr_dict = dict()
-    for row in attr_reader:
-        attr_dict[row[attr_reader.fieldnames[0]]] = \
-                    {field: row[field] for field in attr_reader.fieldnames[1:]}
-    attributes.close()
-    return attr_dict
+    count, failed = 0, dict()
+    for sset in ssets:
+        try:
+            copied = client.entity_copy(project, space, to_project, to_space,
+                                        'sample_set', [sset], True)
+        except Exception as e:
+            logging.error('\t%s: not copied (%s)', sset, e)
+            failed[sset] = e
+        else:
+            logging.info('\t%s: copied', sset)
+            count += len(copied.get('entitiesCopied', ()))
+    if failed:
+        raise SampleSetCopyError(failed)
+    return count
 
 def valid_datestamp(datestamp):
     if re.match(r'^[2-9][0-9]{3}_[0-1][0-9]_[0-3][0-9]$', datestamp):
@@ -67,7 +103,7 @@ def remove_suffix(sset_name):
         return '-'.join(name_fields[:-1])
     return sset_name
 
-def main():
+def main(argv=None):
     logging.basicConfig(level=logging.INFO,
                         format='%(asctime)s::%(levelname)s  %(message)s',
                         datefmt='%Y-%m-%d %I:%M:%S %p')
@@ -95,33 +131,86 @@ def main():
                                                       or 'broadgdac'),
                         help='Method Config namespace.')
     parser.add_argument('-w', '--workflow', type=FileType('r'),
-                        default=resource_filename(__name__,
-                                                  os.path.join('defaults',
-                                                               'Analyses.dot')),
+                        default=resource_path('defaults', 'Analyses.dot'),
                         help='DOT format file with analyses workflow.')
     parser.add_argument('-s', '--ssets', metavar='SSET', nargs='+',
                         help='Specific Sample Set(s) to use.')
+    parser.add_argument('--sset-rules', metavar='FILE', default=DEFAULT_RULES,
+                        help='''File of include/exclude rules selecting the
+                        Sample Sets to use, when --ssets is not given.''')
     parser.add_argument('-a', '--attributes', type=FileType('r'),
-                        default=resource_filename(__name__,
-                                                  os.path.join('defaults',
-                                                               'sample_set_loadfile.tsv')),
+                        default=resource_path('defaults',
+                                              'sample_set_loadfile.tsv'),
                         help='File of sample set attributes to add.')
+    parser.add_argument('--copy-batch-size', type=int, default=100,
+                        help='''Maximum number of Sample Sets copied, with
+                        their samples and participants, in one request.''')
+    parser.add_argument('--static-resources', action='store_true',
+                        help='''Use the memory attributes in the attributes
+                        file as is, rather than sizing them from the peak
+                        memory recorded with gdan resources record. Sizing
+                        has no effect until peaks are recorded.''')
+    parser.add_argument('-l', '--loadfiles',
+                        help='''Datestamped loadfile directory of the stddata
+                        run, from which cohort sizes are taken when sizing
+                        memory attributes.''')
     parser.add_argument('-r', '--recovery_file',
                         default=os.path.expanduser(os.path.join('~', '.fiss',
-                                                                'Analyses.json')),
+                                                                'Analyses.jsonl')),
                         help='''File to save monitor data. This file can be
-                        passed to fissfc supervise_recover in case the
-                        supervisor crashes.''')
+                        passed to gdan_recover in case the supervisor
+                        crashes.''')
+    parser.add_argument('-c', '--max-submissions', type=int,
+                        default=DEFAULT_MAX_SUBMISSIONS,
+                        help='Maximum number of submissions to run at once.')
+    parser.add_argument('--poll-interval', type=int,
+                        default=DEFAULT_POLL_INTERVAL,
+                        help='Seconds between checks on running submissions.')
+    parser.add_argument('-j', '--jobs', type=int, default=8,
+                        help='''Maximum number of concurrent FireCloud calls
+                        while provisioning.''')
+    parser.add_argument('--restart', action='store_true',
+                        help='''Start over rather than resume an earlier,
+                        unfinished run with the same inputs.''')
+    parser.add_argument('-S', '--sync', action='store_true',
+                        help='''If the workspace already exists, update only
+                        the method configs, attributes and sample sets that
+                        differ from those that would be created, rather than
+                        deleting and recreating it.''')
+    parser.add_argument('--refresh-configs', action='store_true',
+                        help='''Read every method config from the methods
+                        workspace, rather than using those cached locally.''')
+    parser.add_argument('--refresh-index', action='store_true',
+                        help='''Check the workspaces and sample sets used
+                        with FireCloud, rather than trusting the local index
+                        of them for up to {} minutes.'''.format(
+                            DEFAULT_TTL // 60))
+    parser.add_argument('--template', metavar='WORKSPACE', nargs='?',
+                        const='',
+                        help='''Create the workspace as a clone of a template
+                        workspace in the same project, holding the method
+                        configs and standard attributes, which is built or
+                        refreshed first if the workflow or method configs
+                        changed. WORKSPACE defaults to the workflow file's
+                        name followed by _template, e.g.
+                        Analyses_template.''')
+    parser.add_argument('--trace', metavar='FILE',
+                        help='''Record every FireCloud call to FILE, as JSON
+                        lines, and log a summary of call latencies at
+                        exit.''')
     
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
+    if args.trace:
+        trace.enable(args.trace)
     methods     = args.methods
     methproject, methspace = methods.split('/')
     fromproject = args.from_project
     toproject   = args.to_project
     namespace   = args.namespace
-    workflow    = args.workflow
+    workflow    = parse_dot(args.workflow)
     datestamp   = args.datestamp
     user_ssets  = args.ssets
+    rules       = RuleSet.from_file(args.sset_rules)
     attributes  = args.attributes
     recover     = args.recovery_file
     stddata     = 'stddata__' + datestamp
@@ -133,70 +222,221 @@ def main():
                                                          for sset in user_ssets))),
                                      analyses)
 
-    if not fissfc("space_exists", '-p', fromproject, "-w", stddata):
+    client = get_client()
+    configs = ConfigCache(methproject, methspace,
+                          max_age=0 if args.refresh_configs else
+                                  DEFAULT_MAX_AGE)
+    if args.refresh_index:
+        set_index(MetadataIndex(ttl=0))
+    index = get_index()
+    if not index.space_exists(fromproject, stddata):
         logging.error("Invalid workspace: {}/{} does not exist".format(fromproject,
                                                                        stddata))
         sys.exit(1)
+    if user_ssets is not None:
+        # Ask FireCloud again before rejecting any, as the index may be
+        # behind
+        unknown = set(user_ssets).difference(index.sample_sets(fromproject,
+                                                                stddata))
+        if unknown:
+            unknown.difference_update(index.sample_sets(fromproject, stddata,
+                                                        refresh=True))
+        if unknown:
+            logging.error('Sample set(s) not in %s/%s: %s', fromproject,
+                          stddata, ', '.join(sorted(unknown)))
+            sys.exit(1)
 
-    logging.info('Checking for {}/{} ...'.format(toproject, analyses))
-    if fissfc('space_exists', '-p', toproject, '-w', analyses):
-        if ask('{}/{} already exists, delete it and continue'.format(toproject,
-                                                                     analyses),
-               prompt='? [Y\\n]: '):
-            fissfc('space_delete', '-p', toproject, '-w', analyses)
-        else:
-            logging.info('User chose not to delete existing space. Exiting.')
-            sys.exit()
+    journal = Journal(toproject, analyses,
+                      {'methods': methods, 'namespace': namespace,
+                       'stddata': [fromproject, stddata],
+                       'workflow': workflow.to_dict(), 'ssets': user_ssets,
+                       'sset_rules': user_ssets is None and
+                                     file_fingerprint(args.sset_rules),
+                       'copy_batch_size': args.copy_batch_size,
+                       'attributes': attributes and
+                                     file_fingerprint(attributes.name),
+                       'static_resources': args.static_resources})
+    with trace.phase('workspace'):
+        logging.info('Checking for {}/{} ...'.format(toproject, analyses))
+        resume = sync = False
+        if index.space_exists(toproject, analyses):
+            # Only needed here, and slow to import
+            from firecloud.fiss import _confirm_prompt as ask
+            if args.sync:
+                logging.info('Comparing {}/{} with the desired state'.format(
+                    toproject, analyses))
+                sync = True
+            elif journal.unfinished() and not args.restart:
+                logging.info('Resuming provisioning of {}/{} from {}'.format(
+                    toproject, analyses, journal.path))
+                resume = True
+            elif ask('{}/{} already exists, delete it and continue'.format(
+                         toproject, analyses), prompt='? [Y\\n]: '):
+                client.space_delete(toproject, analyses)
+                index.record(toproject, analyses, exists=False)
+            else:
+                logging.info('User chose not to delete existing space. ' +
+                             'Exiting.')
+                sys.exit()
+
+        if not (resume or sync):
+            # Create new workspace
+            journal.clear()
+            if args.template is None:
+                logging.info('Creating workspace {}/{}'.format(toproject,
+                                                               analyses))
+                client.space_new(toproject, analyses)
+            else:
+                template = Template(toproject, args.template or
+                                    template_name(args.workflow.name),
+                                    workflow, configs, namespace,
+                                    {'package': 'true'}, args.jobs)
+                template.ensure()
+                template.clone(toproject, analyses,
+                               {'data_version': datestamp})
+                journal.record('space:clone', SUCCEEDED)
+            index.record(toproject, analyses)
+        # A clone already has its method configs and standard attributes
+        cloned = not sync and 'space:clone' in journal.succeeded()
 
-    # Create new workspace
-    logging.info('Creating workspace {}/{}'.format(toproject, analyses))
-    fissfc('space_new', '-p', toproject, '-w', analyses)
+    # A sync recomputes what is left to do, so needs no journal
+    provisioner = Provisioner(args.jobs, None if sync else journal)
+    state = WorkspaceState(client, toproject, analyses) if sync else None
 
     # Add broadgdac group as owner
     # TODO: make this configurable
     group='GROUP_broadgdac@firecloud.org'
-    logging.info('Adding {} as workspace owner'.format(group))
-    fissfc('space_set_acl', '-p', toproject, '-w', analyses, '-r', 'OWNER',
-           '--users', group)
+    if sync:
+        sync_acl(provisioner, state, [group], 'OWNER')
+    else:
+        provisioner.add('acl:owner', client.space_set_acl,
+                        (toproject, analyses, [group], 'OWNER'),
+                        description='Adding {} as workspace owner'.format(
+                            group))
 
     # Set workspace annotations
-    logging.info('Setting data_version to ' + datestamp)
-    fissfc('attr_set', '-p', toproject, '-w', analyses,
-           '-a', 'data_version', '-v', datestamp)
-
-    logging.info('Setting package to "true"')
-    fissfc('attr_set', '-p', toproject, '-w', analyses, '-a', 'package',
-           '-v', 'true')
+    annotations = {'data_version': datestamp, 'package': 'true'}
+    if sync:
+        sync_attributes(provisioner, state, annotations)
+    elif not cloned:
+        provisioner.add('attr:workspace', client.attr_set,
+                        (toproject, analyses, annotations),
+                        description='Setting data_version to ' + datestamp +
+                                    ' and package to "true"')
 
     # Copy method configs
-    logging.info('Copying method configs from {} to {}/{}'.format(methods,
-                                                                  toproject,
-                                                                  analyses))
-    for config in get_configs(workflow):
-        fissfc('config_copy', '-c', config, '-n', namespace, '-p', methproject,
-               '-s', methspace, '-P', toproject, '-S', analyses)
-
-    # Load optional attributes
-    if attributes is not None:
-        attributes = load_attributes(attributes)
-
-    # Copy sample sets (and set attributes)
-    logging.info('Copying sample sets from {}/{} to {}/{}'.format(fromproject,
-                                                                  stddata,
-                                                                  toproject,
-                                                                  analyses))
-    for sset in analyses_sset_list(fromproject, stddata, user_ssets):
-        fissfc("entity_copy", "-t", "sample_set", "-e", sset,
-               "-w", stddata, "-p", fromproject,
-               "-W", analyses, "-P", toproject, "-l")
-        if attributes is not None and sset in attributes:
-            for attr, value in attributes[sset].items():
-                fissfc("attr_set", "-t", "sample_set", "-e", sset, "-a", attr,
-                       "-v", value, "-w", analyses, "-p", toproject)
+    if sync:
+        sync_configs(provisioner, state, configs, namespace, workflow.nodes,
+                     args.jobs)
+    elif not cloned:
+        logging.info('Copying method configs from {} to {}/{}'.format(
+            methods, toproject, analyses))
+        for config in workflow.nodes:
+            provisioner.add('config:' + config, configs.copy,
+                            (config, namespace, toproject, analyses),
+                            description='Copying ' + config)
+
+    # Copy sample sets in batches, starting each batch as soon as enough
+    # are listed. Batches run one after another, so each links to the
+    # samples and participants earlier ones copied rather than racing them.
+    # The optional attributes, which are sized from the whole selection,
+    # are then set in a single update once every batch is done
+    temp_files = []
+    batch_size = max(1, args.copy_batch_size)
+
+    def add_copy(batch, copies):
+        name = 'copy:' + batch[0]
+        if len(batch) > 1:
+            name += '..' + batch[-1]
+        copies.append(provisioner.add(
+            name, copy_sample_sets,
+            (fromproject, stddata, toproject, analyses, list(batch)),
+            requires=copies[-1:],
+            description='Copying {} sample set(s), {} to {}'.format(
+                len(batch), batch[0], batch[-1])))
+
+    def list_sample_sets():
+        logging.info('Copying sample sets from {}/{} to {}/{}'.format(
+            fromproject, stddata, toproject, analyses))
+        existing = ()
+        if sync:
+            fields = ['name']
+            if attributes is not None:
+                fields = read_header(attributes.name).split('\t')[1:]
+                if not args.static_resources:
+                    fields += [attr for attr in RESOURCE_ATTRIBUTES
+                               if attr not in fields]
+            existing = state.entities('sample_set', ','.join(fields))
+        ssets, batch, copies = [], [], []
+        to_copy = 0
+        for sset in analyses_sset_list(fromproject, stddata, user_ssets,
+                                       rules):
+            ssets.append(sset)
+            if sset not in existing:
+                batch.append(sset)
+                to_copy += 1
+            if len(batch) == batch_size:
+                add_copy(batch, copies)
+                batch = []
+        if batch:
+            add_copy(batch, copies)
+        logging.info('Selected %d sample set(s), %d to copy in %d batch(es)',
+                     len(ssets), to_copy, len(copies))
+
+        if attributes is None:
+            return ssets
+        overrides = None
+        if not args.static_resources:
+            sizes = cohort_sizes(glob_loadfiles(os.path.join(
+                args.loadfiles, '*-*.Sample_Set'))) \
+                if args.loadfiles else None
+            overrides = sized_attributes(History(), ssets, sizes)
+        attr_loadfile = attribute_loadfile(attributes, ssets, overrides)
+        if attr_loadfile is not None:
+            temp_files.append(attr_loadfile)
+        if attr_loadfile is not None and sync:
+            diff_dir = tempfile.mkdtemp(prefix=analyses + '.')
+            temp_files.append(diff_dir)
+            attr_loadfile, _ = diff_loadfile(state, attr_loadfile, diff_dir)
+        if attr_loadfile is not None:
+            provisioner.add('attr:sample_sets', client.entity_import,
+                            (toproject, analyses, attr_loadfile),
+                            requires=copies,
+                            description='Adding attributes to Sample Sets')
+        return ssets
+
+    ssets = None
+    try:
+        if sync:
+            # Listing adds the copy and attribute steps, so a sync lists
+            # first for the plan to show them
+            ssets = list_sample_sets()
+            show_plan(provisioner, toproject, analyses)
+        else:
+            # Listed on every run, resumed or not, as the scheduler needs the
+            # list
+            provisioner.add('list:sample_sets', list_sample_sets,
+                            journaled=False,
+                            description='Listing sample sets of {}/{}'.format(
+                                fromproject, stddata))
+        results = provisioner.execute()
+    except ProvisioningError:
+        sys.exit(1)
+    finally:
+        for path in temp_files:
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                os.remove(path)
+    if ssets is None:
+        ssets = results['list:sample_sets'].value
 
     # Initiate supervisor mode
-    fissfc('supervise', '-p', toproject, '-w', analyses,
-           '-n', namespace, '-j', recover, workflow.name)
+    scheduler = Scheduler(toproject, analyses, namespace, workflow, ssets,
+                          args.max_submissions, args.poll_interval,
+                          recovery_file=recover, jobs=args.jobs)
+    if not scheduler.run():
+        sys.exit(1)
 
 if __name__ == '__main__':
     main()
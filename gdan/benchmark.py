@@ -0,0 +1,439 @@
+# encoding: utf-8
+'''
+Benchmark workspace provisioning against a local FireCloud stand-in.
+
+The gdac_new, stddata_new and analyses_new flows are run end to end against
+gdan.fakefc, with synthetic loadfiles for N cohorts of M samples each and a
+DOT workflow of K method configs (gdac_new provisions the first cohort with
+its packaged stddata workflow). Each run happens in its own process with its
+own home directory, so journals, run history and peak memory are never
+shared between runs or with real ones.
+
+For every flow the benchmark reports the seconds until the first submission
+(the provisioning time), the seconds to the end of the run, the number of
+FireCloud calls and the peak resident memory of the process, which includes
+the stand-in server. The startup flow instead times `gdan SUBCOMMAND --help`
+for each subcommand, in a fresh interpreter, which is all an invocation that
+goes no further than parsing its arguments costs. Results can be saved as a
+baseline, and a later run fails if any of them grew by more than a
+threshold over the baseline.
+'''
+
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import tempfile
+import subprocess
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter, SUPPRESS
+from io import open
+from six import text_type
+
+FLOWS = ('gdac_new', 'stddata_new', 'analyses_new')
+STARTUP = 'startup'
+# Times each subcommand is started per repeat, as single starts are noisy
+STARTUP_RUNS = 5
+STARTUP_NOISE = 0.05
+PROJECT = 'bench'
+METHODS = 'bench/Production'
+NAMESPACE = 'bench'
+DATESTAMP = '2000_01_01'
+# Metric: least absolute change counted as a regression, to ignore noise
+METRICS = {'provision_seconds': 0.1, 'total_seconds': 0.1, 'calls': 0,
+           'peak_memory_mb': 2.0}
+
+def write_workflow(path, nodes):
+    """Write a DOT workflow of nodes method configs, each depending on the
+    one at half its index, so the graph is a balanced binary tree"""
+    with open(path, 'w') as dot:
+        dot.write(u'digraph "bench" {\n')
+        for node in range(nodes):
+            dot.write(u'    "Bench_{}";\n'.format(node))
+            if node:
+                dot.write(u'    "Bench_{}" -> "Bench_{}" '
+                          u'[ satisfiedMode="OnComplete" ];\n'.format(
+                              (node - 1) // 2, node))
+        dot.write(u'}\n')
+
+def write_loadfiles(directory, cohort, samples, names):
+    """Write participant, sample and sample set loadfiles for cohort, with one
+    tumor sample per participant, as {entity type: path}. names maps each
+    entity type to its loadfile name component"""
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    paths = dict((etype, os.path.join(directory, '{}.{}.loadfile.txt'.format(
+        cohort, names[etype]))) for etype in names)
+    ids = ['{}-{:05d}'.format(cohort, i) for i in range(samples)]
+    with open(paths['participant'], 'w') as lf:
+        lf.write(u'entity:participant_id\tcohort\n')
+        for participant in ids:
+            lf.write(u'{}\t{}\n'.format(participant, cohort))
+    with open(paths['sample'], 'w') as lf:
+        lf.write(u'entity:sample_id\tparticipant_id\tsample_type\n')
+        for participant in ids:
+            lf.write(u'{0}-TP\t{0}\tTP\n'.format(participant))
+    with open(paths['sample_set'], 'w') as lf:
+        lf.write(u'membership:sample_set_id\tsample_id\n')
+        for sset in (cohort, cohort + '-TP'):
+            for participant in ids:
+                lf.write(u'{}\t{}-TP\n'.format(sset, participant))
+    return paths
+
+def write_inputs(directory, cohorts, samples, nodes):
+    """Synthetic inputs for every flow, under directory"""
+    cohorts = ['BENCH-C{:03d}'.format(i) for i in range(cohorts)]
+    inputs = {'workflow': os.path.join(directory, 'bench.dot'),
+              'loadfile_root': os.path.join(directory, 'stddata'),
+              'gdac': os.path.join(directory, 'gdac'),
+              'attributes': os.path.join(directory, 'attributes.tsv'),
+              'cohorts': cohorts}
+    write_workflow(inputs['workflow'], nodes)
+    for cohort in cohorts:
+        write_loadfiles(os.path.join(inputs['loadfile_root'], DATESTAMP),
+                        cohort, samples, {'participant': 'Participant',
+                                          'sample': 'Sample',
+                                          'sample_set': 'Sample_Set'})
+    write_loadfiles(inputs['gdac'], cohorts[0], samples,
+                    {'participant': 'Participants', 'sample': 'Samples',
+                     'sample_set': 'SampleSet'})
+    with open(inputs['attributes'], 'w') as attrs:
+        attrs.write(u'update:sample_set_id\tlego_plotter_ram_gb\t'
+                    u'mutsig_ram_gb\n')
+        for cohort in cohorts:
+            attrs.write(u'{}-TP\t7.5\t7.5\n'.format(cohort))
+    return inputs
+
+def peak_memory():
+    """Peak resident memory of this process in MB, where known"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KB, macOS bytes
+    return peak / (1024.0 ** 2 if sys.platform == 'darwin' else 1024.0)
+
+def run_flow(flow, inputs, workdir, latency=0.0, error_rate=0.0, seed=0,
+             jobs=8, quota=None, template=False):
+    """Run flow in this process against a new stand-in server, returning its
+    metrics. Meant to be run in a process of its own. With template, the
+    flow clones its workspace from a template that is already up to date"""
+    import requests
+    from gdan import resource_path
+    from gdan.fakefc import FakeFireCloud
+    from gdan.fcclient import FireCloudClient, set_client
+    from gdan.loadfiles import glob_loadfiles
+    from gdan.workflow import parse_dot
+
+    fake = FakeFireCloud(latency, error_rate, seed, quota)
+    methods = METHODS.split('/')
+    for dot in (inputs['workflow'],
+                resource_path('defaults', 'stddata.dot')):
+        for node in parse_dot(dot).nodes:
+            fake.add_config(methods[0], methods[1], NAMESPACE, node)
+    loadfiles = os.path.join(inputs['loadfile_root'], DATESTAMP)
+    if flow == 'analyses_new':
+        # Stands in for the stddata workspace analyses are copied from
+        for etype in ('Participant', 'Sample', 'Sample_Set'):
+            for loadfile in glob_loadfiles(os.path.join(loadfiles,
+                                                        '*.' + etype)):
+                fake.load(PROJECT, 'stddata__' + DATESTAMP, loadfile)
+
+    common = ['-m', METHODS, '-n', NAMESPACE, '-j', str(jobs),
+              '--poll-interval', '0']
+    if template:
+        common.append('--template')
+    if flow == 'gdac_new':
+        from gdan.gdac_new import main
+        os.chdir(inputs['gdac'])
+        argv = common + ['-p', PROJECT, inputs['cohorts'][0]]
+    elif flow == 'stddata_new':
+        from gdan.stddata_new import main
+        argv = common + ['-p', PROJECT, '-w', inputs['workflow'],
+                         '-d', DATESTAMP,
+                         '-r', os.path.join(workdir, 'stddata.jsonl'),
+                         inputs['loadfile_root']]
+    else:
+        from gdan.analyses_new import main
+        argv = common + ['-p', PROJECT, '-P', PROJECT, '-d', DATESTAMP,
+                         '-w', inputs['workflow'],
+                         '-a', inputs['attributes'], '-l', loadfiles,
+                         '-r', os.path.join(workdir, 'analyses.jsonl')]
+
+    set_client(FireCloudClient(fake.start(), requests.Session()))
+    if template:
+        # Only the runs after the one that builds it are worth measuring
+        from gdan.configcache import ConfigCache
+        from gdan.template import Template, template_name
+        dot = resource_path('defaults', 'stddata.dot') \
+              if flow == 'gdac_new' else inputs['workflow']
+        Template(PROJECT, template_name(dot), parse_dot(dot),
+                 ConfigCache(*methods), NAMESPACE, {'package': 'true'},
+                 jobs).ensure()
+        fake.calls.clear()
+    ok = True
+    start = time.time()
+    try:
+        main(argv)
+    except SystemExit as e:
+        ok = not e.code
+    except Exception:
+        logging.exception('%s failed', flow)
+        ok = False
+    total = time.time() - start
+    fake.stop()
+    provision = fake.first_submission - start \
+                if fake.first_submission is not None else total
+    return {'ok': ok, 'provision_seconds': provision, 'total_seconds': total,
+            'calls': sum(fake.calls.values()), 'routes': dict(fake.calls),
+            'injected_errors': fake.errors, 'throttled': fake.throttled,
+            'peak_memory_mb': peak_memory()}
+
+def child_env(home):
+    """Environment for a child process importing this copy of gdan, with
+    home as its home directory"""
+    package = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    return dict(os.environ, HOME=home,
+                PYTHONPATH=os.pathsep.join(
+                    [package] + [p for p in [os.environ.get('PYTHONPATH')]
+                                 if p]))
+
+def measure(flow, inputs, args):
+    """Run flow in a child process with its own home directory, returning
+    its metrics"""
+    workdir = tempfile.mkdtemp(prefix='gdan_benchmark.')
+    log = os.path.join(workdir, 'run.log')
+    env = child_env(workdir)
+    cmd = [sys.executable, '-m', 'gdan.benchmark', '--flow', flow,
+           '--inputs', json.dumps(inputs), '--workdir', workdir,
+           '--latency', str(args.latency), '--error-rate',
+           str(args.error_rate), '--seed', str(args.seed),
+           '-j', str(args.jobs)]
+    if args.quota:
+        cmd += ['--quota', str(args.quota)]
+    if args.template:
+        cmd.append('--template')
+    try:
+        with open(log, 'wb') as stderr:
+            child = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                     stderr=stderr, env=env)
+            out = child.communicate()[0].decode('utf-8')
+        if child.returncode == 0:
+            return json.loads(out.strip().splitlines()[-1])
+        with open(log) as lf:
+            logging.error('%s benchmark crashed:\n%s', flow, lf.read())
+        return {'ok': False}
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def measure_startup(runs):
+    """Least seconds, over runs, for a fresh interpreter to show the help of
+    each gdan subcommand, and for one to start at all, for reference. Noise
+    only ever slows a start, so the least is the most repeatable"""
+    from gdan.cli import COMMANDS
+    workdir = tempfile.mkdtemp(prefix='gdan_benchmark.')
+    env = child_env(workdir)
+
+    def timed(cmd):
+        times = []
+        with open(os.devnull, 'wb') as devnull:
+            for _ in range(runs):
+                start = time.time()
+                subprocess.check_call(cmd, stdout=devnull, stderr=devnull,
+                                      env=env)
+                times.append(time.time() - start)
+        return min(times)
+
+    try:
+        seconds = dict((name, timed([sys.executable, '-m', 'gdan.cli', name,
+                                     '--help'])) for name in COMMANDS)
+        return {'ok': True, 'interpreter': timed([sys.executable, '-c', '']),
+                'startup_seconds': seconds}
+    except subprocess.CalledProcessError as e:
+        logging.error('Startup benchmark failed: %s', e)
+        return {'ok': False}
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def summarize(runs):
+    """Median of each metric over repeated runs of a flow"""
+    from gdan.history import median
+    result = dict(runs[-1])
+    result['ok'] = all(run['ok'] for run in runs)
+    for metric in METRICS:
+        values = [run[metric] for run in runs if run.get(metric) is not None]
+        result[metric] = median(values)
+    return result
+
+def report(results):
+    lines = ['{:<14}{:>6}{:>12}{:>10}{:>8}{:>10}'.format(
+        'flow', 'ok', 'provision', 'total', 'calls', 'peak MB')]
+    for flow, result in results.items():
+        if flow == STARTUP:
+            continue
+        lines.append('{:<14}{:>6}{:>12.2f}{:>10.2f}{:>8}{:>10}'.format(
+            flow, 'yes' if result['ok'] else 'NO',
+            result['provision_seconds'], result['total_seconds'],
+            result['calls'], '{:.1f}'.format(result['peak_memory_mb'])
+            if result['peak_memory_mb'] is not None else '-'))
+        lines.append('    ' + ', '.join('{} {}'.format(route, count) for
+                                        route, count in
+                                        sorted(result['routes'].items())))
+        if result['injected_errors'] or result.get('throttled'):
+            lines.append('    {} injected error(s), {} throttled'.format(
+                result['injected_errors'], result.get('throttled', 0)))
+    startup = results.get(STARTUP)
+    if startup is not None and startup['ok']:
+        lines.append('startup, of {:.2f} for the interpreter:'.format(
+            startup['interpreter']))
+        lines.append('    ' + ', '.join('{} {:.2f}'.format(command, seconds)
+                                        for command, seconds in sorted(
+                                            startup['startup_seconds'].items())))
+    return '\n'.join(lines)
+
+def regressions(results, baseline, threshold):
+    """Descriptions of the metrics in results worse than in baseline by more
+    than the fraction threshold"""
+    found = []
+    for flow, result in results.items():
+        base = baseline.get(flow)
+        if base is None:
+            continue
+        if base['ok'] and not result['ok']:
+            found.append('{} failed'.format(flow))
+            continue
+        if flow == STARTUP:
+            metrics = [(command, STARTUP_NOISE,
+                        base.get('startup_seconds', {}).get(command), seconds)
+                       for command, seconds in sorted(
+                           result.get('startup_seconds', {}).items())]
+        else:
+            metrics = [(metric, noise, base.get(metric), result.get(metric))
+                       for metric, noise in sorted(METRICS.items())]
+        for metric, noise, old, new in metrics:
+            if old is None or new is None:
+                continue
+            if new > old * (1 + threshold) and new - old > noise:
+                found.append('{} {}: {:.2f} -> {:.2f} (+{:.0f}%)'.format(
+                    flow, metric, old, new,
+                    100.0 * (new - old) / old if old else float('inf')))
+    return found
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s::%(levelname)s  %(message)s',
+                        datefmt='%Y-%m-%d %I:%M:%S %p')
+    parser = ArgumentParser(formatter_class=ArgumentDefaultsHelpFormatter,
+                            description='''
+    Benchmark the gdan entry points against a local FireCloud stand-in with
+    synthetic inputs, and compare the results with a saved baseline.''')
+    parser.add_argument('-N', '--cohorts', type=int, default=4,
+                        help='Number of cohorts.')
+    parser.add_argument('-M', '--samples', type=int, default=100,
+                        help='Samples per cohort.')
+    parser.add_argument('-K', '--nodes', type=int, default=10,
+                        help='Method configs in the workflow.')
+    parser.add_argument('-f', '--flows', nargs='+',
+                        choices=FLOWS + (STARTUP,),
+                        default=list(FLOWS + (STARTUP,)),
+                        help='''Entry points to run, and startup to time
+                        the start of each subcommand.''')
+    parser.add_argument('-R', '--repeat', type=int, default=1,
+                        help='''Runs of each flow; the median of each metric
+                        is reported.''')
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help='Seconds added to every FireCloud call.')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='''Fraction of FireCloud calls failing with a
+                        server error.''')
+    parser.add_argument('--quota', type=int,
+                        help='''Concurrent FireCloud calls above which calls
+                        are throttled.''')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed for the choice of failing calls.')
+    parser.add_argument('-j', '--jobs', type=int, default=8,
+                        help='''Maximum number of concurrent FireCloud calls
+                        while provisioning.''')
+    parser.add_argument('--template', action='store_true',
+                        help='''Have each flow clone its workspace from a
+                        template workspace, built before the run is
+                        timed.''')
+    parser.add_argument('-b', '--baseline', metavar='FILE',
+                        help='Baseline results to compare with.')
+    parser.add_argument('-t', '--threshold', type=float, default=0.2,
+                        help='''Fraction by which a metric may exceed the
+                        baseline before it counts as a regression.''')
+    parser.add_argument('-s', '--save', metavar='FILE',
+                        help='Save the results as a baseline to FILE.')
+    # A single run, in the child process measure() starts
+    parser.add_argument('--flow', choices=FLOWS, help=SUPPRESS)
+    parser.add_argument('--inputs', help=SUPPRESS)
+    parser.add_argument('--workdir', help=SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.flow:
+        result = run_flow(args.flow, json.loads(args.inputs), args.workdir,
+                          args.latency, args.error_rate, args.seed, args.jobs,
+                          args.quota, args.template)
+        sys.stdout.write(json.dumps(result) + '\n')
+        return
+
+    parameters = dict((key, getattr(args, key)) for key in
+                      ('cohorts', 'samples', 'nodes', 'latency', 'error_rate',
+                       'quota', 'seed', 'jobs', 'template'))
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as bf:
+            baseline = json.load(bf)
+        if baseline['parameters'] != parameters:
+            logging.warning('Baseline was run with different parameters: %s',
+                            json.dumps(baseline['parameters'],
+                                       sort_keys=True))
+
+    inputs_dir = tempfile.mkdtemp(prefix='gdan_benchmark.')
+    try:
+        inputs = write_inputs(inputs_dir, args.cohorts, args.samples,
+                              args.nodes)
+        results = dict()
+        for flow in args.flows:
+            logging.info('Benchmarking %s', flow)
+            if flow == STARTUP:
+                results[flow] = measure_startup(STARTUP_RUNS *
+                                                max(1, args.repeat))
+                continue
+            runs = [measure(flow, inputs, args)
+                    for _ in range(max(1, args.repeat))]
+            if not all(run['ok'] for run in runs):
+                logging.error('%s did not succeed', flow)
+            if all('calls' in run for run in runs):
+                results[flow] = summarize(runs)
+    finally:
+        shutil.rmtree(inputs_dir, ignore_errors=True)
+
+    if results:
+        logging.info('Benchmark results, in seconds:\n%s', report(results))
+    if args.save:
+        with open(args.save, 'w') as bf:
+            bf.write(text_type(json.dumps({'parameters': parameters,
+                                           'results': results}, indent=2,
+                                          sort_keys=True)))
+        logging.info('Saved baseline to %s', args.save)
+
+    failed = len(results) < len(args.flows) or \
+             not all(result['ok'] for result in results.values())
+    if baseline is not None:
+        found = regressions(results, baseline['results'], args.threshold)
+        if found:
+            logging.error('Regressions beyond %d%% of the baseline:\n\t%s',
+                          100 * args.threshold, '\n\t'.join(found))
+            failed = True
+        else:
+            logging.info('No regressions beyond %d%% of the baseline',
+                         100 * args.threshold)
+    if failed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+# encoding: utf-8
+'''
+The gdan command, which runs each of the gdan tools as a subcommand:
+
+    gdan stddata -d 2018_08_24 /path/to/loadfiles
+    gdan analyses -d 2018_08_24
+    gdan recover ~/.fiss/Analyses.jsonl
+
+Only the module of the subcommand given is imported, and only once its name
+has been checked, so `gdan --help` and a mistyped subcommand return at
+once. Other than dashboard, index and harvest, the subcommands are the same as the gdac_new,
+stddata_new, analyses_new, gdan_recover, gdan_resources and gdan_benchmark
+commands.
+'''
+
+import sys
+from argparse import ArgumentParser, RawDescriptionHelpFormatter, REMAINDER
+from collections import OrderedDict
+from importlib import import_module
+
+# Subcommand: (module whose main() runs it, summary)
+COMMANDS = OrderedDict([
+    ('gdac',      ('gdan.gdac_new', 'Create and run a workspace for cohorts '
+                                    'of local loadfiles.')),
+    ('stddata',   ('gdan.stddata_new', 'Create and run a data '
+                                       'standardization workspace.')),
+    ('analyses',  ('gdan.analyses_new', 'Create and run a data analyses '
+                                        'workspace.')),
+    ('recover',   ('gdan.scheduler', 'Resume a workflow run from its '
+                                     'recovery file.')),
+    ('dashboard', ('gdan.dashboard', 'Update the status dashboard of a '
+                                     'workspace.')),
+    ('index',     ('gdan.index', 'Update the local index of workspaces and '
+                                 'find sample sets in it.')),
+    ('harvest',   ('gdan.harvest', 'Download the output files of a '
+                                   'workspace\'s workflow runs.')),
+    ('resources', ('gdan.resources', 'Record or show task resource '
+                                     'usage.')),
+    ('benchmark', ('gdan.benchmark', 'Benchmark the entry points against a '
+                                     'local FireCloud stand-in.')),
+])
+
+def main(argv=None):
+    parser = ArgumentParser(
+        prog='gdan', formatter_class=RawDescriptionHelpFormatter,
+        description='Tools for running GDAN analyses in FireCloud.',
+        epilog='subcommands:\n' + '\n'.join(
+            '  {:<12}{}'.format(name, summary)
+            for name, (_, summary) in COMMANDS.items()) +
+            '\n\nRun gdan SUBCOMMAND --help for the options of each.')
+    parser.add_argument('command', metavar='SUBCOMMAND', choices=COMMANDS,
+                        help='One of: ' + ', '.join(COMMANDS) + '.')
+    parser.add_argument('args', nargs=REMAINDER, help='Its arguments.')
+    args = parser.parse_args(argv)
+
+    # Usage and help messages of the subcommand name it, not just gdan
+    sys.argv[0] = 'gdan ' + args.command
+    return import_module(COMMANDS[args.command][0]).main(args.args)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+# encoding: utf-8
+'''
+Local cache of the method configs of a methods workspace.
+
+Every workspace gdan creates copies its method configs from the same
+Production workspace, so rather than reading each config from FireCloud for
+every workspace, configs are kept under ~/.fiss/gdan_configs, one JSON file
+per methods workspace, keyed by namespace, name and snapshot. The snapshot
+is a digest of what the workspace's config listing says about a config: its
+root entity type and the method, with its version, that it runs.
+
+A single listing of the methods workspace, made the first time a config is
+needed, validates every entry at once: a config whose snapshot changed is
+read again. Edits to a config's inputs or outputs don't show in the listing,
+so entries are also refreshed once they are older than max_age.
+'''
+
+import os
+import json
+import time
+import hashlib
+import logging
+import tempfile
+import threading
+from io import open
+from six import text_type
+
+from gdan.fcclient import get_client
+
+DEFAULT_CACHE_DIR = os.path.expanduser(os.path.join('~', '.fiss',
+                                                    'gdan_configs'))
+# Seconds a cached config is used for, even if its snapshot is unchanged
+DEFAULT_MAX_AGE = 6 * 3600
+
+def snapshot(summary):
+    """Digest of a config's summary, as listed by config_list"""
+    key = json.dumps([summary.get('rootEntityType'),
+                      summary.get('methodRepoMethod')], sort_keys=True)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()[:12]
+
+class ConfigCache(object):
+    """Method configs of project/workspace, read from FireCloud only when
+    missing from the cache or stale. Safe to share between threads"""
+    def __init__(self, project, workspace, directory=DEFAULT_CACHE_DIR,
+                 max_age=DEFAULT_MAX_AGE, client=None):
+        self.project = project
+        self.workspace = workspace
+        self.path = os.path.join(directory, '{}.{}.json'.format(project,
+                                                                workspace))
+        self.max_age = max_age
+        self.client = client or get_client()
+        self.hits = self.misses = 0
+        self._snapshots = None
+        self._entries = None
+        self._lock = threading.Lock()
+        self._warm_lock = threading.Lock()
+        self._locks = dict()
+
+    def _load(self):
+        try:
+            with open(self.path) as cf:
+                return json.load(cf)
+        except (IOError, OSError, ValueError):
+            return dict()
+
+    def _save(self):
+        """Write the cache atomically, so concurrent runs never see a
+        partial file. Called with the lock held"""
+        directory = os.path.dirname(self.path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with open(fd, 'w') as cf:
+            cf.write(text_type(json.dumps(self._entries)))
+        os.rename(tmp, self.path)
+
+    def warm(self):
+        """List the workspace's configs, dropping cached entries whose
+        snapshot no longer matches. Returns the number still valid"""
+        listing = self.client.config_list(self.project, self.workspace)
+        with self._lock:
+            self._snapshots = dict(('{}/{}'.format(s['namespace'], s['name']),
+                                    snapshot(s)) for s in listing)
+            entries = self._load()
+            self._entries = dict(
+                (key, entry) for key, entry in entries.items()
+                if self._snapshots.get(key.rsplit('/', 1)[0]) ==
+                   key.rsplit('/', 1)[1])
+            if len(self._entries) < len(entries):
+                self._save()
+            logging.info('%d of %d method configs in %s/%s are cached',
+                         len(self._entries), len(self._snapshots),
+                         self.project, self.workspace)
+            return len(self._entries)
+
+    def get(self, namespace, config):
+        """The body of namespace/config, from the cache if it is valid"""
+        # Only the first thread to need a config lists the workspace
+        with self._warm_lock:
+            if self._snapshots is None:
+                self.warm()
+        name = '{}/{}'.format(namespace, config)
+        key = '{}/{}'.format(name, self._snapshots.get(name))
+        with self._lock:
+            lock = self._locks.setdefault(key, threading.Lock())
+        with lock:
+            entry = self._entries.get(key)
+            fresh = entry is not None and \
+                    time.time() - entry['fetched'] < self.max_age
+            with self._lock:
+                if fresh:
+                    self.hits += 1
+                else:
+                    self.misses += 1
+            if fresh:
+                return entry['body']
+            body = self.client.config_get(self.project, self.workspace,
+                                          namespace, config)
+            with self._lock:
+                # Keep what other runs cached meanwhile
+                entries = self._load()
+                entries.update(self._entries)
+                self._entries = entries
+                self._entries[key] = {'fetched': time.time(), 'body': body}
+                self._save()
+            return body
+
+    def copy(self, config, namespace, to_project, to_workspace):
+        """Copy namespace/config to to_project/to_workspace"""
+        body = self.get(namespace, config)
+        self.client.config_put(to_project, to_workspace, body)
+        return body
@@ -0,0 +1,263 @@
+# encoding: utf-8
+'''
+Static status dashboard of the workflow runs in a workspace.
+
+A StatusPoller keeps a snapshot of a workspace's submissions, with the state
+of each of their workflows, in <directory>/<workspace>.dashboard.json, so as
+not to clobber the <workspace>.json recovery files of fissfc. Each poll
+lists the workspace's submissions once, then fetches only those that are
+new, or whose status or workflow counts changed since the last poll; the
+others are taken from the snapshot as they are. A finished submission is
+fetched once after it finishes and never again, so the cost of polling
+follows the work in progress rather than the workspace's history. After each
+poll the snapshot is rendered to <directory>/<workspace>.html, a page that
+needs no server to view.
+
+    gdan dashboard -p broad-firecloud-gdac -o ~/public_html awg_brca__2018_08_24
+'''
+
+import os
+import sys
+import json
+import time
+import logging
+import tempfile
+import threading
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from io import open
+from xml.sax.saxutils import escape
+from six import text_type
+
+from gdan import trace
+from gdan.fcclient import get_client
+from gdan.scheduler import DEFAULT_POLL_INTERVAL
+
+# Order of submission statuses in the summary; others follow
+STATUSES = ('Accepted', 'Evaluating', 'Submitting', 'Submitted', 'Running',
+            'Aborting', 'Aborted', 'Done')
+
+def _save(path, text):
+    """Write text to path atomically, so viewers never see a partial file"""
+    directory = os.path.dirname(os.path.abspath(path))
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    with open(fd, 'w') as out:
+        out.write(text_type(text))
+    # mkstemp files are private; the dashboard is meant to be shared
+    os.chmod(tmp, 0o644)
+    os.rename(tmp, path)
+
+def outcome(submission):
+    """Succeeded, Failed or the status of a submission, for display"""
+    if submission['status'] != 'Done':
+        return submission['status']
+    return 'Failed' if set(submission['workflowStatuses']).difference(
+        ['Succeeded']) else 'Succeeded'
+
+class StatusPoller(object):
+    """Keeps the dashboard of project/workspace in directory up to date"""
+    def __init__(self, project, workspace, directory='.', client=None,
+                 jobs=8):
+        self.project = project
+        self.workspace = workspace
+        self.path = os.path.join(directory, workspace + '.dashboard.json')
+        self.html = os.path.join(directory, workspace + '.html')
+        self.client = client or get_client()
+        self.jobs = max(1, jobs)
+        self.fetched = 0
+        self.snapshot = self._load()
+        self._thread = None
+        self._stop = threading.Event()
+
+    def _load(self):
+        try:
+            with open(self.path) as sf:
+                snapshot = json.load(sf)
+            if [snapshot['project'], snapshot['workspace']] == \
+               [self.project, self.workspace]:
+                return snapshot
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+        return {'project': self.project, 'workspace': self.workspace,
+                'updated': None, 'submissions': dict()}
+
+    def _fetch(self, summary):
+        """The record of a submission, with its workflows"""
+        sid = summary['submissionId']
+        detail = self.client.submission_get(self.project, self.workspace, sid)
+        entity = summary.get('submissionEntity', {})
+        return {'config': summary.get('methodConfigurationName'),
+                'entity': entity.get('entityName'),
+                'entityType': entity.get('entityType'),
+                'submitted': summary.get('submissionDate'),
+                'status': summary['status'],
+                'workflowStatuses': summary.get('workflowStatuses', {}),
+                'workflows': [{'id': wf.get('workflowId'),
+                               'status': wf.get('status'),
+                               'entity': wf.get('workflowEntity', {}).get(
+                                   'entityName')}
+                              for wf in detail.get('workflows', [])]}
+
+    def changed(self, listing):
+        """Those of the submissions listed that differ from the snapshot"""
+        known = self.snapshot['submissions']
+        return [summary for summary in listing
+                if summary['submissionId'] not in known or
+                known[summary['submissionId']]['status'] !=
+                summary['status'] or
+                known[summary['submissionId']]['workflowStatuses'] !=
+                summary.get('workflowStatuses', {})]
+
+    def poll(self):
+        """Bring the snapshot up to date and render it, returning the number
+        of submissions fetched"""
+        listing = self.client.submission_list(self.project, self.workspace)
+        changed = self.changed(listing)
+        if changed:
+            with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+                records = list(pool.map(trace.wrap(self._fetch), changed))
+            for summary, record in zip(changed, records):
+                self.snapshot['submissions'][summary['submissionId']] = record
+            self.fetched += len(changed)
+        self.snapshot['updated'] = time.strftime('%Y-%m-%d %H:%M:%S')
+        self.snapshot['summary'] = self.summary()
+        _save(self.path, json.dumps(self.snapshot, indent=1,
+                                    sort_keys=True))
+        _save(self.html, self.render())
+        logging.debug('Dashboard of %s/%s: %d of %d submission(s) fetched',
+                      self.project, self.workspace, len(changed),
+                      len(listing))
+        return len(changed)
+
+    def latest(self):
+        """The most recent submission of each config on each entity, by
+        config and then entity"""
+        latest = dict()
+        for sid, record in self.snapshot['submissions'].items():
+            key = record['config'], record['entity']
+            if key not in latest or \
+               (record['submitted'] or '') > (latest[key][1]['submitted']
+                                              or ''):
+                latest[key] = sid, record
+        return OrderedDict((key, latest[key]) for key in sorted(
+            latest, key=lambda key: (key[0] or '', key[1] or '')))
+
+    def summary(self):
+        """Count of the latest submissions of each config, by outcome"""
+        summary = OrderedDict()
+        for (config, _), (_, record) in self.latest().items():
+            counts = summary.setdefault(config, dict())
+            counts[outcome(record)] = counts.get(outcome(record), 0) + 1
+        return summary
+
+    def render(self):
+        """The snapshot as a static HTML page"""
+        summary = self.snapshot.get('summary') or self.summary()
+        outcomes = [status for status in ('Succeeded', 'Failed') +
+                    STATUSES if status != 'Done' and any(
+                        status in counts for counts in summary.values())]
+        outcomes += sorted(set(status for counts in summary.values()
+                               for status in counts).difference(outcomes))
+        title = escape('{}/{}'.format(self.project, self.workspace))
+        lines = ['<!DOCTYPE html>', '<html><head><meta charset="utf-8">',
+                 '<title>{}</title>'.format(title),
+                 '<style>body{font-family:sans-serif}'
+                 'table{border-collapse:collapse}'
+                 'td,th{border:1px solid #ccc;padding:2px 8px}'
+                 '.Succeeded{background:#cfc}.Failed{background:#fcc}'
+                 '.Running,.Submitted{background:#ffc}</style>',
+                 '</head><body>', '<h1>{}</h1>'.format(title),
+                 '<p>Updated {}</p>'.format(escape(
+                     self.snapshot['updated'] or 'never')),
+                 '<h2>Summary</h2>', '<table><tr><th>Method config</th>' +
+                 ''.join('<th>{}</th>'.format(escape(status))
+                         for status in outcomes) + '</tr>']
+        for config, counts in summary.items():
+            lines.append('<tr><td>{}</td>'.format(escape(config or '')) +
+                         ''.join('<td>{}</td>'.format(counts.get(status, ''))
+                                 for status in outcomes) + '</tr>')
+        lines += ['</table>', '<h2>Latest submissions</h2>',
+                  '<table><tr><th>Method config</th><th>Entity</th>'
+                  '<th>Submitted</th><th>Status</th><th>Workflows</th>'
+                  '<th>Submission</th></tr>']
+        for (config, entity), (sid, record) in self.latest().items():
+            lines.append(
+                '<tr class="{0}"><td>{1}</td><td>{2}</td><td>{3}</td>'
+                '<td>{0}</td><td>{4}</td><td>{5}</td></tr>'.format(
+                    escape(outcome(record)), escape(config or ''),
+                    escape(entity or ''), escape(record['submitted'] or ''),
+                    escape(', '.join('{} {}'.format(count, status) for
+                                     status, count in sorted(
+                                         record['workflowStatuses'].items()))),
+                    escape(sid)))
+        lines += ['</table>', '</body></html>', '']
+        return '\n'.join(lines)
+
+    def _update(self):
+        """Poll, only logging a failure to, so that the dashboard never
+        stops the run it reports on"""
+        try:
+            self.poll()
+        except Exception as e:
+            logging.warning('Dashboard of %s/%s not updated: %s',
+                            self.project, self.workspace, e)
+
+    def _watch(self, interval):
+        while not self._stop.wait(interval):
+            self._update()
+
+    def start(self, interval=DEFAULT_POLL_INTERVAL):
+        """Poll every interval seconds in a background thread until stopped"""
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._watch,
+                                        args=(max(1, interval),))
+        self._thread.daemon = True
+        self._thread.start()
+        logging.info('Updating the dashboard at %s every %d seconds',
+                     self.html, max(1, interval))
+
+    def stop(self):
+        """Stop polling, then poll once more for the final state"""
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        self._update()
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s::%(levelname)s  %(message)s',
+                        datefmt='%Y-%m-%d %I:%M:%S %p')
+    parser = ArgumentParser(formatter_class=ArgumentDefaultsHelpFormatter,
+                            description='''
+    Update the static HTML and JSON status dashboard of the submissions in a
+    workspace, once or at an interval.''')
+    parser.add_argument('workspace', help='Workspace to report on.')
+    parser.add_argument('-p', '--project', default='broad-firecloud-gdac',
+                        help='Project the workspace is in.')
+    parser.add_argument('-o', '--output', default='.',
+                        help='Directory to write the dashboard to.')
+    parser.add_argument('-w', '--watch', metavar='SECONDS', type=int,
+                        help='Keep updating the dashboard at this interval.')
+    parser.add_argument('-j', '--jobs', type=int, default=8,
+                        help='Maximum number of submissions fetched at once.')
+    args = parser.parse_args(argv)
+
+    poller = StatusPoller(args.project, args.workspace, args.output,
+                          jobs=args.jobs)
+    try:
+        while True:
+            fetched = poller.poll()
+            logging.info('%s updated, %d submission(s) fetched', poller.html,
+                         fetched)
+            if not args.watch:
+                break
+            time.sleep(args.watch)
+    except KeyboardInterrupt:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+# encoding: utf-8
+'''
+Find the cohorts whose loadfiles changed since an earlier dicing.
+
+A delta stddata run compares each cohort's participant, sample and sample
+set loadfiles with those of the same cohort in the directory of a previous
+datestamp, by a digest of their decompressed contents, so a file that was
+only compressed again does not count as changed. A cohort has changed if
+any of its loadfiles is new or differs, or if its sample sets take in
+samples of a cohort that changed, as those of aggregate cohorts like
+COADREAD do. Only the cohorts that changed are imported and merged again;
+the sample sets of the others, with the outputs of their merges, are copied
+from the previous workspace.
+'''
+
+import os
+import hashlib
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from gdan.loadfiles import glob_loadfiles, open_loadfile
+from gdan.validate import cohort_loadfiles
+
+def content_digest(loadfile):
+    """Digest of the contents of loadfile, compressed or not"""
+    digest = hashlib.sha1()
+    with open_loadfile(loadfile) as lf:
+        for line in lf:
+            digest.update(line.rstrip('\r\n').encode('utf-8') + b'\n')
+    return digest.hexdigest()
+
+def cohort_digests(directory, jobs=4):
+    """Digests of the loadfiles of each cohort in directory, as {cohort:
+    {entity type: digest}}"""
+    cohorts = cohort_loadfiles(glob_loadfiles(os.path.join(directory,
+                                                           '*-*.*')))
+    paths = [path for loadfiles in cohorts.values()
+             for path in loadfiles.values()]
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        digests = dict(zip(paths, pool.map(content_digest, paths)))
+    return dict((cohort, dict((etype, digests[path])
+                              for etype, path in loadfiles.items()))
+                for cohort, loadfiles in cohorts.items())
+
+def _column(loadfile, index):
+    """Values of a column of loadfile, without its header"""
+    with open_loadfile(loadfile) as lf:
+        lf.readline()
+        for line in lf:
+            fields = line.rstrip('\r\n').split('\t')
+            if len(fields) > index and fields[index]:
+                yield fields[index]
+
+def changed_cohorts(directory, previous, jobs=4):
+    """Cohorts in the loadfile directory whose loadfiles differ from those
+    in the directory previous, and the unchanged ones, as two sorted lists"""
+    current = cohort_digests(directory, jobs)
+    earlier = cohort_digests(previous, jobs)
+    changed = set(cohort for cohort, digests in current.items()
+                  if digests != earlier.get(cohort))
+    loadfiles = cohort_loadfiles(glob_loadfiles(os.path.join(directory,
+                                                             '*-*.*')))
+    # Repeat until settled, in case aggregates take in aggregates
+    while True:
+        samples = set(sample for cohort in changed
+                      if 'sample' in loadfiles[cohort]
+                      for sample in _column(loadfiles[cohort]['sample'], 0))
+        aggregates = set(cohort for cohort in current
+                         if cohort not in changed and
+                         'sample_set' in loadfiles[cohort] and
+                         any(sample in samples for sample in _column(
+                             loadfiles[cohort]['sample_set'], 1)))
+        if not aggregates:
+            break
+        logging.info('%s take(s) in samples of changed cohorts',
+                     ', '.join(sorted(aggregates)))
+        changed.update(aggregates)
+    return sorted(changed), sorted(set(current).difference(changed))
+
+def sample_sets(directory, cohorts):
+    """Names of the sample sets of cohorts, from their loadfiles in
+    directory"""
+    loadfiles = cohort_loadfiles(glob_loadfiles(os.path.join(directory,
+                                                             '*-*.*')))
+    return sorted(set(sset for cohort in cohorts
+                      if 'sample_set' in loadfiles.get(cohort, {})
+                      for sset in _column(loadfiles[cohort]['sample_set'],
+                                          0)))
@@ -0,0 +1,421 @@
+# encoding: utf-8
+'''
+In-memory stand-in for the FireCloud Orchestration API, for benchmarks.
+
+FakeFireCloud serves the endpoints FireCloudClient uses over local HTTP,
+keeping workspaces, method configs, entities and submissions in memory.
+Every request can be delayed by a fixed latency and fail with a 503 at a
+given rate, requests beyond a quota of concurrent ones are throttled with a
+429, and requests are counted per route. Submissions finish as soon as they
+are listed.
+
+    fake = FakeFireCloud(latency=0.05)
+    url = fake.start()
+    set_client(FireCloudClient(url, requests.Session()))
+'''
+
+import re
+import copy
+import json
+import time
+import datetime
+import random
+import threading
+import itertools
+from collections import OrderedDict, Counter
+from six.moves.BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from six.moves.socketserver import ThreadingMixIn
+from six.moves.urllib.parse import urlparse, parse_qs
+
+from gdan.loadfiles import open_loadfile
+
+_SPACE = r'/api/workspaces/(?P<ns>[^/]+)/(?P<ws>[^/]+)'
+# (method, route name, path pattern)
+ROUTES = [(method, name, re.compile(pattern + '$')) for method, name, pattern in [
+    ('POST',   'space_new',       r'/api/workspaces'),
+    ('GET',    'space_list',      r'/api/workspaces'),
+    ('GET',    'space_get',       _SPACE),
+    ('DELETE', 'space_delete',    _SPACE),
+    ('POST',   'space_clone',     _SPACE + r'/clone'),
+    ('GET',    'acl_get',         _SPACE + r'/acl'),
+    ('PATCH',  'acl_set',         _SPACE + r'/acl'),
+    ('PATCH',  'attr_set',        _SPACE + r'/updateAttributes'),
+    ('GET',    'config_list',     _SPACE + r'/methodconfigs'),
+    ('GET',    'config_get',      _SPACE + r'/method_configs/(?P<cns>[^/]+)/(?P<name>[^/]+)'),
+    ('PUT',    'config_put',      _SPACE + r'/method_configs/(?P<cns>[^/]+)/(?P<name>[^/]+)'),
+    ('DELETE', 'config_delete',   _SPACE + r'/method_configs/(?P<cns>[^/]+)/(?P<name>[^/]+)'),
+    ('POST',   'entity_import',   _SPACE + r'/(?:flexibleI|i)mportEntities'),
+    ('POST',   'entity_copy',     _SPACE + r'/entities/copy'),
+    ('PATCH',  'entity_update',   _SPACE + r'/entities/(?P<etype>[^/]+)/(?P<name>[^/]+)'),
+    ('GET',    'entity_query',    _SPACE + r'/entityQuery/(?P<etype>[^/]+)'),
+    ('POST',   'submission_new',  _SPACE + r'/submissions'),
+    ('GET',    'submission_list', _SPACE + r'/submissions'),
+    ('GET',    'submission_get',  _SPACE + r'/submissions/(?P<sid>[^/]+)'),
+]]
+# Entity types loadfile reference columns may point to
+REFERENCE_TYPES = ('participant', 'sample', 'pair')
+
+class FakeError(Exception):
+    def __init__(self, code, message):
+        super(FakeError, self).__init__(message)
+        self.code = code
+
+def _now():
+    """The time, as FireCloud reports it"""
+    return datetime.datetime.utcnow().isoformat() + 'Z'
+
+def _workspace(name):
+    return {'name': name, 'attributes': dict(), 'acl': dict(),
+            'configs': OrderedDict(), 'entities': dict(),
+            'submissions': OrderedDict(), 'lastModified': _now()}
+
+class FakeFireCloud(object):
+    """In-memory FireCloud, served over HTTP on a local port"""
+    def __init__(self, latency=0.0, error_rate=0.0, seed=0, quota=None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.quota = quota
+        self.calls = Counter()
+        self.errors = 0
+        self.throttled = 0
+        self.in_flight = 0
+        self.first_submission = None
+        self.workspaces = dict()
+        self._random = random.Random(seed)
+        self._ids = itertools.count(1)
+        self._lock = threading.RLock()
+        self._server = None
+
+    def start(self):
+        """Serve on an ephemeral port, returning the API root URL"""
+        fake = self
+
+        class Handler(_Handler):
+            firecloud = fake
+
+        class Server(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+            request_queue_size = 128
+
+        self._server = Server(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=self._server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return 'http://127.0.0.1:{}/api/'.format(self._server.server_port)
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+    # Direct access, for setting up fixtures without going through HTTP
+    def space(self, project, workspace, create=False):
+        key = (project, workspace)
+        with self._lock:
+            if key not in self.workspaces:
+                if not create:
+                    raise FakeError(404, 'No workspace {}/{}'.format(*key))
+                self.workspaces[key] = _workspace(workspace)
+            return self.workspaces[key]
+
+    def add_config(self, project, workspace, namespace, name,
+                   root_entity_type='sample_set'):
+        self.space(project, workspace, True)['configs'][namespace, name] = {
+            'namespace': namespace, 'name': name,
+            'rootEntityType': root_entity_type,
+            'methodRepoMethod': {'methodNamespace': namespace,
+                                 'methodName': name, 'methodVersion': 1},
+            'inputs': {}, 'outputs': {}, 'prerequisites': {}}
+
+    def load(self, project, workspace, loadfile):
+        """Import a loadfile straight into a workspace"""
+        with open_loadfile(loadfile) as lf:
+            self.import_entities(self.space(project, workspace, True),
+                                 lf.read())
+
+    def import_entities(self, space, text):
+        lines = [line.split('\t') for line in text.splitlines() if line]
+        header = lines[0]
+        kind, key = header[0].split(':', 1)
+        etype = key[:-3] if key.endswith('_id') else key
+        with self._lock:
+            entities = space['entities'].setdefault(etype, OrderedDict())
+            if kind == 'membership':
+                member = header[1][:-3] if header[1].endswith('_id') \
+                         else header[1]
+                for fields in lines[1:]:
+                    attrs = entities.setdefault(fields[0], dict())
+                    items = attrs.setdefault(member + 's', {
+                        'itemsType': 'EntityReference', 'items': []})
+                    items['items'].append({'entityType': member,
+                                           'entityName': fields[1]})
+                return
+            for fields in lines[1:]:
+                if kind == 'update' and fields[0] not in entities:
+                    raise FakeError(400, '{} {} does not exist'.format(
+                        etype, fields[0]))
+                attrs = entities.setdefault(fields[0], dict())
+                for column, value in zip(header[1:], fields[1:]):
+                    ref = column[:-3] if column.endswith('_id') else None
+                    if ref in REFERENCE_TYPES:
+                        attrs[ref] = {'entityType': ref, 'entityName': value}
+                    else:
+                        attrs[column] = value
+
+    def _copy(self, source, target, etype, name):
+        attrs = source['entities'].get(etype, {}).get(name)
+        if attrs is None:
+            raise FakeError(404, '{} {} not found'.format(etype, name))
+        target['entities'].setdefault(etype, OrderedDict())[name] = \
+            json.loads(json.dumps(attrs))
+        # Copy what the entity refers to along with it
+        for value in attrs.values():
+            refs = value.get('items', [value]) if isinstance(value, dict) \
+                   else []
+            for ref in refs:
+                if isinstance(ref, dict) and 'entityName' in ref and \
+                   ref['entityName'] not in target['entities'].get(
+                       ref['entityType'], {}):
+                    self._copy(source, target, ref['entityType'],
+                               ref['entityName'])
+
+    # Request handling
+    def handle(self, method, path, query, body):
+        """Return (status, response body) for a request"""
+        for route_method, name, pattern in ROUTES:
+            match = pattern.match(path)
+            if match and route_method == method:
+                break
+        else:
+            return 404, {'message': 'No route for {} {}'.format(method, path)}
+        with self._lock:
+            self.calls[name] += 1
+            if self.quota and self.in_flight >= self.quota:
+                self.throttled += 1
+                return 429, {'message': 'Too many requests'}
+            self.in_flight += 1
+        try:
+            if self.latency:
+                time.sleep(self.latency)
+            with self._lock:
+                if self.error_rate and \
+                   self._random.random() < self.error_rate:
+                    self.errors += 1
+                    return 503, {'message': 'Injected failure'}
+            code, response = getattr(self, '_' + name)(query, body,
+                                                       **match.groupdict())
+            # Whatever changes a workspace updates its lastModified
+            key = match.groupdict().get('ns'), match.groupdict().get('ws')
+            with self._lock:
+                if method != 'GET' and key in self.workspaces:
+                    self.workspaces[key]['lastModified'] = _now()
+            return code, response
+        except FakeError as e:
+            return e.code, {'message': str(e)}
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+    def _space_new(self, query, body):
+        key = (body['namespace'], body['name'])
+        with self._lock:
+            if key in self.workspaces:
+                raise FakeError(409, 'Workspace exists')
+            space = self.space(key[0], key[1], True)
+            space['attributes'].update(body.get('attributes', {}))
+        return 201, {'namespace': key[0], 'name': key[1]}
+
+    def _space_list(self, query, body):
+        with self._lock:
+            return 200, [{'accessLevel': 'OWNER', 'workspace': {
+                'namespace': ns, 'name': ws,
+                'lastModified': space['lastModified'],
+                'attributes': space['attributes']}}
+                for (ns, ws), space in sorted(self.workspaces.items())]
+
+    def _space_get(self, query, body, ns, ws):
+        space = self.space(ns, ws)
+        return 200, {'workspace': {'namespace': ns, 'name': ws,
+                                   'lastModified': space['lastModified'],
+                                   'attributes': space['attributes']}}
+
+    def _space_clone(self, query, body, ns, ws):
+        key = (body['namespace'], body['name'])
+        with self._lock:
+            source = self.space(ns, ws)
+            if key in self.workspaces:
+                raise FakeError(409, 'Workspace exists')
+            clone = self.space(key[0], key[1], True)
+            # Everything but ACLs and submissions, as FireCloud does
+            for part in ('attributes', 'configs', 'entities'):
+                clone[part] = copy.deepcopy(source[part])
+            clone['attributes'].update(body.get('attributes', {}))
+        return 201, {'namespace': key[0], 'name': key[1]}
+
+    def _space_delete(self, query, body, ns, ws):
+        with self._lock:
+            self.space(ns, ws)
+            del self.workspaces[ns, ws]
+        return 202, {}
+
+    def _acl_get(self, query, body, ns, ws):
+        return 200, {'acl': dict((user, {'accessLevel': level})
+                                 for user, level in
+                                 self.space(ns, ws)['acl'].items())}
+
+    def _acl_set(self, query, body, ns, ws):
+        space = self.space(ns, ws)
+        with self._lock:
+            for entry in body:
+                space['acl'][entry['email']] = entry['accessLevel']
+        return 200, {'usersUpdated': body, 'usersNotFound': []}
+
+    @staticmethod
+    def _apply(attributes, updates):
+        for update in updates:
+            attributes[update['attributeName']] = update['addUpdateAttribute']
+
+    def _attr_set(self, query, body, ns, ws):
+        with self._lock:
+            self._apply(self.space(ns, ws)['attributes'], body)
+        return 200, {}
+
+    def _config_list(self, query, body, ns, ws):
+        return 200, [dict((k, config[k]) for k in
+                          ('namespace', 'name', 'rootEntityType',
+                           'methodRepoMethod'))
+                     for config in self.space(ns, ws)['configs'].values()]
+
+    def _config_get(self, query, body, ns, ws, cns, name):
+        config = self.space(ns, ws)['configs'].get((cns, name))
+        if config is None:
+            raise FakeError(404, 'No method config {}/{}'.format(cns, name))
+        return 200, config
+
+    def _config_put(self, query, body, ns, ws, cns, name):
+        with self._lock:
+            self.space(ns, ws)['configs'][cns, name] = body
+        return 200, body
+
+    def _config_delete(self, query, body, ns, ws, cns, name):
+        with self._lock:
+            if self.space(ns, ws)['configs'].pop((cns, name), None) is None:
+                raise FakeError(404, 'No method config {}/{}'.format(cns,
+                                                                    name))
+        return 204, {}
+
+    def _entity_import(self, query, body, ns, ws):
+        self.import_entities(self.space(ns, ws), body['entities'][0])
+        return 200, {}
+
+    def _entity_copy(self, query, body, ns, ws):
+        source = self.space(body['sourceWorkspace']['namespace'],
+                            body['sourceWorkspace']['name'])
+        target = self.space(ns, ws)
+        with self._lock:
+            for name in body['entityNames']:
+                self._copy(source, target, body['entityType'], name)
+        return 201, {'entitiesCopied': body['entityNames'],
+                     'hardConflicts': [], 'softConflicts': []}
+
+    def _entity_update(self, query, body, ns, ws, etype, name):
+        with self._lock:
+            entity = self.space(ns, ws)['entities'].get(etype, {}).get(name)
+            if entity is None:
+                raise FakeError(404, '{} {} not found'.format(etype, name))
+            self._apply(entity, body)
+        return 200, {}
+
+    def _entity_query(self, query, body, ns, ws, etype):
+        page = int(query.get('page', ['1'])[0])
+        size = int(query.get('pageSize', ['100'])[0])
+        fields = query.get('fields', [None])[0]
+        with self._lock:
+            entities = sorted(self.space(ns, ws)['entities'].get(
+                etype, {}).items())
+        pages = max(1, (len(entities) + size - 1) // size)
+        results = []
+        for name, attrs in entities[(page - 1) * size:page * size]:
+            if fields is not None:
+                wanted = fields.split(',')
+                attrs = dict((k, v) for k, v in attrs.items() if k in wanted)
+            results.append({'name': name, 'entityType': etype,
+                            'attributes': attrs})
+        return 200, {'resultMetadata': {'filteredPageCount': pages,
+                                        'filteredCount': len(entities)},
+                     'results': results}
+
+    def _submission_new(self, query, body, ns, ws):
+        space = self.space(ns, ws)
+        if (body['methodConfigurationNamespace'],
+                body['methodConfigurationName']) not in space['configs']:
+            raise FakeError(404, 'No method config ' +
+                            body['methodConfigurationName'])
+        with self._lock:
+            if self.first_submission is None:
+                self.first_submission = time.time()
+            sid = 'fake-{}'.format(next(self._ids))
+            entity = {'entityType': body['entityType'],
+                      'entityName': body['entityName']}
+            space['submissions'][sid] = {
+                'submissionId': sid, 'status': 'Submitted',
+                'methodConfigurationNamespace':
+                    body['methodConfigurationNamespace'],
+                'methodConfigurationName': body['methodConfigurationName'],
+                'submissionEntity': entity,
+                'submissionDate': time.strftime('%Y-%m-%dT%H:%M:%S.000Z',
+                                                time.gmtime()),
+                'workflowStatuses': {},
+                'workflows': [{'workflowId': sid + '-1', 'status': 'Queued',
+                               'workflowEntity': entity}]}
+        return 201, {'submissionId': sid}
+
+    def _submission_list(self, query, body, ns, ws):
+        with self._lock:
+            submissions = list(self.space(ns, ws)['submissions'].values())
+            # Everything listed once is done
+            for submission in submissions:
+                submission.update(status='Done',
+                                  workflowStatuses={'Succeeded': 1})
+                for workflow in submission['workflows']:
+                    workflow['status'] = 'Succeeded'
+            # Listings summarize submissions, without their workflows
+            return 200, [dict((key, value) for key, value in s.items()
+                              if key != 'workflows') for s in submissions]
+
+    def _submission_get(self, query, body, ns, ws, sid):
+        with self._lock:
+            submission = self.space(ns, ws)['submissions'].get(sid)
+            if submission is None:
+                raise FakeError(404, 'No submission ' + sid)
+            return 200, json.loads(json.dumps(submission))
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    firecloud = None
+
+    def log_message(self, *args):
+        pass
+
+    def _handle(self):
+        url = urlparse(self.path)
+        length = int(self.headers.get('Content-Length') or 0)
+        data = self.rfile.read(length).decode('utf-8') if length else ''
+        if self.headers.get('Content-Type', '').startswith(
+                'application/x-www-form-urlencoded'):
+            body = parse_qs(data)
+        else:
+            body = json.loads(data) if data else None
+        code, response = self.firecloud.handle(self.command, url.path,
+                                               parse_qs(url.query), body)
+        # No content means no body, or the next response on the
+        # connection would be misread
+        payload = b'' if code == 204 else \
+                  json.dumps(response).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = _handle
@@ -0,0 +1,387 @@
+# encoding: utf-8
+'''
+In-process FireCloud client shared by the gdan entry points.
+
+firecloud.fiss commands are meant for the command line: every call re-parses
+arguments and re-reads configuration on its way to firecloud.api. This
+module talks to the same Orchestration endpoints through a single pooled,
+authorized requests session, so connections are kept alive and access
+tokens are only refreshed when they expire.
+'''
+
+import os
+import json
+import random
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from six.moves.urllib.parse import urlencode, urljoin
+
+from firecloud.errors import FireCloudServerError
+from firecloud.fccore import __fcconfig as fcconfig
+from firecloud.__about__ import __version__ as fiss_version
+from gdan import trace
+from gdan.governor import Governor
+from gdan.loadfiles import read_header, read_chunks
+
+SCOPES = ['https://www.googleapis.com/auth/userinfo.profile',
+          'https://www.googleapis.com/auth/userinfo.email']
+USER_AGENT = 'gdan FISS/' + fiss_version
+# Attempts at a call after the first, for calls that are safe to repeat, and
+# for each chunk of an import
+RETRIES = 4
+IMPORT_RETRIES = 3
+# Longest wait, in seconds, before the first retry, doubled for each one
+# after up to MAX_RETRY_DELAY; the actual wait is a random fraction of it
+RETRY_DELAY = 2
+MAX_RETRY_DELAY = 60
+# Statuses worth retrying: throttled, and transient server errors
+THROTTLED = (429, 503)
+RETRY_CODES = (429, 500, 502, 503, 504)
+# Methods that may be repeated without changing the outcome
+IDEMPOTENT = ('GET', 'HEAD', 'PUT', 'DELETE')
+
+def authorized_session():
+    """A requests session using Google application default credentials"""
+    import google.auth
+    from google.auth.transport.requests import AuthorizedSession
+    logging.getLogger('google.auth').setLevel(logging.ERROR)
+    return AuthorizedSession(google.auth.default(SCOPES)[0])
+
+class FireCloudClient(object):
+    """Typed wrappers around the FireCloud API calls used by gdan.
+
+    All calls share one session, whose connection pool holds up to pool_size
+    connections, so concurrent provisioning steps can reuse connections.
+    Pass root_url and a plain requests.Session to talk to a local stand-in
+    server without credentials.
+
+    Calls are made through governor, by default a Governor letting up to
+    pool_size calls run at once, and are retried with jittered exponential
+    backoff: any call when throttled, since FireCloud did not act on it,
+    and calls safe to repeat on transient errors too."""
+    def __init__(self, root_url=None, session=None, pool_size=16,
+                 governor=None):
+        # requests is imported here, rather than with the module, so that
+        # the entry points start quickly when they make no calls
+        from requests.adapters import HTTPAdapter
+        self.root_url = root_url or fcconfig.root_url
+        if not self.root_url.endswith('/'):
+            self.root_url += '/'
+        self.session = authorized_session() if session is None else session
+        adapter = HTTPAdapter(pool_connections=pool_size,
+                              pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers['User-Agent'] = USER_AGENT
+        self.governor = governor or Governor(maximum=pool_size)
+
+    def _request(self, method, uri, codes, idempotent=None, retries=RETRIES,
+                 retry_codes=RETRY_CODES, **kwargs):
+        """Issue a request, raising FireCloudServerError unless the response
+        status is one of codes. Throttled requests are retried, and so are
+        those failing with retry_codes or a connection error if idempotent,
+        which by default depends on the method"""
+        from requests.exceptions import RequestException
+        if idempotent is None:
+            idempotent = method in IDEMPOTENT
+        url = urljoin(self.root_url, uri)
+        for attempt in range(retries + 1):
+            retry_after = 0
+            with self.governor.slot() as outcome:
+                try:
+                    r = self.session.request(method, url, **kwargs)
+                except RequestException as e:
+                    # Not a sign of throttling, so left to the retries
+                    if not idempotent or attempt == retries:
+                        raise
+                    error = e
+                else:
+                    logging.debug('%s %s: %d', method, r.url, r.status_code)
+                    outcome['throttled'] = r.status_code in THROTTLED
+                    if r.status_code in codes:
+                        return r
+                    if attempt == retries or not (
+                            r.status_code == 429 or
+                            (idempotent and r.status_code in retry_codes)):
+                        try:
+                            msg = json.dumps(r.json())
+                        except ValueError:
+                            msg = r.text
+                        raise FireCloudServerError(r.status_code, msg)
+                    error = r.status_code
+                    retry_after = r.headers.get('Retry-After', '')
+                    retry_after = int(retry_after) \
+                                  if retry_after.isdigit() else 0
+            delay = max(retry_after, random.uniform(
+                0, min(MAX_RETRY_DELAY, RETRY_DELAY * 2 ** attempt)))
+            logging.warning('%s %s failed (%s), retrying in %.1fs', method,
+                            uri, error, delay)
+            trace.retry()
+            time.sleep(delay)
+
+    @staticmethod
+    def _space(project, workspace):
+        return 'workspaces/{}/{}'.format(project, workspace)
+
+    # Workspaces
+    @trace.traced()
+    def space_exists(self, project, workspace):
+        """Whether project/workspace exists"""
+        r = self._request('GET', self._space(project, workspace), (200, 404),
+                          params={'fields': 'workspace.name'})
+        return r.status_code == 200
+
+    @trace.traced(workspace=())
+    def space_list(self, fields=None):
+        """Every workspace the user has access to"""
+        params = {'fields': fields} if fields else None
+        return self._request('GET', 'workspaces', (200,),
+                             params=params).json()
+
+    @trace.traced()
+    def space_get(self, project, workspace, fields=None):
+        params = {'fields': fields} if fields else None
+        return self._request('GET', self._space(project, workspace), (200,),
+                             params=params).json()
+
+    @trace.traced()
+    def space_new(self, project, workspace, attributes=None):
+        """Create project/workspace, with optional workspace attributes"""
+        body = {'namespace': project, 'name': workspace,
+                'attributes': attributes or dict(),
+                'authorizationDomain': []}
+        return self._request('POST', 'workspaces', (201,), json=body).json()
+
+    @trace.traced()
+    def space_clone(self, from_project, from_workspace, to_project,
+                    to_workspace, attributes=None):
+        """Create to_project/to_workspace as a copy of the method configs,
+        attributes and entities of from_project/from_workspace, with
+        attributes, if given, set over those copied. ACLs are not copied"""
+        body = {'namespace': to_project, 'name': to_workspace,
+                'attributes': attributes or dict(),
+                'authorizationDomain': []}
+        return self._request('POST', self._space(from_project, from_workspace)
+                             + '/clone', (201,), json=body).json()
+
+    @trace.traced()
+    def space_delete(self, project, workspace):
+        self._request('DELETE', self._space(project, workspace), (202,))
+
+    @trace.traced()
+    def space_get_acl(self, project, workspace):
+        """Map of each user or group with access to its access level"""
+        acl = self._request('GET', self._space(project, workspace) + '/acl',
+                            (200,)).json()['acl']
+        return dict((user, access['accessLevel'])
+                    for user, access in acl.items())
+
+    @trace.traced()
+    def space_set_acl(self, project, workspace, users, role):
+        """Grant role to users, returning any users FireCloud didn't know"""
+        acl = [{'email': user, 'accessLevel': role} for user in users]
+        r = self._request('PATCH', self._space(project, workspace) + '/acl',
+                          (200,), idempotent=True,
+                          params={'inviteUsersNotFound': 'false'}, json=acl)
+        not_found = [user['email'] for user in r.json().get('usersNotFound',
+                                                            [])]
+        if not_found:
+            logging.warning('Unable to assign %s role for unrecognized ' +
+                            'user(s): %s', role, ', '.join(not_found))
+        return not_found
+
+    # Attributes
+    @trace.traced(entity='entity')
+    def attr_set(self, project, workspace, attributes, etype=None,
+                 entity=None):
+        """Set a dict of attributes on the workspace, or on the given entity
+        if etype and entity are specified, in a single update"""
+        updates = [{'op': 'AddUpdateAttribute', 'attributeName': attr,
+                    'addUpdateAttribute': value}
+                   for attr, value in attributes.items()]
+        if etype and entity:
+            uri = '{}/entities/{}/{}'.format(self._space(project, workspace),
+                                             etype, entity)
+        else:
+            uri = self._space(project, workspace) + '/updateAttributes'
+        self._request('PATCH', uri, (200,), idempotent=True, json=updates)
+
+    # Method configurations
+    @trace.traced(entity='config')
+    def config_get(self, project, workspace, namespace, config):
+        uri = '{}/method_configs/{}/{}'.format(self._space(project, workspace),
+                                               namespace, config)
+        return self._request('GET', uri, (200,)).json()
+
+    @trace.traced()
+    def config_put(self, project, workspace, body):
+        """Create or overwrite the method config described by body"""
+        uri = '{}/method_configs/{}/{}'.format(self._space(project, workspace),
+                                               body['namespace'], body['name'])
+        self._request('PUT', uri, (200,), json=body)
+
+    @trace.traced()
+    def config_delete(self, project, workspace, namespace, config):
+        uri = '{}/method_configs/{}/{}'.format(self._space(project, workspace),
+                                               namespace, config)
+        self._request('DELETE', uri, (204,))
+
+    @trace.traced()
+    def config_list(self, project, workspace):
+        """Summaries of all method configs in project/workspace"""
+        return self._request('GET', self._space(project, workspace) +
+                             '/methodconfigs', (200,),
+                             params={'allRepos': 'true'}).json()
+
+    def config_copy(self, config, namespace, from_project, from_workspace,
+                    to_project, to_workspace):
+        """Copy namespace/config between workspaces"""
+        body = self.config_get(from_project, from_workspace, namespace, config)
+        self.config_put(to_project, to_workspace, body)
+        return body
+
+    # Entities
+    def _import_chunk(self, uri, data, retries):
+        """Upload one chunk of a loadfile, retrying on server and connection
+        errors. Imports are upserts, so repeating one is harmless"""
+        headers = {'Content-type': 'application/x-www-form-urlencoded'}
+        # 409: a concurrent chunk updated the same entity
+        self._request('POST', uri, (200,), idempotent=True, retries=retries,
+                      retry_codes=RETRY_CODES + (409,), headers=headers,
+                      data=urlencode({'entities': data}),
+                      params={'deleteEmptyValues': 'false'})
+
+    def entity_import(self, project, workspace, loadfile, chunk_size=500,
+                      model='firecloud', jobs=4, retries=IMPORT_RETRIES):
+        """Upload a loadfile, which may be gzipped, in chunks of about
+        chunk_size rows. Up to jobs chunks are uploaded at once and each is
+        retried on its own, so a failure only costs a chunk. Returns the
+        number of rows uploaded"""
+        endpoint = 'flexibleImportEntities' if model == 'flexible' \
+                   else 'importEntities'
+        uri = '{}/{}'.format(self._space(project, workspace), endpoint)
+        header = read_header(loadfile)
+        jobs = max(1, jobs)
+        rows = chunks = 0
+        errors = []
+
+        def collect(futures):
+            for future in futures:
+                if future.exception() is not None:
+                    errors.append(future.exception())
+
+        @trace.wrap
+        def upload(data):
+            with trace.span('entity_import', project + '/' + workspace,
+                            os.path.basename(loadfile)):
+                self._import_chunk(uri, data, retries)
+
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            running = set()
+            for chunk in read_chunks(loadfile, chunk_size):
+                # Bound the number of chunks read ahead of the uploads
+                if len(running) >= 2 * jobs:
+                    done, running = wait(running, return_when=FIRST_COMPLETED)
+                    collect(done)
+                data = '\n'.join([header] + chunk)
+                running.add(pool.submit(upload, data))
+                rows += len(chunk)
+                chunks += 1
+            collect(wait(running)[0])
+        if errors:
+            logging.error('%d of %d chunk(s) of %s failed to upload',
+                          len(errors), chunks, loadfile)
+            raise errors[0]
+        return rows
+
+    @trace.traced(workspace=('to_project', 'to_workspace'),
+                  entity='entities')
+    def entity_copy(self, from_project, from_workspace, to_project,
+                    to_workspace, etype, entities, link=False):
+        """Copy entities of type etype between workspaces. If link is True,
+        entities that already exist in the target are linked to rather than
+        reported as conflicts"""
+        body = {'sourceWorkspace': {'namespace': from_project,
+                                    'name': from_workspace},
+                'entityType': etype,
+                'entityNames': list(entities)}
+        r = self._request('POST', self._space(to_project, to_workspace) +
+                          '/entities/copy', (201,), json=body,
+                          params={'linkExistingEntities': str(link).lower()})
+        return r.json()
+
+    def entity_iter(self, project, workspace, etype, page_size=500,
+                    fields=None):
+        """Yield entities of type etype, one page at a time"""
+        uri = '{}/entityQuery/{}'.format(self._space(project, workspace),
+                                         etype)
+        params = {'pageSize': page_size, 'sortDirection': 'asc'}
+        if fields:
+            params['fields'] = fields
+        page = pages = 1
+        while page <= pages:
+            params['page'] = page
+            with trace.span('entity_query', project + '/' + workspace, etype):
+                body = self._request('GET', uri, (200,), params=params).json()
+            pages = body['resultMetadata']['filteredPageCount']
+            for entity in body['results']:
+                yield entity
+            page += 1
+
+    def sset_iter(self, project, workspace, page_size=500):
+        """Yield the names of the sample sets in project/workspace, one page
+        at a time"""
+        for sset in self.entity_iter(project, workspace, 'sample_set',
+                                     page_size, fields='name'):
+            yield sset['name']
+
+    def sset_list(self, project, workspace):
+        """Names of all sample sets in project/workspace"""
+        return list(self.sset_iter(project, workspace))
+
+    # Submissions
+    @trace.traced(entity='config')
+    def submission_new(self, project, workspace, namespace, config, entity,
+                       etype, use_callcache=True):
+        """Submit namespace/config on the given entity, returning the new
+        submission's ID"""
+        body = {'methodConfigurationNamespace': namespace,
+                'methodConfigurationName': config,
+                'entityType': etype,
+                'entityName': entity,
+                'useCallCache': use_callcache}
+        r = self._request('POST', self._space(project, workspace) +
+                          '/submissions', (201,), json=body)
+        return r.json()['submissionId']
+
+    @trace.traced()
+    def submission_list(self, project, workspace):
+        """Summaries of all submissions in project/workspace"""
+        return self._request('GET', self._space(project, workspace) +
+                             '/submissions', (200,)).json()
+
+    @trace.traced(entity='submission_id')
+    def submission_get(self, project, workspace, submission_id):
+        return self._request('GET', '{}/submissions/{}'.format(
+            self._space(project, workspace), submission_id), (200,)).json()
+
+_client = None
+_client_lock = threading.Lock()
+
+def get_client():
+    """The process-wide FireCloudClient, created on first use"""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = FireCloudClient()
+        return _client
+
+def set_client(client):
+    """Replace the process-wide FireCloudClient, e.g. with one pointed at a
+    local stand-in server"""
+    global _client
+    with _client_lock:
+        _client = client
@@ -18,85 +18,305 @@ import os
 import sys
 import logging
 import logging.config
-import subprocess
-import csv
 from argparse import ArgumentParser, FileType
 from getpass import getuser
-from pkg_resources import resource_filename
-from firecloud.fiss import main as call_fiss, fcconfig, space_set_acl, _confirm_prompt as ask
+from firecloud.fccore import __fcconfig as fcconfig
 from six.moves import input
+from concurrent.futures import ThreadPoolExecutor
+from gdan import trace, resource_path
+from gdan.provision import Provisioner, ProvisioningError, SUCCEEDED
+from gdan.journal import Journal, file_fingerprint
+from gdan.loadfiles import attribute_loadfile, open_loadfile
+from gdan.validate import cohort_loadfiles, validate_loadfiles
+from gdan.fcclient import get_client
+from gdan.configcache import ConfigCache, DEFAULT_MAX_AGE
+from gdan.workflow import parse_dot
+from gdan.scheduler import Scheduler, DEFAULT_MAX_SUBMISSIONS, \
+                          DEFAULT_POLL_INTERVAL
+from gdan.history import History
+from gdan.dashboard import StatusPoller
+from gdan.resources import cohort_sizes, sized_attributes
+from gdan.template import Template, template_name
+from gdan.index import MetadataIndex, DEFAULT_TTL, get_index, set_index
 
-def fissfc(*args):
-    return call_fiss(["fissfc", "-V"] + list(args))
+# What to do, without asking, with a workspace that already exists
+EXISTING_POLICIES = ('ask', 'rename', 'skip')
 
-def get_configs(workflow):
-    with open(workflow, 'r') as configs:
-        for line in configs:
-            config = line.strip()
-            if config.endswith(';') and '->' not in config:
-                yield config.rstrip(';').strip('"')
+class GdacError(Exception):
+    pass
 
-def create_workspace(project, workspace):
-    """Creates a new workspace or confirms use of an existing workspace.
-    Returns the workspace name and if the workspace is new"""
+def create_workspace(project, workspace, inputs=None, restart=False,
+                     existing='ask', template=None):
+    """Creates a new workspace, as a clone of template if given, or
+    confirms use of an existing workspace.
+    Returns the workspace name, if the workspace is new, and the Journal of
+    its provisioning from inputs. An existing workspace with an unfinished
+    journal is resumed without asking, unless restart is set. Otherwise
+    existing says whether to ask what to do with an existing workspace,
+    rename the new one to <workspace>__<user>, or skip it, in which case
+    the workspace name returned is None"""
     username = getuser()
+    client = get_client()
+    index = get_index()
+    journal = Journal(project, workspace, inputs)
+    if restart:
+        journal.clear()
     logging.info('Checking for %s/%s ...', project, workspace)
-    if fissfc('space_exists', '-p', project, '-w', workspace):
-        if not workspace.endswith(username) and \
+    if index.space_exists(project, workspace):
+        # Only needed here, and slow to import
+        from firecloud.fiss import _confirm_prompt as ask
+        if journal.unfinished():
+            logging.info('Resuming provisioning of %s/%s from %s', project,
+                         workspace, journal.path)
+            return workspace, 'space:new' in journal.succeeded(), journal
+        if existing == 'rename' and not workspace.endswith(username):
+            logging.info('%s/%s already exists, using %s instead', project,
+                         workspace, workspace + '__' + username)
+            workspace = workspace + '__' + username
+        elif existing != 'ask':
+            logging.warning('%s/%s already exists, skipping it', project,
+                            workspace)
+            return None, False, journal
+        elif not workspace.endswith(username) and \
            ask('{}/{}'.format(project, workspace) + ' already exists, use ' +
                '{} instead'.format(workspace + '__' + username),
                prompt='? [y/N]: '):
             workspace = workspace + '__' + username
         elif ask('Initialize analyses run in existing workspace ' +
                  '{}/{}'.format(project, workspace), prompt='? [y/N]: '):
-            return workspace, False
+            return workspace, False, journal
         else:
             workspace = input(workspace + ' already exists in ' + project +
                               '. Please create a unique workspace name: ')
-        return create_workspace(project, workspace)
+        return create_workspace(project, workspace, inputs, restart,
+                                existing, template)
     
-    # Create new workspace
-    logging.info('Creating workspace %s/%s', project, workspace)
-    fissfc('space_new', '-p', project, '-w', workspace)
+    # Create new workspace, forgetting any journal of one since deleted
+    journal.clear()
+    if template is None:
+        logging.info('Creating workspace %s/%s', project, workspace)
+        client.space_new(project, workspace)
+    else:
+        template.clone(project, workspace)
+        journal.record('space:clone', SUCCEEDED)
+    journal.record('space:new', SUCCEEDED)
+    index.record(project, workspace)
     
     # Workspace name may have been modified, so return the final version
-    return workspace, True
+    return workspace, True, journal
 
-def set_acl(role, args):
+def set_acl(role, args, workspace):
     attr = getattr(args, role.lower() + 's')
     if attr:
-        args.users = attr
-        args.role = role.upper()
         logging.info('Adding %s as workspace %s(s)', ', '.join(attr), role)
-        space_set_acl(args)
+        return get_client().space_set_acl(args.project, workspace, attr,
+                                          role.upper())
 
 def get_ssets(sset_loadfile):
-    with open(sset_loadfile) as ssets:
-        ssets.next()
+    with open_loadfile(sset_loadfile) as ssets:
+        ssets.readline()
         return sorted(set(line.strip().split("\t")[0] for line in ssets))
 
-def load_attributes(attributes):
-    attr_reader = csv.DictReader(attributes, dialect='excel-tab')
-    attr_dict = dict()
-    for row in attr_reader:
-        attr_dict[row[attr_reader.fieldnames[0]]] = \
-                    {field: row[field] for field in attr_reader.fieldnames[1:]}
-    attributes.close()
-    return attr_dict
+def get_loadfiles(cohort):
+    """Paths to the loadfiles of cohort in the working directory, by type,
+    falling back to gzipped ones"""
+    loadfiles = dict(zip(['participants', 'samples', 'sample_sets'],
+                         [cohort + etype + '.loadfile.txt' for etype in 
+                          ('.Participants', '.Samples', '.SampleSet')]))
+    for etype, loadfile in loadfiles.items():
+        if not os.path.isfile(loadfile) and os.path.isfile(loadfile + '.gz'):
+            loadfiles[etype] = loadfile + '.gz'
+    return loadfiles
+
+def read_manifest(manifest):
+    """(cohort, workspace) pairs from a manifest of one cohort per line,
+    optionally followed by its workspace name. Blank lines and lines
+    starting with # are ignored"""
+    cohorts = []
+    with manifest:
+        for line in manifest:
+            fields = line.split('#', 1)[0].split()
+            if fields:
+                cohorts.append((fields[0], fields[1] if len(fields) > 1
+                                           else None))
+    return cohorts
 
-def main():
-    workflow = resource_filename(__name__,
-                                 os.path.join('defaults', 'stddata.dot'))
+def provision(args, cohort, workspace, configs, existing='ask',
+              template=None):
+    """Create the workspace for cohort, or use an existing one, and
+    provision it, copying method configs from the ConfigCache configs, or
+    cloning a new workspace from template if given.
+    Returns the workspace name, whether it is new, the workflow to run and
+    the message to log once it is done, or None if the workspace was
+    skipped. Raises GdacError if provisioning failed"""
+    loadfiles = get_loadfiles(cohort)
+    inputs = {'cohort': cohort, 'methods': args.methods,
+              'namespace': args.namespace, 'entities': args.entities,
+              'owners': args.owners, 'readers': args.readers,
+              'writers': args.writers,
+              'attributes': file_fingerprint(args.attributes.name),
+              'static_resources': args.static_resources,
+              'loadfiles': [file_fingerprint(lf) for lf in
+                            sorted(loadfiles.values()) if os.path.isfile(lf)]}
+    client = get_client()
+    with trace.phase('workspace'):
+        workspace, new, journal = create_workspace(args.project, workspace,
+                                                   inputs, args.restart,
+                                                   existing, template)
+    if workspace is None:
+        return None
+    # A clone already has its method configs and standard attributes
+    cloned = new and 'space:clone' in journal.succeeded()
+    provisioner = Provisioner(args.jobs, journal)
+    attr_loadfile = None
+    done_msg = ''
+    if new:
+        logging.info('Initializing stddata run in %s.', workspace)
+        workflow = resource_path('defaults', 'stddata.dot')
+        for loadfile in loadfiles.values():
+            if not os.path.isfile(loadfile):
+                logging.error("Loadfile not found: %s. Exiting.", loadfile)
+                raise GdacError('Loadfile not found: ' + loadfile)
+        
+        ssets = get_ssets(loadfiles['sample_sets'])
+        
+        done_msg = 're-run by populating the --entities option with any ' + \
+                   'of the following Sample Sets:\n\t' + '\n\t'.join(ssets)
+        # Add ACLs
+        for role in ('owner', 'reader', 'writer'):
+            provisioner.add('acl:' + role, set_acl, (role, args, workspace),
+                            description='Adding workspace {}s'.format(role))
+        
+        # Set workspace annotations
+        if not cloned:
+            provisioner.add('attr:package', client.attr_set,
+                            (args.project, workspace, {'package': 'true'}),
+                            description='Setting package to "true"')
+        
+        # Load Entities; each type references the one before it
+        participants = provisioner.add('import:participants',
+                                       client.entity_import,
+                                       (args.project, workspace,
+                                        loadfiles['participants']),
+                                       description='Loading Participants')
+        samples = provisioner.add('import:samples', client.entity_import,
+                                  (args.project, workspace,
+                                   loadfiles['samples']),
+                                  requires=[participants],
+                                  description='Loading Samples')
+        provisioner.add('import:sample_sets', client.entity_import,
+                        (args.project, workspace, loadfiles['sample_sets']),
+                        requires=[samples], description='Loading Sample Sets')
+        
+    elif args.entities:
+        logging.info('Initializing analyses run.')
+        workflow = resource_path('defaults', 'Analyses.dot')
+        # load custom sset attributes
+        overrides = None
+        if not args.static_resources:
+            sset_loadfile = loadfiles['sample_sets']
+            sizes = cohort_sizes([sset_loadfile] if os.path.isfile(
+                                 sset_loadfile) else [])
+            overrides = sized_attributes(History(), args.entities, sizes)
+        attr_loadfile = attribute_loadfile(args.attributes, args.entities,
+                                           overrides)
+        if attr_loadfile is not None:
+            provisioner.add('attr:sample_sets', client.entity_import,
+                            (args.project, workspace, attr_loadfile),
+                            description='Adding attributes to Sample Sets')
+    else:
+        logging.error("To use an existing workspace, please specify the " +
+                      "Sample Set(s) to run analyses on via the '--entities'" +
+                      " option")
+        raise GdacError('No Sample Sets given for existing workspace ' +
+                        workspace)
     
-    analyses_wf = resource_filename(__name__,
-                                    os.path.join('defaults', 'Analyses.dot'))
+    # Copy method configs
+    workflow = parse_dot(workflow)
+    if not cloned:
+        logging.info('Copying method configs from %s to %s/%s', args.methods,
+                     args.project, workspace)
+        for config in workflow.nodes:
+            provisioner.add('config:' + config, configs.copy,
+                            (config, args.namespace, args.project, workspace),
+                            description='Copying ' + config)
     
+    try:
+        provisioner.execute()
+    except ProvisioningError as e:
+        raise GdacError(str(e))
+    finally:
+        if attr_loadfile is not None:
+            os.remove(attr_loadfile)
+    return workspace, new, workflow, done_msg
+
+def supervise(args, workspace, workflow, history=None):
+    """Run workflow in workspace until it is done, returning the Scheduler's
+    summary of its tasks"""
+    recover = workspace + '.jsonl'
+    logging.info('Initiating run. Recovery file is at:\n\t' + recover +
+                 '\nIf run fails due to FireCloud issues, it can be ' +
+                 'continued by running:\n\t' +
+                 'gdan_recover ' + recover)
+    dashboard = None
+    if args.dashboard:
+        dashboard = StatusPoller(args.project, workspace, os.getcwd(),
+                                 jobs=args.jobs)
+        dashboard.start(args.poll_interval)
+
+    ssets = args.entities or get_client().sset_list(args.project, workspace)
+    scheduler = Scheduler(args.project, workspace, args.namespace, workflow,
+                          ssets, args.max_submissions, args.poll_interval,
+                          recovery_file=recover, jobs=args.jobs,
+                          history=history)
+    try:
+        scheduler.run()
+    finally:
+        if dashboard is not None:
+            dashboard.stop()
+    return scheduler.summary()
+
+def run_cohort(args, cohort, workspace, configs, existing, history,
+               template=None):
+    """Provision and run one cohort of a batch, returning its outcome"""
+    result = {'cohort': cohort, 'workspace': workspace, 'summary': None}
+    try:
+        run = provision(args, cohort, workspace, configs, existing, template)
+        if run is None:
+            result['status'] = 'skipped'
+            return result
+        result['workspace'], _, workflow, _ = run
+        result['summary'] = supervise(args, result['workspace'], workflow,
+                                      history)
+        result['status'] = 'failed tasks' if result['summary']['Failed'] \
+                           else 'succeeded'
+    except Exception as e:
+        logging.exception('%s failed', cohort)
+        result['status'] = 'failed: {}'.format(e)
+    return result
+
+def batch_report(results):
+    """Table of the outcome of each cohort of a batch"""
+    columns = ('Succeeded', 'Failed', 'Not Run')
+    lines = ['{:<16}{:<32}{:>10}{:>8}{:>9}  {}'.format(
+        'cohort', 'workspace', 'succeeded', 'failed', 'not run', 'status')]
+    for result in results:
+        counts = [result['summary'][col] if result['summary'] else '-'
+                  for col in columns]
+        lines.append('{:<16}{:<32}{:>10}{:>8}{:>9}  {}'.format(
+            result['cohort'], result['workspace'], counts[0], counts[1],
+            counts[2], result['status']))
+    return '\n'.join(lines)
+
+def main(argv=None):
     fail_msg = "Failed, see log output for details."
     
     parser = ArgumentParser(description="""
     Create given project/workspace. Loads default attributes and ACLs.
     Loads methods from specified DOT file. Loads entities from loadfiles
-    in the working directory. Adds custom attributes""")
+    in the working directory. Adds custom attributes. Given several cohorts,
+    or a manifest of them, provisions and runs a workspace for each at
+    once""")
     parser.add_argument('-m', '--methods',
                         default='broad-firecloud-gdac/Production',
                         help='Production workspace containing method configs' +
@@ -120,24 +340,96 @@ def main():
         proj_kwargs['required'] = True
     parser.add_argument('-p', '--project', **proj_kwargs)
     parser.add_argument('-s', '--workspace', help='Workspace for run. ' +
-                        'Defaults to "awg_COHORT"')
-    parser.add_argument('cohort', help='Name of the tumor cohort ' +
+                        'Defaults to "awg_COHORT". Only for a single cohort')
+    parser.add_argument('cohort', nargs='*',
+                        help='Name of the tumor cohort ' +
                         '(e.g. TCGA-LUAD, TCGA-STES, CPTAC3-UCEC, etc.). ' +
                         'This should match the root names of your loadfiles')
+    parser.add_argument('--manifest', type=FileType('r'),
+                        help='File of further cohorts, one per line, each ' +
+                             'optionally followed by its workspace name.')
+    parser.add_argument('--existing', choices=EXISTING_POLICIES,
+                        help='What to do with a workspace that already ' +
+                             'exists and has no unfinished run to resume: ' +
+                             'ask, use WORKSPACE__USER instead, or skip the ' +
+                             'cohort (default: ask for a single cohort, ' +
+                             'skip for several).')
+    parser.add_argument('--batch-jobs', type=int, default=4,
+                        help='Maximum number of cohorts provisioned and run ' +
+                             'at once (default: %(default)s).')
     parser.add_argument('-e', '--entities', metavar='ENTITY', nargs='*',
                         help='Specify which entities to run analyses ' +
                         'workflow on. Only set this for an existing ' +
                         'workspace on which the stddata workflow has ' +
                         'completed')
     parser.add_argument('-a', '--attributes', type=FileType('r'),
-                        default=resource_filename(__name__,
-                                                  os.path.join('defaults',
-                                                               'sample_set_loadfile.tsv')),
+                        default=resource_path('defaults',
+                                              'sample_set_loadfile.tsv'),
                         help='File of sample set attributes to add (default: %(default)s).')
-    parser.add_argument('-d', '--dashboard', help='Generate dashboard for ' +
-                        'run tracking', action='store_true')
+    parser.add_argument('--static-resources', action='store_true',
+                        help='Use the memory attributes in the attributes ' +
+                             'file as is, rather than sizing them from the ' +
+                             'peak memory recorded with gdan resources ' +
+                             'record. Sizing has no effect until peaks are ' +
+                             'recorded.')
+    parser.add_argument('-d', '--dashboard', help='Keep a static HTML and ' +
+                        'JSON dashboard of the run, named after the ' +
+                        'workspace, in the working directory',
+                        action='store_true')
     parser.add_argument('-l', '--logfile', help='Write logging output to file')
-    args = parser.parse_args()
+    parser.add_argument('-j', '--jobs', type=int, default=8,
+                        help='Maximum number of concurrent FireCloud calls ' +
+                             'while provisioning (default: %(default)s).')
+    parser.add_argument('-c', '--max-submissions', type=int,
+                        default=DEFAULT_MAX_SUBMISSIONS,
+                        help='Maximum number of submissions to run at once ' +
+                             '(default: %(default)s).')
+    parser.add_argument('--poll-interval', type=int,
+                        default=DEFAULT_POLL_INTERVAL,
+                        help='Seconds between checks on running submissions ' +
+                             '(default: %(default)s).')
+    parser.add_argument('--refresh-configs', action='store_true',
+                        help='Read every method config from the methods ' +
+                             'workspace, rather than using those cached ' +
+                             'locally.')
+    parser.add_argument('--refresh-index', action='store_true',
+                        help='Check workspace names with FireCloud, rather ' +
+                             'than trusting the local index of workspaces ' +
+                             'for up to {} minutes.'.format(DEFAULT_TTL // 60))
+    parser.add_argument('--template', metavar='WORKSPACE', nargs='?',
+                        const='',
+                        help='Create new workspaces as clones of a template ' +
+                             'workspace in the same project, holding the ' +
+                             'stddata method configs and standard ' +
+                             'attributes, which is built or refreshed first ' +
+                             'if the workflow or method configs changed ' +
+                             '(default WORKSPACE: stddata_template).')
+    parser.add_argument('--skip-validation', action='store_true',
+                        help="Don't check the loadfiles for broken " +
+                             'references and malformed rows before creating ' +
+                             'the workspace.')
+    parser.add_argument('--restart', action='store_true',
+                        help='Start over rather than resume an earlier, ' +
+                             'unfinished run with the same inputs.')
+    parser.add_argument('--trace', metavar='FILE',
+                        help='Record every FireCloud call to FILE, as JSON ' +
+                             'lines, and log a summary of call latencies ' +
+                             'at exit.')
+    args = parser.parse_args(argv)
+    
+    cohorts = [(cohort, None) for cohort in args.cohort]
+    if args.manifest is not None:
+        cohorts.extend(read_manifest(args.manifest))
+    if not cohorts:
+        parser.error('a cohort or a --manifest of cohorts is required')
+    batch = len(cohorts) > 1
+    if batch and (args.workspace or args.entities):
+        parser.error('--workspace and --entities only apply to a single ' +
+                     'cohort')
+    existing = args.existing or ('skip' if batch else 'ask')
+    if batch and existing == 'ask':
+        parser.error("can't ask about existing workspaces of several " +
+                     'cohorts, please choose --existing rename or skip')
     
     # fiss.supervisor sets the root logger rather than using its own, the below
     # method overrides those settings
@@ -175,109 +467,82 @@ def main():
         log_cfg['root']['handlers'].append('file')
         
     logging.config.dictConfig(log_cfg)
+    if args.trace:
+        trace.enable(args.trace)
     
+    if args.refresh_index:
+        set_index(MetadataIndex(ttl=0))
     fromproject, fromspace = args.methods.split('/')
-    if args.workspace is None:
-        args.workspace = 'awg_' + args.cohort
+    cohorts = [(cohort, workspace or args.workspace or 'awg_' + cohort)
+               for cohort, workspace in cohorts]
     
-    args.workspace, new = create_workspace(args.project, args.workspace)
-    done_msg = ''
-    if new:
-        logging.info('Initializing stddata run.')
-        # Confirm loadfiles exist before going any further
-        loadfiles = dict(zip(['participants', 'samples', 'sample_sets'],
-                             [args.cohort + etype + '.loadfile.txt' for etype in 
-                              ('.Participants', '.Samples', '.SampleSet')]))
-        
-        for loadfile in loadfiles.values():
-            if not os.path.isfile(loadfile):
-                logging.error("Loadfile not found: %s. Exiting.", loadfile)
-                sys.exit(fail_msg)
-        
-        ssets = get_ssets(loadfiles['sample_sets'])
-        
-        done_msg = 're-run by populating the --entities option with any ' + \
-                   'of the following Sample Sets:\n\t' + '\n\t'.join(ssets)
-        # Add ACLs
-        set_acl('owner', args)
-        set_acl('reader', args)
-        set_acl('writer', args)
-        
-        # Set args.workspace annotations
-        logging.info('Setting package to "true"')
-        fissfc('-y', 'attr_set', '-p', args.project, '-w', args.workspace, '-a', 'package',
-               '-v', 'true')
-        
-        # Load Entities
-        logging.info('Loading Participants')
-        fissfc('entity_import', '-p', args.project, '-w', args.workspace,
-               '-f', loadfiles['participants'])
-        
-        logging.info('Loading Samples')
-        fissfc('entity_import', '-p', args.project, '-w', args.workspace,
-               '-f', loadfiles['samples'])
-        
-        logging.info('Loading Sample Sets')
-        fissfc('entity_import', '-p', args.project, '-w', args.workspace,
-               '-f', loadfiles['sample_sets'])
-        
-    elif args.entities:
-        logging.info('Initializing analyses run.')
-        workflow = analyses_wf
-        # load custom sset attributes
-        logging.info("Adding attributes to Sample Sets")
-        attributes = load_attributes(args.attributes)
-        for sset in args.entities:
-            if sset in attributes:
-                for attr, value in attributes[sset].items():
-                    fissfc('-y', "attr_set", "-t", "sample_set", "-e", sset,
-                           "-a", attr, "-v", value, "-w", args.workspace,
-                           "-p", args.project)
-    else:
-        logging.error("To use an existing workspace, please specify the " +
-                      "Sample Set(s) to run analyses on via the '--entities'" +
-                      " option")
-        sys.exit(fail_msg)
+    # Confirm loadfiles exist and are sound before going any further
+    if not args.entities:
+        paths = []
+        for cohort, _ in cohorts:
+            for loadfile in get_loadfiles(cohort).values():
+                if not os.path.isfile(loadfile):
+                    logging.error("Loadfile not found: %s. Exiting.",
+                                  loadfile)
+                    sys.exit(fail_msg)
+                paths.append(loadfile)
+        if not args.skip_validation and \
+           validate_loadfiles(cohort_loadfiles(paths)):
+            sys.exit(fail_msg)
     
-    # Copy method configs
-    logging.info('Copying method configs from %s to %s/%s', args.methods,
-                 args.project, args.workspace)
+    # Every workspace copies its method configs from the same reads
+    configs = ConfigCache(fromproject, fromspace,
+                          max_age=0 if args.refresh_configs else
+                                  DEFAULT_MAX_AGE)
+    # Every new workspace is cloned from the same template
+    template = None
+    if args.template is not None and not args.entities:
+        workflow = resource_path('defaults', 'stddata.dot')
+        template = Template(args.project, args.template or
+                            template_name(workflow), parse_dot(workflow),
+                            configs, args.namespace, {'package': 'true'},
+                            args.jobs)
+        try:
+            with trace.phase('workspace'):
+                template.ensure()
+        except Exception:
+            logging.exception('Template %s/%s could not be prepared',
+                              template.project, template.workspace)
+            sys.exit(fail_msg)
+    if batch:
+        logging.info('Provisioning workspaces for %d cohorts, %d at a time',
+                     len(cohorts), args.batch_jobs)
+        history = History()
+        with ThreadPoolExecutor(max_workers=max(1, args.batch_jobs)) as pool:
+            futures = [pool.submit(trace.wrap(run_cohort), args, cohort,
+                                   workspace, configs, existing, history,
+                                   template)
+                       for cohort, workspace in cohorts]
+            results = [future.result() for future in futures]
+        logging.info('Batch of %d cohorts:\n%s', len(results),
+                     batch_report(results))
+        if any(result['status'].startswith('failed:') for result in results):
+            sys.exit(fail_msg)
+        return
     
-    for config in get_configs(workflow):
-        fissfc('config_copy', '-c', config, '-n', args.namespace,
-               '-p', fromproject, '-s', fromspace, '-P', args.project,
-               '-S', args.workspace)
+    cohort, workspace = cohorts[0]
+    try:
+        run = provision(args, cohort, workspace, configs, existing,
+                        template)
+    except GdacError:
+        sys.exit(fail_msg)
+    if run is None:
+        return
+    workspace, new, workflow, done_msg = run
     
     # Initiate supervisor mode
-    recover = args.workspace + '.json'
-    logging.info('Initiating run. Recovery file is at:\n\t' + recover +
-                 '\nIf run fails due to FireCloud issues, it can be ' +
-                 'continued by running:\n\t' +
-                 'fissfc supervise_recover ' + recover)
-    if args.dashboard:
-        logging.info('Initiating dashboard generation cron job')
-        try:
-            cron_cmd = ['gdac_cron', 'awg', 'add', '-c',
-                        'gdac_dashboard -D {} {}'.format(os.getcwd(), args.workspace)]
-            logging.info(subprocess.check_output(cron_cmd, stderr=subprocess.STDOUT))
-        except subprocess.CalledProcessError as cpe:
-            cron_cmd[-1] = '"{}"'.format(cron_cmd[-1])
-            if cpe.output:
-                logging.warning(cpe.output)
-            logging.warning('Failed to add Dashboard cron job. Please run\n' +
-                            '\t{}\n'.format(' '.join(cron_cmd)) +
-                            'from a CGA server')
-    
     try:
-        supervise_args = ['-y', 'supervise', '-p', args.project, '-w', \
-                          args.workspace, '-n', args.namespace]
-        if args.entities:
-            supervise_args += ['-s'] + args.entities
-        supervise_args += ['-j', recover, workflow]
-        fissfc(*supervise_args)
+        if supervise(args, workspace, workflow)['Failed']:
+            logging.warning('Some workflows failed, see log output for ' +
+                            'details.')
     except:
         logging.exception('Supervisor failed, please check nature of failure' +
-                          ' and run\n\tfissfc supervise_recover ' + recover +
+                          ' and run\n\tgdan_recover ' + workspace + '.jsonl' +
                           '\nif appropriate.')
         if new:
             logging.info('Once successful, %s\n to begin analyses.', done_msg)
@@ -0,0 +1,65 @@
+# encoding: utf-8
+'''
+Adaptive limit on the number of FireCloud calls in flight.
+
+However many threads the entry points run, every call goes through the
+client's Governor, which lets at most `limit` of them proceed at once. The
+limit follows AIMD, as in TCP congestion control: each call that succeeds
+raises it by 1/limit, so it grows by about one per round of calls, and a
+call that is throttled (429) or finds the service unavailable (503) cuts it
+in half. Other failures, such as 5xx errors and connection errors, say
+nothing of the load FireCloud will accept, so never cut the limit; the
+client retries them where that is safe. Cuts are at most one per cooldown, so a burst of
+throttled calls that were all in flight together only counts once. The limit
+thus settles just under the rate FireCloud will accept, without tuning.
+'''
+
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+class Governor(object):
+    """AIMD concurrency limit, shared by the threads making calls"""
+    def __init__(self, initial=8, minimum=1, maximum=16, decrease=0.5,
+                 cooldown=1.0):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.decrease = decrease
+        self.cooldown = cooldown
+        self.limit = float(max(minimum, min(initial, maximum)))
+        self.in_flight = 0
+        self.throttled = 0
+        self._last_cut = 0.0
+        self._cond = threading.Condition()
+
+    @contextmanager
+    def slot(self):
+        """Wait for room under the limit, then hold it for the enclosed call.
+        The block should set the yielded dict's 'throttled' entry when the
+        call was throttled"""
+        with self._cond:
+            while self.in_flight >= int(self.limit):
+                self._cond.wait()
+            self.in_flight += 1
+        outcome = {'throttled': False}
+        try:
+            yield outcome
+        finally:
+            self._release(outcome['throttled'])
+
+    def _release(self, throttled):
+        with self._cond:
+            self.in_flight -= 1
+            if throttled:
+                self.throttled += 1
+                now = time.time()
+                if now - self._last_cut >= self.cooldown:
+                    self._last_cut = now
+                    self.limit = max(self.minimum,
+                                     self.limit * self.decrease)
+                    logging.debug('Throttled, allowing %d call(s) at once',
+                                  int(self.limit))
+            else:
+                self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+            self._cond.notify_all()
@@ -0,0 +1,353 @@
+# encoding: utf-8
+'''
+Download the outputs of an analyses run to a local directory.
+
+The files each node of a workflow produces are named by the outputs of its
+method config: an output bound to this.<attribute> sets that attribute of
+the sample set the node ran on to the bucket URL of the file, or a list of
+them. A harvest reads those configs and the sample sets' output attributes,
+then downloads every file concurrently to <directory>/<sset>/<node>/.
+
+Each file downloaded is recorded in <directory>/MANIFEST.jsonl, one JSON
+line per file, with its URL, size and checksum, once it is complete. A
+harvest that is interrupted, or run again after more of the workflow has
+finished, downloads only the files the manifest does not hold or whose
+object changed since; the rest are skipped.
+
+    gdan harvest -p broad-firecloud-gdac -o ~/harvest analyses__2018_08_24
+
+Files are read from Google Cloud Storage, or with --bucket-root from a
+local directory holding a copy of each bucket, gs://bucket/path being
+<bucket-root>/bucket/path.
+'''
+
+import os
+import sys
+import json
+import base64
+import shutil
+import hashlib
+import logging
+import binascii
+import threading
+import time
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+from concurrent.futures import ThreadPoolExecutor
+from io import open
+from six import string_types, text_type
+
+from gdan import trace, resource_path
+from gdan.fcclient import get_client
+from gdan.workflow import parse_dot
+
+MANIFEST = 'MANIFEST.jsonl'
+
+def split_url(url):
+    """(bucket, object name) of a gs:// URL"""
+    if not url.startswith('gs://') or '/' not in url[5:]:
+        raise ValueError('Not an object URL: ' + url)
+    return tuple(url[5:].split('/', 1))
+
+def md5sum(path):
+    """Hex MD5 digest of the file at path"""
+    digest = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+class LocalStore(object):
+    """Stand-in for Cloud Storage, with the objects of each bucket as files
+    under root/<bucket>"""
+    def __init__(self, root):
+        self.root = root
+
+    def _path(self, url):
+        return os.path.join(self.root, *split_url(url))
+
+    def stat(self, url):
+        """(size, checksum) of the object at url. The checksum is the hex
+        MD5 digest of the object"""
+        path = self._path(url)
+        return os.path.getsize(path), md5sum(path)
+
+    def download(self, url, path):
+        shutil.copyfile(self._path(url), path)
+
+class BucketStore(object):
+    """Objects in Google Cloud Storage, read with application default
+    credentials"""
+    def __init__(self, project=None):
+        self.project = project
+        self._local = threading.local()
+
+    @property
+    def client(self):
+        # Clients are not shared between threads
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            from google.cloud import storage
+            client = self._local.client = storage.Client(self.project)
+        return client
+
+    def _blob(self, url):
+        bucket, name = split_url(url)
+        blob = self.client.bucket(bucket).get_blob(name)
+        if blob is None:
+            raise IOError('No such object: ' + url)
+        return blob
+
+    def stat(self, url):
+        """(size, checksum) of the object at url. The checksum is the hex
+        MD5 digest of the object, or for composite objects, which have
+        none, crc32c: and its CRC32C"""
+        blob = self._blob(url)
+        if blob.md5_hash:
+            checksum = binascii.hexlify(base64.b64decode(blob.md5_hash))
+            return blob.size, checksum.decode('ascii')
+        return blob.size, 'crc32c:' + blob.crc32c
+
+    def download(self, url, path):
+        self._blob(url).download_to_filename(path)
+
+def node_outputs(project, workspace, namespace, nodes, jobs=8):
+    """The sample set attributes set by the method config of each node in
+    project/workspace, as {node: [attribute]}"""
+    client = get_client()
+
+    def outputs(node):
+        config = client.config_get(project, workspace, namespace, node)
+        return sorted(set(value[5:] for value in
+                          config.get('outputs', {}).values()
+                          if isinstance(value, string_types) and
+                          value.startswith('this.')))
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        return dict(zip(nodes, pool.map(trace.wrap(outputs), nodes)))
+
+def _urls(value):
+    """The object URLs in an attribute value, a URL or a list of them"""
+    if isinstance(value, dict):
+        value = value.get('items', [])
+    if isinstance(value, string_types):
+        value = [value]
+    return [url for url in value if isinstance(url, string_types) and
+            url.startswith('gs://')]
+
+class Manifest(object):
+    """Manifest of the files harvested into directory. Safe to share
+    between threads"""
+    def __init__(self, directory):
+        self.path = os.path.join(directory, MANIFEST)
+        self._lock = threading.Lock()
+        self._checked = False
+
+    def load(self):
+        """The latest entry of each file, by path relative to the directory"""
+        entries = dict()
+        if not os.path.isfile(self.path):
+            return entries
+        with open(self.path) as mf:
+            for line in mf:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # A partial last line from a crash mid-write
+                    logging.warning('Ignoring corrupt manifest entry in %s',
+                                    self.path)
+                    continue
+                entries[entry['path']] = entry
+        return entries
+
+    def record(self, entry):
+        with self._lock:
+            line = text_type(json.dumps(entry, sort_keys=True)) + u'\n'
+            if not self._checked:
+                # End a partial last line, rather than add to it
+                self._checked = True
+                if os.path.isfile(self.path):
+                    with open(self.path, 'rb') as mf:
+                        mf.seek(0, os.SEEK_END)
+                        if mf.tell():
+                            mf.seek(-1, os.SEEK_END)
+                            if mf.read(1) != b'\n':
+                                line = u'\n' + line
+            with open(self.path, 'a') as mf:
+                mf.write(line)
+
+class Harvester(object):
+    """Downloads the outputs of workflow nodes on the sample sets of
+    project/workspace into directory, from store"""
+    def __init__(self, project, workspace, directory, store,
+                 namespace='broadgdac', jobs=8, verify=False):
+        self.project = project
+        self.workspace = workspace
+        self.directory = directory
+        self.store = store
+        self.namespace = namespace
+        self.jobs = max(1, jobs)
+        self.verify = verify
+        self.manifest = Manifest(directory)
+
+    def plan(self, nodes, ssets=None):
+        """The files to harvest from nodes, on ssets if given or else every
+        sample set, as dicts of their sset, node, attribute, url and path
+        relative to the directory. Each path is planned once, and each URL
+        once for a node on a sample set, so no two downloads share a
+        file"""
+        outputs = node_outputs(self.project, self.workspace, self.namespace,
+                               nodes, self.jobs)
+        attributes = sorted(set(attr for attrs in outputs.values()
+                                for attr in attrs))
+        if not attributes:
+            return []
+        items = []
+        paths = set()
+        for entity in get_client().entity_iter(
+                self.project, self.workspace, 'sample_set',
+                fields=','.join(attributes)):
+            sset = entity['name']
+            if ssets is not None and sset not in ssets:
+                continue
+            for node in nodes:
+                urls = set()
+                for attr in outputs[node]:
+                    for url in _urls(entity['attributes'].get(attr)):
+                        if url in urls:
+                            # Set by more than one output
+                            continue
+                        urls.add(url)
+                        name = url.rsplit('/', 1)[1]
+                        path = os.path.join(sset, node, name)
+                        if path in paths:
+                            # Two outputs by the same name
+                            path = os.path.join(sset, node, attr + '.' + name)
+                        copies = 1
+                        while path in paths:
+                            # Or files by the same name in one output
+                            copies += 1
+                            path = os.path.join(sset, node, '{}.{}.{}'.format(
+                                attr, copies, name))
+                        paths.add(path)
+                        items.append({'sset': sset, 'node': node,
+                                      'attribute': attr, 'url': url,
+                                      'path': path})
+        return items
+
+    def _fetch(self, item, known):
+        """Download the file of item unless the manifest entry known for it
+        shows it is already here. Returns whether it was downloaded"""
+        size, checksum = self.store.stat(item['url'])
+        local = os.path.join(self.directory, item['path'])
+        if known is not None and known['url'] == item['url'] and \
+           known['checksum'] == checksum and known['size'] == size and \
+           os.path.isfile(local) and os.path.getsize(local) == size and \
+           (not self.verify or md5sum(local) == known['md5']):
+            return False
+        directory = os.path.dirname(local)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # Made by another thread meanwhile
+                if not os.path.isdir(directory):
+                    raise
+        partial = local + '.part'
+        self.store.download(item['url'], partial)
+        md5 = md5sum(partial)
+        if len(checksum) == 32 and md5 != checksum:
+            os.remove(partial)
+            raise IOError('Checksum mismatch for ' + item['url'])
+        os.rename(partial, local)
+        self.manifest.record(dict(item, size=size, checksum=checksum,
+                                  md5=md5, time=time.time()))
+        return True
+
+    def harvest(self, items):
+        """Download items, as plan() returns them, skipping those already
+        harvested. Returns the number downloaded, skipped and failed"""
+        known = self.manifest.load()
+        counts = {'downloaded': 0, 'skipped': 0, 'failed': 0}
+
+        def fetch(item):
+            try:
+                return self._fetch(item, known.get(item['path']))
+            except Exception as e:
+                logging.error('%s: %s not harvested (%s)', item['sset'],
+                              item['url'], e)
+                return None
+        with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            for item, fetched in zip(items, pool.map(trace.wrap(fetch),
+                                                     items)):
+                if fetched is None:
+                    counts['failed'] += 1
+                elif fetched:
+                    logging.info('%s: %s', item['sset'], item['path'])
+                    counts['downloaded'] += 1
+                else:
+                    counts['skipped'] += 1
+        return counts
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s::%(levelname)s  %(message)s',
+                        datefmt='%Y-%m-%d %I:%M:%S %p')
+    parser = ArgumentParser(formatter_class=ArgumentDefaultsHelpFormatter,
+                            description='''
+    Download the output files of the workflow's nodes on the sample sets of
+    a workspace, skipping those a previous harvest already downloaded.''')
+    parser.add_argument('workspace', help='Workspace to harvest.')
+    parser.add_argument('-p', '--project', default='broad-firecloud-gdac',
+                        help='Project the workspace is in.')
+    parser.add_argument('-o', '--output', default='.',
+                        help='Directory to download the outputs to.')
+    parser.add_argument('-w', '--workflow',
+                        default=resource_path('defaults', 'Analyses.dot'),
+                        help='DOT format file with the workflow run.')
+    parser.add_argument('-N', '--nodes', metavar='NODE', nargs='+',
+                        help='''Only harvest the outputs of NODE(s), rather
+                        than of every node in the workflow.''')
+    parser.add_argument('-s', '--ssets', metavar='SSET', nargs='+',
+                        help='Only harvest the outputs on SSET(s).')
+    parser.add_argument('-n', '--namespace', default='broadgdac',
+                        help='Method Config namespace.')
+    parser.add_argument('-j', '--jobs', type=int, default=8,
+                        help='Maximum number of files downloaded at once.')
+    parser.add_argument('--verify', action='store_true',
+                        help='''Check the checksum of files already harvested
+                        before skipping them, rather than only their
+                        size.''')
+    parser.add_argument('--bucket-root', metavar='DIR',
+                        help='''Read gs://BUCKET/PATH from DIR/BUCKET/PATH,
+                        rather than from Cloud Storage.''')
+    parser.add_argument('--trace', metavar='FILE',
+                        help='''Record every FireCloud call to FILE, as JSON
+                        lines, and log a summary of call latencies at
+                        exit.''')
+    args = parser.parse_args(argv)
+    if args.trace:
+        trace.enable(args.trace)
+
+    nodes = parse_dot(args.workflow).nodes
+    if args.nodes:
+        unknown = set(args.nodes).difference(nodes)
+        if unknown:
+            parser.error('not in the workflow: ' + ', '.join(sorted(unknown)))
+        nodes = [node for node in nodes if node in args.nodes]
+    store = LocalStore(args.bucket_root) if args.bucket_root else \
+            BucketStore(args.project)
+    if not os.path.isdir(args.output):
+        os.makedirs(args.output)
+    harvester = Harvester(args.project, args.workspace, args.output, store,
+                          args.namespace, args.jobs, args.verify)
+    items = harvester.plan(nodes, args.ssets and set(args.ssets))
+    logging.info('%d output file(s) of %d node(s) in %s/%s', len(items),
+                 len(nodes), args.project, args.workspace)
+    counts = harvester.harvest(items)
+    logging.info('%d file(s) downloaded, %d unchanged, %d failed, into %s',
+                 counts['downloaded'], counts['skipped'], counts['failed'],
+                 args.output)
+    if counts['failed']:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+# encoding: utf-8
+'''
+Local history of method runtimes and resource usage, used to plan runs.
+
+Every task the scheduler sees finish is recorded in a SQLite database
+(~/.fiss/gdan_history.sqlite by default) with its method, sample set and
+duration, so later runs can estimate how long each node will take. Peak
+memory of individual tasks within a method can be recorded as well, from
+which gdan.resources sizes the memory attributes of new runs. Unlike
+runtimes, peak memory is not recorded automatically, since neither
+FireCloud nor the workflow metadata reports it; it is recorded by hand with
+`gdan resources record`.
+'''
+
+import os
+import sqlite3
+import threading
+import time
+
+DEFAULT_HISTORY = os.path.expanduser(os.path.join('~', '.fiss',
+                                                  'gdan_history.sqlite'))
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runtimes (
+    method        TEXT NOT NULL,
+    sample_set    TEXT NOT NULL,
+    workspace     TEXT,
+    submission_id TEXT,
+    duration      REAL NOT NULL,
+    succeeded     INTEGER NOT NULL,
+    recorded      REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS runtimes_method ON runtimes (method, sample_set);
+CREATE TABLE IF NOT EXISTS resources (
+    method        TEXT NOT NULL,
+    task          TEXT NOT NULL,
+    sample_set    TEXT NOT NULL,
+    cohort_size   INTEGER,
+    peak_memory   REAL NOT NULL,
+    duration      REAL,
+    workspace     TEXT,
+    submission_id TEXT,
+    recorded      REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS resources_task ON resources (method, task);
+'''
+
+def median(values):
+    values = sorted(values)
+    if not values:
+        return None
+    mid = len(values) // 2
+    if len(values) % 2:
+        return values[mid]
+    return (values[mid - 1] + values[mid]) / 2.0
+
+class History(object):
+    """Runtime history store. Safe to share between threads"""
+    def __init__(self, path=DEFAULT_HISTORY):
+        self.path = path
+        if path != ':memory:' and not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._db:
+            self._db.executescript(_SCHEMA)
+
+    def close(self):
+        self._db.close()
+
+    def _query(self, sql, params=()):
+        with self._lock:
+            return self._db.execute(sql, params).fetchall()
+
+    def record_runtime(self, method, sample_set, duration, succeeded=True,
+                       workspace=None, submission_id=None):
+        """Record how long method took on sample_set, in seconds"""
+        with self._lock, self._db:
+            self._db.execute('INSERT INTO runtimes VALUES (?, ?, ?, ?, ?, ?, ?)',
+                             (method, sample_set, workspace, submission_id,
+                              duration, int(bool(succeeded)), time.time()))
+
+    def record_resources(self, method, task, sample_set, peak_memory,
+                         cohort_size=None, duration=None, workspace=None,
+                         submission_id=None):
+        """Record the peak memory, in GB, of a task of method on sample_set,
+        which had cohort_size samples"""
+        with self._lock, self._db:
+            self._db.execute('INSERT INTO resources ' +
+                             'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                             (method, task, sample_set, cohort_size,
+                              peak_memory, duration, workspace, submission_id,
+                              time.time()))
+
+    def peak_memory(self, method, task):
+        """(sample set, cohort size, peak memory) of recorded runs of a task,
+        most recent first"""
+        return self._query('SELECT sample_set, cohort_size, peak_memory ' +
+                           'FROM resources WHERE method = ? AND task = ? ' +
+                           'ORDER BY recorded DESC', (method, task))
+
+    def runtimes(self, sample_set=None):
+        """Median duration of successful runs of each method, in seconds.
+
+        If sample_set is given, runs on it take precedence over the median
+        across all sample sets."""
+        durations = dict()
+        for method, duration in self._query(
+                'SELECT method, duration FROM runtimes WHERE succeeded = 1'):
+            durations.setdefault(method, []).append(duration)
+        estimates = dict((method, median(values))
+                         for method, values in durations.items())
+        if sample_set is not None:
+            durations = dict()
+            for method, duration in self._query(
+                    'SELECT method, duration FROM runtimes ' +
+                    'WHERE succeeded = 1 AND sample_set = ?', (sample_set,)):
+                durations.setdefault(method, []).append(duration)
+            estimates.update((method, median(values))
+                             for method, values in durations.items())
+        return estimates
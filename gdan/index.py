@@ -0,0 +1,297 @@
+# encoding: utf-8
+'''
+Local index of FireCloud workspaces and the sample sets they hold.
+
+Whether a workspace exists, and which sample sets it has, are asked again
+and again: by every analyses run of the stddata workspace it copies from,
+by gdac_new while it settles on a workspace name, and by anyone looking for
+the datestamps that have a cohort's sample set. The answers are kept in a
+SQLite database (~/.fiss/gdan_index.sqlite by default), with the time
+FireCloud last confirmed each workspace and the lastModified it reported.
+
+For up to ttl seconds after it was confirmed, a workspace is taken to exist
+without asking; a workspace the index does not hold is always looked up,
+so a workspace is never taken to be missing when it was just created. The
+sample sets of a workspace are listed again only when its lastModified
+changed since they were last listed, so rechecking a stale entry costs a
+single request rather than a listing of every sample set.
+
+    gdan index                # index stddata__, analyses__ and awg_ spaces
+    gdan index BRCA-TP        # which of them have BRCA-TP
+'''
+
+import os
+import sys
+import json
+import sqlite3
+import logging
+import threading
+import time
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import fnmatch
+
+from firecloud.errors import FireCloudServerError
+from gdan import trace
+from gdan.fcclient import get_client
+
+DEFAULT_INDEX = os.path.expanduser(os.path.join('~', '.fiss',
+                                                'gdan_index.sqlite'))
+# Seconds a workspace is taken to exist, and keep its lastModified, for
+DEFAULT_TTL = 15 * 60
+# Workspaces whose sample sets are indexed by update()
+INDEXED = ('stddata__*', 'analyses__*', 'awg_*')
+# Fields of each workspace kept in the index
+FIELDS = 'workspace.namespace,workspace.name,workspace.lastModified,' + \
+         'workspace.attributes'
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS workspaces (
+    project        TEXT NOT NULL,
+    name           TEXT NOT NULL,
+    modified       TEXT,
+    attributes     TEXT,
+    checked        REAL NOT NULL,
+    ssets_modified TEXT,
+    PRIMARY KEY (project, name)
+);
+CREATE TABLE IF NOT EXISTS sample_sets (
+    project        TEXT NOT NULL,
+    workspace      TEXT NOT NULL,
+    name           TEXT NOT NULL,
+    PRIMARY KEY (project, workspace, name)
+);
+CREATE INDEX IF NOT EXISTS sample_sets_name ON sample_sets (name);
+CREATE TABLE IF NOT EXISTS listings (
+    name           TEXT PRIMARY KEY,
+    listed         REAL NOT NULL
+);
+'''
+
+class MetadataIndex(object):
+    """Index of workspaces and their sample sets, asking FireCloud only for
+    what is missing or older than ttl seconds. Safe to share between
+    threads"""
+    def __init__(self, path=DEFAULT_INDEX, ttl=DEFAULT_TTL, client=None):
+        self.path = path
+        self.ttl = ttl
+        self._client = client
+        if path != ':memory:' and not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        with self._lock, self._db:
+            self._db.executescript(_SCHEMA)
+
+    @property
+    def client(self):
+        return self._client or get_client()
+
+    def close(self):
+        self._db.close()
+
+    def _query(self, sql, params=()):
+        with self._lock:
+            return self._db.execute(sql, params).fetchall()
+
+    def _store(self, project, name, space, checked):
+        """Record the workspace FireCloud described as space. Called with
+        the lock held"""
+        self._db.execute(
+            'INSERT OR IGNORE INTO workspaces (project, name, checked) '
+            'VALUES (?, ?, ?)', (project, name, checked))
+        self._db.execute(
+            'UPDATE workspaces SET modified = ?, attributes = ?, checked = ? '
+            'WHERE project = ? AND name = ?',
+            (space.get('lastModified'),
+             json.dumps(space.get('attributes', {}), sort_keys=True),
+             checked, project, name))
+
+    def _forget(self, project, name):
+        """Drop the workspace from the index. Called with the lock held"""
+        for table, column in (('workspaces', 'name'),
+                              ('sample_sets', 'workspace')):
+            self._db.execute('DELETE FROM {} WHERE project = ? AND {} = ?'
+                             .format(table, column), (project, name))
+
+    def record(self, project, workspace, exists=True):
+        """Record that project/workspace was just created, or deleted"""
+        with self._lock, self._db:
+            self._forget(project, workspace)
+            if exists:
+                self._store(project, workspace, {}, time.time())
+
+    def _check(self, project, workspace, force=False):
+        """The index's entry for project/workspace, (modified,
+        ssets_modified), after asking FireCloud if it is older than ttl or
+        force is set, or None if the workspace does not exist"""
+        row = self._query('SELECT modified, ssets_modified, checked '
+                          'FROM workspaces WHERE project = ? AND name = ?',
+                          (project, workspace))
+        if row and not force and time.time() - row[0][2] < self.ttl:
+            return row[0][:2]
+        try:
+            space = self.client.space_get(project, workspace, FIELDS)
+        except FireCloudServerError as e:
+            if e.code != 404:
+                raise
+            with self._lock, self._db:
+                self._forget(project, workspace)
+            return None
+        with self._lock, self._db:
+            self._store(project, workspace, space['workspace'], time.time())
+        return self._query('SELECT modified, ssets_modified FROM workspaces '
+                           'WHERE project = ? AND name = ?',
+                           (project, workspace))[0]
+
+    def space_exists(self, project, workspace):
+        """Whether project/workspace exists"""
+        return self._check(project, workspace) is not None
+
+    def sset_iter(self, project, workspace, refresh=False):
+        """Yield the names of the sample sets in project/workspace, listing
+        them from FireCloud only if it changed since they were indexed, or
+        if refresh is set. Raises FireCloudServerError if the workspace
+        does not exist"""
+        entry = self._check(project, workspace, refresh)
+        if entry is None:
+            raise FireCloudServerError(404, 'Workspace {}/{} does not '
+                                       'exist'.format(project, workspace))
+        modified, listed = entry
+        if modified is not None and modified == listed and not refresh:
+            for (sset,) in self._query(
+                    'SELECT name FROM sample_sets WHERE project = ? AND '
+                    'workspace = ? ORDER BY name', (project, workspace)):
+                yield sset
+            return
+        ssets = []
+        for sset in self.client.sset_iter(project, workspace):
+            ssets.append(sset)
+            yield sset
+        # Only a complete listing is kept
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM sample_sets WHERE project = ? AND '
+                             'workspace = ?', (project, workspace))
+            self._db.executemany('INSERT OR IGNORE INTO sample_sets '
+                                 'VALUES (?, ?, ?)',
+                                 [(project, workspace, sset)
+                                  for sset in ssets])
+            self._db.execute('UPDATE workspaces SET ssets_modified = ? '
+                             'WHERE project = ? AND name = ?',
+                             (modified, project, workspace))
+
+    def sample_sets(self, project, workspace, refresh=False):
+        """Names of all sample sets in project/workspace"""
+        return list(self.sset_iter(project, workspace, refresh))
+
+    def update(self, patterns=INDEXED, projects=None, jobs=8, force=False):
+        """List every workspace FireCloud has, unless listed within ttl or
+        force is set, and then the sample sets of those matching patterns
+        that changed since they were indexed. Returns the number of
+        workspaces whose sample sets were listed"""
+        listed = self._query('SELECT listed FROM listings WHERE name = ?',
+                             ('workspaces',))
+        if force or not listed or time.time() - listed[0][0] >= self.ttl:
+            now = time.time()
+            spaces = [entry['workspace'] for entry in
+                      self.client.space_list(FIELDS)]
+            with self._lock, self._db:
+                known = set(self._db.execute(
+                    'SELECT project, name FROM workspaces').fetchall())
+                for space in spaces:
+                    key = space['namespace'], space['name']
+                    known.discard(key)
+                    self._store(key[0], key[1], space, now)
+                for project, name in known:
+                    self._forget(project, name)
+                self._db.execute('INSERT OR REPLACE INTO listings '
+                                 'VALUES (?, ?)', ('workspaces', now))
+        stale = [(project, name) for project, name, modified, ssets in
+                 self._query('SELECT project, name, modified, '
+                             'ssets_modified FROM workspaces')
+                 if (projects is None or project in projects) and
+                    any(fnmatch(name, pattern) for pattern in patterns) and
+                    (force or modified is None or modified != ssets)]
+        if stale:
+            logging.info('Listing the sample sets of %d workspace(s)',
+                         len(stale))
+            with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+                list(pool.map(trace.wrap(lambda key: self.sample_sets(
+                    key[0], key[1], force)), stale))
+        return len(stale)
+
+    def find(self, sset, projects=None):
+        """(project, workspace, data_version) of the indexed workspaces
+        that have sample set sset, by workspace name"""
+        found = []
+        for project, workspace, attributes in self._query(
+                'SELECT w.project, w.name, w.attributes FROM sample_sets s '
+                'JOIN workspaces w ON w.project = s.project AND '
+                'w.name = s.workspace WHERE s.name = ? '
+                'ORDER BY w.name, w.project', (sset,)):
+            if projects is None or project in projects:
+                found.append((project, workspace, json.loads(
+                    attributes or '{}').get('data_version')))
+        return found
+
+_index = None
+_index_lock = threading.Lock()
+
+def get_index():
+    """The MetadataIndex shared by this process"""
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = MetadataIndex()
+        return _index
+
+def set_index(index):
+    """Share index, e.g. one with a shorter ttl, with this process"""
+    global _index
+    with _index_lock:
+        _index = index
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s::%(levelname)s  %(message)s',
+                        datefmt='%Y-%m-%d %I:%M:%S %p')
+    parser = ArgumentParser(formatter_class=ArgumentDefaultsHelpFormatter,
+                            description='''
+    Bring the local index of stddata, analyses and AWG workspaces and their
+    sample sets up to date, and show the workspaces that have the given
+    sample sets.''')
+    parser.add_argument('ssets', metavar='SSET', nargs='*',
+                        help='Sample set(s) to look for.')
+    parser.add_argument('-p', '--project', metavar='PROJECT', nargs='+',
+                        help='Only index and show workspaces in PROJECT(s).')
+    parser.add_argument('-i', '--index', default=DEFAULT_INDEX,
+                        help='Index database.')
+    parser.add_argument('--ttl', type=int, default=DEFAULT_TTL,
+                        help='''Seconds after which the list of workspaces
+                        is read again.''')
+    parser.add_argument('-r', '--refresh', action='store_true',
+                        help='''Read every workspace and its sample sets
+                        again, rather than only those that changed.''')
+    parser.add_argument('-o', '--offline', action='store_true',
+                        help='''Answer from the index as it is, without
+                        updating it.''')
+    parser.add_argument('-j', '--jobs', type=int, default=8,
+                        help='''Maximum number of workspaces whose sample
+                        sets are listed at once.''')
+    args = parser.parse_args(argv)
+
+    index = MetadataIndex(args.index, args.ttl)
+    if not args.offline:
+        listed = index.update(projects=args.project, jobs=args.jobs,
+                              force=args.refresh)
+        logging.info('Index at %s is up to date, %d workspace(s) listed',
+                     index.path, listed)
+    for sset in args.ssets:
+        found = index.find(sset, args.project)
+        sys.stdout.write('{}\t{}\n'.format(sset, '\t'.join(
+            '{}/{}{}'.format(project, workspace,
+                             ' ({})'.format(version) if version else '')
+            for project, workspace, version in found) or '-'))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+# encoding: utf-8
+'''
+Local journal of provisioning steps, so a failed run can be resumed.
+
+A journal is an append-only file of JSON lines, one per finished step,
+stored under ~/.fiss/gdan_journal. Its name is derived from the project,
+workspace and a description of the run's inputs, so rerunning a command with
+the same inputs picks up the same journal and skips every step that already
+succeeded, while changed inputs start afresh. Once every step has succeeded
+the journal ends with a done entry, after which it is no longer resumed.
+'''
+
+import os
+import json
+import hashlib
+import logging
+import threading
+import time
+from io import open
+from six import text_type
+
+DEFAULT_JOURNAL_DIR = os.path.expanduser(os.path.join('~', '.fiss',
+                                                      'gdan_journal'))
+# Step of the entry ending the journal of a completed provisioning
+DONE = 'done'
+
+def file_fingerprint(path):
+    """Cheap stand-in for a file's contents: its name, size and mtime"""
+    stat = os.stat(path)
+    return [os.path.abspath(path), stat.st_size, int(stat.st_mtime)]
+
+class Journal(object):
+    """Journal of the steps of provisioning project/workspace from inputs,
+    which may be anything JSON serializable"""
+    def __init__(self, project, workspace, inputs=None,
+                 directory=DEFAULT_JOURNAL_DIR):
+        self.project = project
+        self.workspace = workspace
+        key = json.dumps([project, workspace, inputs], sort_keys=True)
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+        self.path = os.path.join(directory, '{}.{}.{}.jsonl'.format(
+            project, workspace, digest))
+        self._lock = threading.Lock()
+
+    def entries(self):
+        """All recorded entries, oldest first"""
+        if not os.path.isfile(self.path):
+            return []
+        entries = []
+        with open(self.path) as journal:
+            for line in journal:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    # A partial last line from a crash mid-write
+                    logging.warning('Ignoring corrupt journal entry in %s',
+                                    self.path)
+        return entries
+
+    def succeeded(self):
+        """Names of steps whose latest entry is a success"""
+        status = dict()
+        for entry in self.entries():
+            status[entry['step']] = entry['status']
+        return set(step for step, state in status.items()
+                   if state == 'succeeded')
+
+    def unfinished(self):
+        """Whether an earlier run was journaled, but did not complete"""
+        entries = self.entries()
+        return bool(entries) and entries[-1]['step'] != DONE
+
+    def finish(self):
+        """Record that every step succeeded"""
+        self.record(DONE, 'succeeded')
+
+    def record(self, step, status, error=None):
+        entry = {'step': step, 'status': status, 'time': time.time()}
+        if error is not None:
+            entry['error'] = str(error)
+        with self._lock:
+            directory = os.path.dirname(self.path)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            with open(self.path, 'a') as journal:
+                journal.write(text_type(json.dumps(entry)) + u'\n')
+
+    def clear(self):
+        with self._lock:
+            if os.path.isfile(self.path):
+                os.remove(self.path)
@@ -0,0 +1,170 @@
+# encoding: utf-8
+'''
+Helpers for reading and combining FireCloud loadfiles.
+
+Loadfiles may be gzip compressed, in which case their names end in .gz.
+'''
+
+import os
+import io
+import gzip
+import logging
+import tempfile
+from collections import OrderedDict
+from glob import glob
+from io import open
+from six import string_types
+
+# Rows per merged loadfile
+DEFAULT_MAX_ROWS = 20000
+
+def get_cohort(loadfile):
+    return os.path.basename(loadfile).split('.', 1)[0]
+
+def open_loadfile(loadfile):
+    """Open a loadfile for reading as text, decompressing it on the fly if
+    it is gzipped"""
+    if loadfile.endswith('.gz'):
+        return io.TextIOWrapper(gzip.open(loadfile, 'rb'), encoding='utf-8')
+    return open(loadfile)
+
+def glob_loadfiles(pattern):
+    """Sorted paths matching pattern + '.loadfile.txt', compressed or not"""
+    return sorted(glob(pattern + '.loadfile.txt') +
+                  glob(pattern + '.loadfile.txt.gz'))
+
+def read_header(loadfile):
+    with open_loadfile(loadfile) as lf:
+        return lf.readline().rstrip('\r\n')
+
+def read_chunks(loadfile, chunk_size):
+    """Yield the rows of loadfile, without its header, in lists of
+    chunk_size rows. Consecutive memberships of the same set are kept in one
+    chunk, which may then run over chunk_size"""
+    with open_loadfile(loadfile) as lf:
+        membership = key_columns(lf.readline()) == 2
+        chunk = []
+        last = None
+        for line in lf:
+            line = line.rstrip('\r\n')
+            if not line.strip():
+                continue
+            key = line.split('\t', 1)[0]
+            if len(chunk) >= chunk_size and not (membership and key == last):
+                yield chunk
+                chunk = []
+            chunk.append(line)
+            last = key
+        if chunk:
+            yield chunk
+
+def key_columns(header):
+    """Number of leading columns identifying a row: membership loadfiles are
+    keyed on the (set, member) pair, entity loadfiles on the entity ID"""
+    return 2 if header.startswith('membership:') else 1
+
+def merge_loadfiles(loadfiles, outdir, max_rows=DEFAULT_MAX_ROWS):
+    """Stream loadfiles of a single entity type into as few merged loadfiles
+    as possible, each holding at most max_rows rows.
+
+    Loadfiles are grouped by header, since only identical headers can share
+    an upload; a warning is logged when more than one group is found. Rows
+    whose ID was already seen in the same group are dropped, keeping the
+    first occurrence; a row of another group, having other columns, is kept.
+    Only the IDs are held in memory, rows are written out as they are
+    read.
+    Returns the list of merged loadfile paths."""
+    groups = OrderedDict()
+    for loadfile in loadfiles:
+        groups.setdefault(read_header(loadfile), []).append(loadfile)
+    if len(groups) > 1:
+        logging.warning('Found %d distinct loadfile headers, these will be ' +
+                        'uploaded separately:\n\t%s', len(groups),
+                        '\n\t'.join(groups))
+
+    merged = []
+    duplicates = 0
+    for group, (header, paths) in enumerate(groups.items()):
+        keys = key_columns(header)
+        seen = set()
+        etype = header.split('\t', 1)[0].split(':', 1)[-1]
+        out = None
+        rows = 0
+        try:
+            for path in paths:
+                with open_loadfile(path) as lf:
+                    lf.readline()
+                    for line in lf:
+                        line = line.rstrip('\r\n')
+                        if not line:
+                            continue
+                        key = tuple(line.split('\t', keys)[:keys])
+                        if key in seen:
+                            duplicates += 1
+                            continue
+                        seen.add(key)
+                        if out is None or rows >= max_rows:
+                            if out is not None:
+                                out.close()
+                            merged.append(os.path.join(outdir,
+                                '{}.{}.{}.loadfile.txt'.format(
+                                    etype, group, len(merged))))
+                            out = open(merged[-1], 'w')
+                            out.write(header + u'\n')
+                            rows = 0
+                        out.write(line + u'\n')
+                        rows += 1
+        finally:
+            if out is not None:
+                out.close()
+
+    if duplicates:
+        logging.warning('Dropped %d duplicate row(s) while merging %d ' +
+                        'loadfile(s)', duplicates, len(loadfiles))
+    return merged
+
+def attribute_loadfile(attributes, ssets, overrides=None):
+    """Write the rows of the attributes loadfile for the given sample sets
+    to a temporary loadfile, so they can be set in a single import.
+
+    attributes may be a path or an open file, which is closed once read.
+    overrides maps sample sets to attribute values replacing, or adding to,
+    those in the attributes loadfile; a sample set not in the loadfile is
+    only included if overrides gives it a value for every column. Returns
+    the path to the loadfile, or None if no sample set has attributes"""
+    overrides = overrides or dict()
+    wanted = set(ssets)
+    lf = open(attributes) if isinstance(attributes, string_types) \
+         else attributes
+    try:
+        header = lf.readline().rstrip('\r\n').split('\t')
+        columns = header[1:] + sorted(set(attr for sset in wanted
+                                          for attr in overrides.get(sset, {})
+                                          if attr not in header))
+        rows = OrderedDict()
+        for line in lf:
+            fields = line.rstrip('\r\n').split('\t')
+            if fields[0] in wanted and fields[0] not in rows:
+                rows[fields[0]] = dict(zip(header[1:], fields[1:]))
+    finally:
+        lf.close()
+    for sset in sorted(wanted):
+        if sset in rows:
+            rows[sset].update(overrides.get(sset, {}))
+        elif set(columns).issubset(overrides.get(sset, {})):
+            rows[sset] = dict(overrides[sset])
+
+    missing = wanted.difference(rows)
+    if missing:
+        logging.warning('No attributes found for Sample Set(s):\n\t%s',
+                        '\n\t'.join(sorted(missing)))
+    if not rows:
+        return None
+    fd, loadfile = tempfile.mkstemp(suffix='.sample_set.loadfile.txt')
+    os.close(fd)
+    with open(loadfile, 'w') as out:
+        out.write(u'\t'.join(header[:1] + columns) + u'\n')
+        for sset, values in rows.items():
+            out.write(u'\t'.join([sset] + [values.get(col, '')
+                                            for col in columns]) + u'\n')
+    return loadfile
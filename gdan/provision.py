@@ -0,0 +1,261 @@
+# encoding: utf-8
+'''
+Dependency-aware workspace provisioning.
+
+Provisioning a workspace is a handful of independent FireCloud calls (ACLs,
+attributes, method config copies) plus a few that must wait on others (e.g.
+samples cannot be imported before their participants). A Provisioner holds
+these as named steps with explicit requirements and runs every step whose
+requirements have succeeded on a bounded pool of worker threads. Given a
+gdan.journal.Journal, steps that succeeded in an earlier run are not repeated.
+
+Steps may add further steps while they run, e.g. one step per entity of a
+listing as its pages arrive; these start as soon as their own requirements
+allow, without waiting for the step that added them to finish.
+'''
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from six.moves import queue
+
+from gdan import trace
+
+SUCCEEDED = 'succeeded'
+FAILED    = 'failed'
+SKIPPED   = 'skipped'
+
+# Phase of the run a step's calls are traced under, by step name prefix
+PHASES = {'acl': 'acl', 'attr': 'attributes', 'config': 'config',
+          'import': 'import', 'copy': 'copy', 'list': 'copy'}
+
+class ProvisioningError(Exception):
+    """Raised when one or more provisioning steps did not succeed"""
+    def __init__(self, results):
+        self.results = results
+        failed = [name for name, result in results.items()
+                  if result.status != SUCCEEDED]
+        super(ProvisioningError, self).__init__(
+            '{} provisioning step(s) did not succeed: {}'.format(
+                len(failed), ', '.join(failed)))
+
+class Step(object):
+    """A single unit of provisioning work. Steps that are not journaled run
+    every time, e.g. those adding other steps"""
+    def __init__(self, name, func, args=(), kwargs=None, requires=(),
+                 description=None, journaled=True):
+        self.name = name
+        self.func = func
+        self.args = tuple(args)
+        self.kwargs = kwargs or dict()
+        self.requires = tuple(requires)
+        self.description = description or name
+        self.journaled = journaled
+        self.phase = PHASES.get(name.split(':', 1)[0], 'provision')
+
+    def __call__(self):
+        return self.func(*self.args, **self.kwargs)
+
+class StepResult(object):
+    """Outcome of a Step: its status, return value or error, and duration"""
+    def __init__(self, status, value=None, error=None, elapsed=0.0):
+        self.status = status
+        self.value = value
+        self.error = error
+        self.elapsed = elapsed
+
+    def __repr__(self):
+        return 'StepResult({!r}, elapsed={:.2f})'.format(self.status,
+                                                         self.elapsed)
+
+class Provisioner(object):
+    """Runs a graph of provisioning steps concurrently.
+
+    Steps are added with the names of the steps they require. When run, each
+    step is submitted as soon as all of its requirements have succeeded; if
+    a requirement fails, the step (and anything requiring it) is skipped.
+    At most max_workers steps are in flight at once.
+
+    If journal is given, the outcome of each step is recorded in it, and
+    steps it records as succeeded are not run again."""
+    def __init__(self, max_workers=8, journal=None):
+        self.max_workers = max(1, max_workers)
+        self.journal = journal
+        self.steps = OrderedDict()
+        self._lock = threading.Lock()
+        # Set while running, to hand the run steps added by other steps
+        self._events = None
+
+    def add(self, name, func, args=(), kwargs=None, requires=(),
+            description=None, journaled=True):
+        """Add a step and return its name, for use in later requirements.
+        A step added while running may only require steps already added"""
+        with self._lock:
+            if name in self.steps:
+                raise ValueError('Duplicate provisioning step: ' + name)
+            if self._events is not None:
+                for req in requires:
+                    if req not in self.steps:
+                        raise ValueError('Step {} requires unknown step '
+                                         '{}'.format(name, req))
+            self.steps[name] = Step(name, func, args, kwargs, requires,
+                                    description, journaled)
+            if self._events is not None:
+                self._events.put(None)
+        return name
+
+    def _check(self):
+        for step in self.steps.values():
+            for req in step.requires:
+                if req not in self.steps:
+                    raise ValueError('Step {} requires unknown step {}'.format(
+                        step.name, req))
+        # Kahn's algorithm, only to reject cycles before anything is submitted
+        indegree = {name: len(step.requires)
+                    for name, step in self.steps.items()}
+        dependents = self._dependents()
+        ready = [name for name, deg in indegree.items() if deg == 0]
+        visited = 0
+        while ready:
+            name = ready.pop()
+            visited += 1
+            for dep in dependents[name]:
+                indegree[dep] -= 1
+                if indegree[dep] == 0:
+                    ready.append(dep)
+        if visited != len(self.steps):
+            raise ValueError('Provisioning steps contain a dependency cycle')
+
+    def _dependents(self):
+        dependents = {name: [] for name in self.steps}
+        for step in self.steps.values():
+            for req in step.requires:
+                dependents[req].append(step.name)
+        return dependents
+
+    @staticmethod
+    def _timed(step):
+        start = time.time()
+        try:
+            with trace.phase(step.phase):
+                value = step()
+        except Exception as e:
+            return StepResult(FAILED, error=e, elapsed=time.time() - start)
+        return StepResult(SUCCEEDED, value=value, elapsed=time.time() - start)
+
+    def run(self):
+        """Run all steps, returning an OrderedDict of step name: StepResult.
+
+        Failures do not stop independent steps; each failure is logged as it
+        happens and summarized by report()."""
+        self._check()
+        results = OrderedDict()
+        pending = dict()
+        dependents = dict()
+        done = self.journal.succeeded() if self.journal is not None else ()
+
+        def succeed(name):
+            for dep in dependents[name]:
+                if dep in pending:
+                    pending[dep].discard(name)
+
+        def skip(name, cause):
+            for dep in dependents[name]:
+                if dep in pending:
+                    del pending[dep]
+                    logging.warning('Skipping %s: requires %s, which %s',
+                                    self.steps[dep].description, name, cause)
+                    results[dep] = StepResult(SKIPPED)
+                    skip(dep, 'was skipped')
+
+        def admit():
+            """Take on the steps added since last called"""
+            with self._lock:
+                new = [step for name, step in self.steps.items()
+                       if name not in results]
+            for step in new:
+                results[step.name] = None
+                dependents[step.name] = []
+                reqs = pending[step.name] = set()
+                for req in step.requires:
+                    dependents[req].append(step.name)
+                    status = results[req].status if results[req] else None
+                    if status is None:
+                        reqs.add(req)
+                    elif status != SUCCEEDED:
+                        del pending[step.name]
+                        logging.warning('Skipping %s: requires %s, which %s',
+                                        step.description, req,
+                                        'failed' if status == FAILED else
+                                        'was skipped')
+                        results[step.name] = StepResult(SKIPPED)
+                        break
+                if step.journaled and step.name in done and \
+                   step.name in pending:
+                    logging.info('%s: already done', step.description)
+                    del pending[step.name]
+                    results[step.name] = StepResult(SUCCEEDED)
+                    succeed(step.name)
+
+        events = self._events = queue.Queue()
+        try:
+            admit()
+            with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+                running = dict()
+                while pending or running:
+                    for name in [n for n, reqs in pending.items() if not reqs]:
+                        del pending[name]
+                        step = self.steps[name]
+                        logging.info('%s ...', step.description)
+                        future = running[name] = pool.submit(self._timed, step)
+                        future.add_done_callback(
+                            lambda f, name=name: events.put(name))
+                    if not running:
+                        break
+
+                    # None means steps were added; admit them once running
+                    # steps have had the chance to add the rest of a batch
+                    name = events.get()
+                    if name is None:
+                        admit()
+                        continue
+                    result = results[name] = running.pop(name).result()
+                    if self.journal is not None and self.steps[name].journaled:
+                        self.journal.record(name, result.status, result.error)
+                    if result.status == SUCCEEDED:
+                        succeed(name)
+                    else:
+                        logging.error('%s failed: %s',
+                                      self.steps[name].description,
+                                      result.error)
+                        skip(name, 'failed')
+                    # A step may add steps up to the moment it returns
+                    admit()
+        finally:
+            self._events = None
+        return results
+
+    def report(self, results):
+        """Log a summary of results, raising ProvisioningError on failure"""
+        counts = dict((status, 0) for status in (SUCCEEDED, FAILED, SKIPPED))
+        for result in results.values():
+            counts[result.status] += 1
+        logging.info('Provisioning: %d succeeded, %d failed, %d skipped',
+                     counts[SUCCEEDED], counts[FAILED], counts[SKIPPED])
+        if counts[FAILED] or counts[SKIPPED]:
+            for name, result in results.items():
+                if result.status == FAILED:
+                    logging.error('\t%s: %s', self.steps[name].description,
+                                  result.error)
+            raise ProvisioningError(results)
+        return results
+
+    def execute(self):
+        """Run all steps and report on the results. The journal, if any, is
+        then marked done, so that it is not resumed"""
+        results = self.report(self.run())
+        if self.journal is not None:
+            self.journal.finish()
+        return results
@@ -0,0 +1,106 @@
+# encoding: utf-8
+'''
+Append-only recovery journal of a Scheduler's run.
+
+The first line of a journal is a JSON header holding the run's arguments and
+workflow. Each later line holds the fields of one task that changed, e.g.
+
+    {"node": "Merge_clinical", "sset": "BRCA-TP", "state": "Running", ...}
+
+so saving a change costs a short append rather than a rewrite of every
+task's state. Replaying the lines in order gives the latest state of each
+task, and a partial last line, from a crash mid-write, is ignored. Whenever
+a run starts from a journal, it is compacted: rewritten as the header and
+one line for each task that has left its initial state.
+
+Recovery files of earlier versions, a single JSON document, can still be
+read, and convert() rewrites one as a journal.
+'''
+
+import os
+import json
+import logging
+import tempfile
+import threading
+from io import open
+from six import text_type
+
+def is_legacy(path):
+    """Whether path is a recovery file in the earlier, single document
+    format"""
+    with open(path) as rf:
+        try:
+            return 'monitor_data' in json.load(rf)
+        except ValueError:
+            # Several lines of JSON
+            return False
+
+def load(path):
+    """The header of the recovery file at path, in either format, with the
+    latest state of its tasks under 'monitor_data', as {node: {sset:
+    fields}}"""
+    if is_legacy(path):
+        with open(path) as rf:
+            return json.load(rf)
+    header = None
+    tasks = dict()
+    with open(path) as rf:
+        for line in rf:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                logging.warning('Ignoring corrupt recovery entry in %s', path)
+                continue
+            if header is None:
+                header = entry
+                continue
+            node, sset = entry.pop('node'), entry.pop('sset')
+            tasks.setdefault(node, dict()).setdefault(sset, dict()).update(
+                entry)
+    if header is None:
+        raise ValueError('Empty recovery file: ' + path)
+    header['monitor_data'] = tasks
+    return header
+
+class RecoveryJournal(object):
+    """The recovery journal at path. Safe to share between threads"""
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def write(self, header, tasks, initial=None):
+        """Replace the journal with header and the state of tasks, {node:
+        {sset: fields}}, leaving out those whose fields equal initial"""
+        directory = os.path.dirname(os.path.abspath(self.path))
+        with self._lock:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+            with open(fd, 'w') as rf:
+                rf.write(text_type(json.dumps(header)) + u'\n')
+                for node, ssets in tasks.items():
+                    for sset, fields in ssets.items():
+                        if fields != initial:
+                            rf.write(self._line(node, sset, fields))
+            os.rename(tmp, self.path)
+
+    def append(self, node, sset, fields):
+        """Record that fields of the task of node on sset changed"""
+        with self._lock:
+            with open(self.path, 'a') as rf:
+                rf.write(self._line(node, sset, fields))
+
+    @staticmethod
+    def _line(node, sset, fields):
+        entry = dict(fields, node=node, sset=sset)
+        return text_type(json.dumps(entry, sort_keys=True)) + u'\n'
+
+def convert(source, target=None):
+    """Rewrite the recovery file source, in either format, as a journal at
+    target, by default source with a .jsonl extension. Returns target"""
+    if target is None:
+        target = os.path.splitext(source)[0] + '.jsonl'
+    recovery = load(source)
+    tasks = recovery.pop('monitor_data')
+    RecoveryJournal(target).write(recovery, tasks)
+    return target
@@ -0,0 +1,155 @@
+# encoding: utf-8
+'''
+Size the memory attributes of sample sets from recorded resource usage.
+
+defaults/sample_set_loadfile.tsv fixes lego_plotter_ram_gb and mutsig_ram_gb
+per cohort. Given peak memory recorded in gdan.history, each attribute is
+instead estimated, for the task that consumes it, from:
+
+    1. recent runs of the task on the same sample set, or else
+    2. a linear fit of peak memory against cohort size over all sample sets,
+
+plus some headroom. The static value is kept when neither is available.
+
+Peak memory is only in the history once recorded with `gdan resources
+record`, e.g. from the monitoring logs of a run; runs do not record it
+themselves, as FireCloud does not report it. Until peaks are recorded,
+sizing is in effect off and every run keeps the static values.
+'''
+
+import sys
+import logging
+import math
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+from collections import OrderedDict
+
+from gdan.history import History, DEFAULT_HISTORY
+from gdan.loadfiles import open_loadfile
+
+# Sample set attribute: (method, task) whose memory it sets
+RESOURCE_ATTRIBUTES = OrderedDict([
+    ('lego_plotter_ram_gb', ('Mutation_MutSig2CV', 'lego_plotter')),
+    ('mutsig_ram_gb',       ('Mutation_MutSig2CV', 'mutsig'))
+])
+HEADROOM = 1.25
+GRANULARITY_GB = 0.5
+# Number of recent runs of a task on a sample set considered
+RECENT_RUNS = 5
+
+def cohort_sizes(sset_loadfiles):
+    """Number of members of each sample set in the given membership
+    loadfiles"""
+    sizes = dict()
+    for loadfile in sset_loadfiles:
+        with open_loadfile(loadfile) as lf:
+            lf.readline()
+            for line in lf:
+                sset = line.split('\t', 1)[0].strip()
+                if sset:
+                    sizes[sset] = sizes.get(sset, 0) + 1
+    return sizes
+
+def _round_up(gb):
+    return max(GRANULARITY_GB,
+               math.ceil(gb * HEADROOM / GRANULARITY_GB) * GRANULARITY_GB)
+
+def _linear_fit(points):
+    """Least squares (intercept, slope) of points, or None if the x values
+    don't vary"""
+    n = float(len(points))
+    mean_x = sum(x for x, _ in points) / n
+    mean_y = sum(y for _, y in points) / n
+    var_x = sum((x - mean_x) ** 2 for x, _ in points)
+    if not var_x:
+        return None
+    slope = sum((x - mean_x) * (y - mean_y) for x, y in points) / var_x
+    return mean_y - slope * mean_x, slope
+
+def estimate_memory(history, method, task, sample_set, cohort_size=None):
+    """Estimated memory in GB for a task of method on sample_set, or None if
+    there is no usable history"""
+    runs = history.peak_memory(method, task)
+    recent = [peak for sset, _, peak in runs if sset == sample_set]
+    if recent:
+        return _round_up(max(recent[:RECENT_RUNS]))
+    if cohort_size is None:
+        return None
+    points = [(size, peak) for _, size, peak in runs if size is not None]
+    fit = _linear_fit(points) if len(points) > 1 else None
+    if fit is None:
+        return None
+    intercept, slope = fit
+    # Never go below the smallest peak seen, a poor fit can predict ~0
+    return _round_up(max(intercept + slope * cohort_size,
+                         min(peak for _, peak in points)))
+
+def sized_attributes(history, ssets, sizes=None):
+    """Estimated resource attributes for each of ssets that has history, as
+    {sample set: {attribute: value}}"""
+    sizes = sizes or dict()
+    estimates = dict()
+    for sset in ssets:
+        for attr, (method, task) in RESOURCE_ATTRIBUTES.items():
+            gb = estimate_memory(history, method, task, sset, sizes.get(sset))
+            if gb is not None:
+                estimates.setdefault(sset, OrderedDict())[attr] = \
+                    '{:g}'.format(gb)
+    if estimates:
+        logging.info('Sized resource attributes of %d Sample Set(s) from ' +
+                     'history', len(estimates))
+    elif ssets:
+        logging.info('No peak memory recorded for these Sample Sets or ' +
+                     'their tasks, keeping the static resource attributes')
+    return estimates
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO)
+    parser = ArgumentParser(formatter_class=ArgumentDefaultsHelpFormatter,
+                            description='''
+    Record task resource usage, or show the resource attributes that would be
+    set for sample sets from the recorded history. Peak memory is recorded
+    only by this command; runs do not record it, as FireCloud does not
+    report it. Until peaks of a task are recorded, sizing is off for the
+    attribute it consumes, and runs keep the value in the attributes
+    file.''')
+    parser.add_argument('-H', '--history', default=DEFAULT_HISTORY,
+                        help='Resource history database.')
+    subparsers = parser.add_subparsers(dest='command')
+    record = subparsers.add_parser('record', help='''Record the peak memory
+                                   of a task run, e.g. as read from its
+                                   monitoring logs.''',
+                                   formatter_class=ArgumentDefaultsHelpFormatter)
+    record.add_argument('method', help='Method config, e.g. Mutation_MutSig2CV')
+    record.add_argument('task', help='Task within the method, e.g. mutsig')
+    record.add_argument('sample_set')
+    record.add_argument('peak_memory', type=float, help='Peak memory in GB.')
+    record.add_argument('-n', '--cohort-size', type=int,
+                        help='Number of samples in the sample set.')
+    record.add_argument('-d', '--duration', type=float,
+                        help='Task duration in seconds.')
+    show = subparsers.add_parser('show', help='Show sized attributes.',
+                                 formatter_class=ArgumentDefaultsHelpFormatter)
+    show.add_argument('sample_sets', metavar='SSET', nargs='+')
+    show.add_argument('-l', '--loadfiles', metavar='LOADFILE', nargs='*',
+                      default=[], help='Sample set membership loadfiles ' +
+                                       'from which to take cohort sizes.')
+    args = parser.parse_args(argv)
+
+    history = History(args.history)
+    if args.command == 'record':
+        history.record_resources(args.method, args.task, args.sample_set,
+                                 args.peak_memory, args.cohort_size,
+                                 args.duration)
+    elif args.command == 'show':
+        estimates = sized_attributes(history, args.sample_sets,
+                                     cohort_sizes(args.loadfiles))
+        print('\t'.join(['sample_set_id'] + list(RESOURCE_ATTRIBUTES)))
+        for sset in args.sample_sets:
+            print('\t'.join([sset] + [estimates.get(sset, {}).get(attr, '')
+                                      for attr in RESOURCE_ATTRIBUTES]))
+    else:
+        parser.print_help()
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
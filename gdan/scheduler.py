@@ -0,0 +1,441 @@
+# encoding: utf-8
+'''
+Run a DOT workflow of method configs over a workspace's sample sets.
+
+This replaces `fissfc supervise` for the gdan entry points. The supervisor
+there walks every node in a fixed order and sleeps between sweeps; here every
+(node, sample set) task is submitted as soon as its dependencies on that
+sample set are satisfied, submissions are issued concurrently, and the number
+of submissions running at once is capped. When more tasks are ready than can
+be submitted, those with the longest remaining critical path, estimated from
+the runtimes recorded in gdan.history, go first.
+
+Progress is saved to a gdan.recovery journal, from which `gdan recover`
+resumes a run. A resumed run reconciles its tasks with the workspace's
+submissions using one listing of them, including any submission made just
+before a crash but never recorded. A submission that fails with a server or
+connection error is reconciled the same way at the next poll, and submitted
+again only if the listing shows it was not made.
+'''
+
+import sys
+import heapq
+import calendar
+import logging
+import time
+from datetime import timedelta
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from gdan import trace
+from firecloud.errors import FireCloudServerError
+from gdan.fcclient import get_client, RETRY_CODES
+from gdan.workflow import Workflow, ON_COMPLETE
+from gdan.history import History, median
+from gdan.recovery import RecoveryJournal, is_legacy, load, convert
+
+# Task states, as in firecloud.supervisor
+NOT_STARTED = 'Not Started'
+RUNNING     = 'Running'
+COMPLETED   = 'Completed'
+EVALUATED   = 'Evaluated'
+
+# Submission statuses after which no workflow will change
+FINISHED = ('Done', 'Aborted')
+
+DEFAULT_MAX_SUBMISSIONS = 200
+DEFAULT_POLL_INTERVAL = 30
+# Assumed runtime, in seconds, when there is no history at all
+DEFAULT_RUNTIME = 3600.0
+# Attempts at submitting a task failing with server or connection errors
+SUBMIT_ATTEMPTS = 5
+# Seconds by which a submission may appear to predate the attempt making it,
+# allowing for the difference between the local and FireCloud clocks
+CLOCK_SKEW = 300
+
+def _timestamp(date):
+    """Seconds since the epoch of a submissionDate, or None"""
+    try:
+        return calendar.timegm(time.strptime(date[:19], '%Y-%m-%dT%H:%M:%S'))
+    except (TypeError, ValueError):
+        return None
+
+def _transient(error):
+    """Whether a submission failing with error may have been made, or may
+    succeed if made again"""
+    from requests.exceptions import RequestException
+    if isinstance(error, FireCloudServerError):
+        return error.code in RETRY_CODES
+    return isinstance(error, RequestException)
+
+class SchedulerError(Exception):
+    pass
+
+class Scheduler(object):
+    """Submits each node of workflow on each sample set in dependency order.
+
+    A task may start once every upstream task on the same sample set has been
+    evaluated. An "OnComplete" dependency additionally requires the upstream
+    task to have succeeded; otherwise the task is marked evaluated without
+    running. At most max_submissions submissions run at once, prioritized by
+    their critical path. Task runtimes are read from and recorded to history
+    (by default the local gdan.history store). Each change of state is
+    appended to the recovery journal at recovery_file, if given."""
+    def __init__(self, project, workspace, namespace, workflow, sample_sets,
+                 max_submissions=DEFAULT_MAX_SUBMISSIONS,
+                 poll_interval=DEFAULT_POLL_INTERVAL, recovery_file=None,
+                 jobs=8, client=None, history=None):
+        self.project = project
+        self.workspace = workspace
+        self.namespace = namespace
+        self.workflow = workflow
+        self.sample_sets = list(sample_sets)
+        self.max_submissions = max(1, max_submissions)
+        self.poll_interval = poll_interval
+        self.recovery_file = recovery_file
+        self.journal = RecoveryJournal(recovery_file) \
+                       if recovery_file is not None else None
+        self.jobs = max(1, jobs)
+        self.client = client or get_client()
+        self.history = History() if history is None else history
+        self.runtimes = dict((sset, self.history.runtimes(sset))
+                             for sset in self.sample_sets)
+        self.default_runtime = median(self.history.runtimes().values()) or \
+                               DEFAULT_RUNTIME
+        self.priority = dict((sset, workflow.critical_paths(
+                                  self.runtimes[sset], self.default_runtime))
+                             for sset in self.sample_sets)
+        self.tasks = OrderedDict()
+        for node in workflow.nodes:
+            self.tasks[node] = OrderedDict(
+                (sset, self.initial()) for sset in self.sample_sets)
+
+    @staticmethod
+    def initial():
+        """State of a task that has not been started"""
+        return {'state': NOT_STARTED, 'evaluated': False, 'succeeded': False}
+
+    @classmethod
+    def recover(cls, recovery_file, client=None, history=None, **kwargs):
+        """Recreate a Scheduler from the state saved in recovery_file, which
+        may be in the earlier, single document format"""
+        if is_legacy(recovery_file):
+            converted = convert(recovery_file)
+            logging.info('Converted %s to the journal %s, from which the run '
+                         'continues', recovery_file, converted)
+            recovery_file = converted
+        recovery = load(recovery_file)
+        args = recovery['args']
+        args.update(kwargs)
+        workflow = Workflow.from_dict(recovery['dependencies'],
+                                      args.pop('workflow', None))
+        scheduler = cls(args['project'], args['workspace'], args['namespace'],
+                        workflow, args['sample_sets'],
+                        max_submissions=args.get('max_submissions',
+                                                 DEFAULT_MAX_SUBMISSIONS),
+                        poll_interval=args.get('poll_interval',
+                                               DEFAULT_POLL_INTERVAL),
+                        recovery_file=recovery_file,
+                        jobs=args.get('jobs', 8), client=client,
+                        history=history)
+        for node, ssets in recovery['monitor_data'].items():
+            for sset, fields in ssets.items():
+                scheduler.tasks[node][sset].update(fields)
+        return scheduler
+
+    def save(self):
+        """Write the state of every task to the recovery journal, replacing
+        the changes appended to it"""
+        if self.journal is None:
+            return
+        header = {'args': {'project': self.project,
+                           'workspace': self.workspace,
+                           'namespace': self.namespace,
+                           'workflow': self.workflow.name,
+                           'sample_sets': self.sample_sets,
+                           'max_submissions': self.max_submissions,
+                           'poll_interval': self.poll_interval,
+                           'jobs': self.jobs},
+                  'dependencies': self.workflow.to_dict()}
+        self.journal.write(header, self.tasks, self.initial())
+
+    def update(self, node, sset, **fields):
+        """Change fields of the task of node on sset, and journal them"""
+        self.tasks[node][sset].update(fields)
+        if self.journal is not None:
+            self.journal.append(node, sset, fields)
+
+    def validate(self):
+        """Confirm every node has a method config in the workspace"""
+        configs = set(config['name'] for config in
+                      self.client.config_list(self.project, self.workspace)
+                      if config['namespace'] == self.namespace)
+        missing = [node for node in self.workflow.nodes if node not in configs]
+        if missing:
+            raise SchedulerError('No method config for {} in {}/{}'.format(
+                ', '.join(missing), self.project, self.workspace))
+
+    def _iter_tasks(self, state=None):
+        for node, ssets in self.tasks.items():
+            for sset, task in ssets.items():
+                if state is None or task['state'] == state:
+                    yield node, sset, task
+
+    def running(self):
+        return sum(1 for _ in self._iter_tasks(RUNNING))
+
+    def ready(self):
+        """Tasks whose dependencies are satisfied, in submission order.
+
+        Tasks that can never run, because an "OnComplete" dependency did not
+        succeed, are marked evaluated along the way."""
+        ready = []
+        changed = True
+        while changed:
+            changed = False
+            ready = []
+            for node, sset, _ in self._iter_tasks(NOT_STARTED):
+                upstream = [(self.tasks[dep][sset], mode) for dep, mode in
+                            self.workflow.dependencies[node]]
+                if not all(dep['evaluated'] for dep, _ in upstream):
+                    continue
+                if any(mode == ON_COMPLETE and not dep['succeeded']
+                       for dep, mode in upstream):
+                    logging.info('Not running %s on %s, a dependency did ' +
+                                 'not succeed', node, sset)
+                    self.update(node, sset, state=EVALUATED, evaluated=True)
+                    changed = True
+                    continue
+                ready.append((node, sset))
+        return self.order(ready)
+
+    def order(self, ready):
+        """Order in which to submit ready tasks: longest critical path first"""
+        return sorted(ready, key=lambda task: -self.priority[task[1]][task[0]])
+
+    def runtime(self, node, sset):
+        return self.runtimes[sset].get(node, self.default_runtime)
+
+    def predict_makespan(self):
+        """Simulate the rest of the run with the estimated runtimes, assuming
+        every task succeeds, and return its duration in seconds"""
+        down = self.workflow.downstream()
+        waiting = dict()
+        ready = []
+        for node, sset, task in self._iter_tasks():
+            if task['evaluated']:
+                continue
+            waiting[node, sset] = sum(
+                1 for dep, _ in self.workflow.dependencies[node]
+                if not self.tasks[dep][sset]['evaluated'])
+            if not waiting[node, sset]:
+                ready.append((node, sset))
+        now = 0.0
+        running = []
+        while ready or running:
+            ready = self.order(ready)
+            while ready and len(running) < self.max_submissions:
+                node, sset = ready.pop(0)
+                heapq.heappush(running, (now + self.runtime(node, sset),
+                                         node, sset))
+            now, node, sset = heapq.heappop(running)
+            for dep in down[node]:
+                if (dep, sset) in waiting:
+                    waiting[dep, sset] -= 1
+                    if not waiting[dep, sset]:
+                        ready.append((dep, sset))
+        return now
+
+    def _submit(self, node, sset):
+        return self.client.submission_new(self.project, self.workspace,
+                                          self.namespace, node, sset,
+                                          'sample_set')
+
+    def submit(self, pool, ready):
+        """Submit ready tasks concurrently, up to the running limit. Each
+        task is journaled as submitting first, so that a submission made
+        just before a crash is found on recovery rather than repeated. A
+        submission failing with a server or connection error is left
+        submitting, for the next poll to reconcile"""
+        slots = self.max_submissions - self.running()
+        ready = ready[:max(0, slots)]
+        for node, sset in ready:
+            self.update(node, sset, submitting=True, attempted=time.time())
+        submit = trace.wrap(self._submit)
+        futures = [(node, sset, pool.submit(submit, node, sset))
+                   for node, sset in ready]
+        for node, sset, future in futures:
+            try:
+                submission_id = future.result()
+            except Exception as e:
+                attempts = self.tasks[node][sset].get('attempts', 0) + 1
+                if _transient(e) and attempts < SUBMIT_ATTEMPTS:
+                    logging.warning('Failed to submit %s on %s, checking ' +
+                                    'whether to retry: %s', node, sset, e)
+                    self.update(node, sset, attempts=attempts)
+                    continue
+                logging.error('Failed to submit %s on %s: %s', node, sset, e)
+                self.update(node, sset, state=COMPLETED, evaluated=True,
+                            succeeded=False, submitting=False)
+                continue
+            logging.info('Started %s on %s', node, sset)
+            self.update(node, sset, state=RUNNING, submissionId=submission_id,
+                        submitted=time.time(), submitting=False)
+        return len(futures)
+
+    def reconcile(self, submissions):
+        """Resolve tasks journaled as submitting, but not as submitted, from
+        the workspace's submissions: each takes the latest submission of its
+        config on its sample set not already taken by a task, and not made
+        before it was last attempted, or else is left to be submitted
+        again"""
+        unsure = [(node, sset, task) for node, sset, task in
+                  self._iter_tasks(NOT_STARTED) if task.get('submitting')]
+        if not unsure:
+            return
+        known = set(task.get('submissionId') for _, _, task in
+                    self._iter_tasks())
+        latest = dict()
+        for submission in sorted(submissions,
+                                 key=lambda s: s.get('submissionDate', '')):
+            if submission['submissionId'] in known or \
+               submission.get('methodConfigurationNamespace',
+                              self.namespace) != self.namespace:
+                continue
+            latest[submission.get('methodConfigurationName'),
+                   submission.get('submissionEntity', {}).get('entityName')] \
+                = submission
+        for node, sset, task in unsure:
+            submission = latest.get((node, sset))
+            made = submission and _timestamp(submission.get('submissionDate'))
+            if made is not None and task.get('attempted') is not None and \
+               made < task['attempted'] - CLOCK_SKEW:
+                # Left by an earlier run in the workspace
+                submission = None
+            if submission is None:
+                logging.info('%s on %s was not submitted, submitting it',
+                             node, sset)
+                self.update(node, sset, submitting=False)
+                continue
+            logging.info('Found unrecorded submission %s of %s on %s',
+                         submission['submissionId'], node, sset)
+            self.update(node, sset, state=RUNNING,
+                        submissionId=submission['submissionId'],
+                        submitted=time.time(), submitting=False)
+
+    def poll(self):
+        """Update running tasks, and those whose submission is uncertain,
+        from one listing of the workspace's submissions. Returns the number
+        of tasks that finished"""
+        if not any(task['state'] == RUNNING or task.get('submitting')
+                   for _, _, task in self._iter_tasks()):
+            return 0
+        listing = self.client.submission_list(self.project, self.workspace)
+        self.reconcile(listing)
+        submissions = dict((s['submissionId'], s) for s in listing)
+        finished = 0
+        for node, sset, task in self._iter_tasks(RUNNING):
+            submission = submissions.get(task['submissionId'])
+            if submission is None or submission['status'] not in FINISHED:
+                continue
+            succeeded = submission['status'] == 'Done' and \
+                        'Failed' not in submission.get('workflowStatuses', {})
+            logging.info('%s %s on %s', node,
+                         'succeeded' if succeeded else 'failed', sset)
+            self.update(node, sset, state=COMPLETED, evaluated=True,
+                        succeeded=succeeded, completed=time.time())
+            # Tasks running when a legacy recovery file was written have no
+            # submission time, so their runtime is unknown
+            if task.get('submitted') is not None:
+                self.history.record_runtime(
+                    node, sset, task['completed'] - task['submitted'],
+                    succeeded, self.workspace, task['submissionId'])
+            finished += 1
+        return finished
+
+    def done(self):
+        return all(task['evaluated'] for _, _, task in self._iter_tasks())
+
+    def summary(self):
+        counts = OrderedDict((key, 0) for key in
+                             ('Waiting', 'Running', 'Succeeded', 'Failed',
+                              'Not Run'))
+        for _, _, task in self._iter_tasks():
+            if task['state'] == NOT_STARTED:
+                counts['Waiting'] += 1
+            elif task['state'] == RUNNING:
+                counts['Running'] += 1
+            elif task['state'] == EVALUATED:
+                counts['Not Run'] += 1
+            elif task['succeeded']:
+                counts['Succeeded'] += 1
+            else:
+                counts['Failed'] += 1
+        return counts
+
+    def run(self):
+        """Run until every task has been evaluated. Returns True if every
+        task that ran succeeded"""
+        with trace.phase('supervise'):
+            return self._run()
+
+    def _run(self):
+        logging.info('Running %s on %d sample set(s) in %s/%s',
+                     self.workflow.name, len(self.sample_sets), self.project,
+                     self.workspace)
+        self.validate()
+        logging.info('Predicted makespan: %s', timedelta(
+            seconds=int(self.predict_makespan())))
+        # Start the journal afresh, or compact the one recovered from
+        self.save()
+        with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            while True:
+                changed = self.poll()
+                changed += self.submit(pool, self.ready())
+                if changed:
+                    logging.info(', '.join('{} {}'.format(count, key) for
+                                           key, count in
+                                           self.summary().items()))
+                if self.done():
+                    break
+                time.sleep(self.poll_interval)
+        self.save()
+        return self.summary()['Failed'] == 0
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s::%(levelname)s  %(message)s',
+                        datefmt='%Y-%m-%d %I:%M:%S %p')
+    parser = ArgumentParser(formatter_class=ArgumentDefaultsHelpFormatter,
+                            description='''
+    Resume a gdan workflow run from its recovery file.''')
+    parser.add_argument('recovery_file', help='Recovery file of the run.')
+    parser.add_argument('--convert', action='store_true',
+                        help='''Only convert a recovery file of an earlier
+                        version to a journal, named after it with a .jsonl
+                        extension.''')
+    parser.add_argument('-c', '--max-submissions', type=int,
+                        help='''Maximum number of submissions to run at once
+                        (default: as originally run).''')
+    parser.add_argument('--trace', metavar='FILE',
+                        help='''Record every FireCloud call to FILE, as JSON
+                        lines, and log a summary of call latencies at
+                        exit.''')
+    args = parser.parse_args(argv)
+    if args.convert:
+        logging.info('Converted %s to %s', args.recovery_file,
+                     convert(args.recovery_file))
+        return
+    if args.trace:
+        trace.enable(args.trace)
+
+    overrides = dict()
+    if args.max_submissions:
+        overrides['max_submissions'] = args.max_submissions
+    scheduler = Scheduler.recover(args.recovery_file, **overrides)
+    if not scheduler.run():
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+# encoding: utf-8
+'''
+Rules selecting the sample sets an analyses run is made of.
+
+A rule set is read from a file of rules, one per line:
+
+    include -tp$
+    exclude (^|-)stes-[^-]+$
+
+Each rule is a regular expression searched for in a sample set's name,
+ignoring case. The first rule that matches decides whether the sample set is
+selected, and sample sets no rule matches are not. Blank lines and lines
+starting with # are ignored. The default rules are in defaults/sset_rules.txt.
+'''
+
+import re
+from io import open
+
+from gdan import resource_path
+
+DEFAULT_RULES = resource_path('defaults', 'sset_rules.txt')
+ACTIONS = ('include', 'exclude')
+
+class RuleSyntaxError(ValueError):
+    pass
+
+class RuleSet(object):
+    """Ordered include/exclude rules, compiled once"""
+    def __init__(self, rules):
+        self.rules = []
+        for action, pattern in rules:
+            if action not in ACTIONS:
+                raise RuleSyntaxError('Unknown action {!r}, expected one of '
+                                      '{}'.format(action, ', '.join(ACTIONS)))
+            try:
+                self.rules.append((action == 'include',
+                                   re.compile(pattern, re.IGNORECASE)))
+            except re.error as e:
+                raise RuleSyntaxError('Bad pattern {!r}: {}'.format(pattern,
+                                                                    e))
+
+    @classmethod
+    def from_file(cls, path=DEFAULT_RULES):
+        rules = []
+        with open(path) as rf:
+            for lineno, line in enumerate(rf, 1):
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                fields = line.split(None, 1)
+                if len(fields) != 2:
+                    raise RuleSyntaxError('{}:{}: expected an action and a '
+                                          'pattern'.format(path, lineno))
+                rules.append(fields)
+        return cls(rules)
+
+    def match(self, sset):
+        """Whether the rules select sset"""
+        for include, pattern in self.rules:
+            if pattern.search(sset):
+                return include
+        return False
+
+    def select(self, ssets):
+        """Yield those of ssets the rules select, as they arrive"""
+        for sset in ssets:
+            if self.match(sset):
+                yield sset
@@ -2,27 +2,29 @@
 import sys
 import os
 import logging
+import shutil
+import tempfile
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
-from pkg_resources import resource_filename
-from glob import glob
-from io import open
 
-from firecloud.fiss import main as call_fiss, _confirm_prompt as ask
+from gdan import trace, resource_path
+from gdan.provision import Provisioner, ProvisioningError, SUCCEEDED
+from gdan.journal import Journal, file_fingerprint
+from gdan.sync import WorkspaceState, sync_acl, sync_attributes, \
+                      sync_configs, sync_loadfiles, show_plan
+from gdan.loadfiles import get_cohort, glob_loadfiles, merge_loadfiles, \
+                           DEFAULT_MAX_ROWS
+from gdan.validate import cohort_loadfiles, validate_loadfiles
+from gdan.fcclient import get_client
+from gdan.configcache import ConfigCache, DEFAULT_MAX_AGE
+from gdan.workflow import parse_dot
+from gdan.scheduler import Scheduler, DEFAULT_MAX_SUBMISSIONS, \
+                          DEFAULT_POLL_INTERVAL
+from gdan.delta import changed_cohorts, sample_sets
+from gdan.analyses_new import copy_sample_sets
+from gdan.template import Template, template_name
+from gdan.index import MetadataIndex, DEFAULT_TTL, get_index, set_index
 
-def get_configs(workflow):
-    with open(workflow, 'r') as configs:
-        for line in configs:
-            config = line.strip()
-            if config.endswith(';') and '->' not in config:
-                yield config.rstrip(';').strip('"')
-
-def get_cohort(loadfile):
-    return os.path.basename(loadfile).split('.', 1)[0]
-
-def fissfc(*args):
-    return call_fiss(["fissfc", "-V"] + list(args))
-
-def main():
+def main(argv=None):
     logging.basicConfig(level=logging.INFO)
     
     parser = ArgumentParser(formatter_class=ArgumentDefaultsHelpFormatter,
@@ -39,27 +41,86 @@ def main():
     parser.add_argument('-n', '--namespace', default='broadgdac',
                         help='Method Config namespace.')
     parser.add_argument('-w', '--workflow',
-                        default=resource_filename(__name__,
-                                                  os.path.join('defaults',
-                                                               'stddata.dot')),
+                        default=resource_path('defaults', 'stddata.dot'),
                         help='DOT format file with stddata workflow.')
     parser.add_argument('-d', '--datestamp', default='latest',
                         help='Specify the dicing date to use in YYYY_MM_DD.')
     parser.add_argument('-r', '--recovery_file',
                         default=os.path.expanduser(os.path.join('~', '.fiss',
-                                                                'stddata.json')),
+                                                                'stddata.jsonl')),
                         help='''File to save monitor data. This file can be
-                        passed to fissfc supervise_recover in case the
-                        supervisor crashes.''')
+                        passed to gdan_recover in case the supervisor
+                        crashes.''')
+    parser.add_argument('-j', '--jobs', type=int, default=8,
+                        help='''Maximum number of concurrent FireCloud calls
+                        while provisioning.''')
+    parser.add_argument('-c', '--max-submissions', type=int,
+                        default=DEFAULT_MAX_SUBMISSIONS,
+                        help='Maximum number of submissions to run at once.')
+    parser.add_argument('--poll-interval', type=int,
+                        default=DEFAULT_POLL_INTERVAL,
+                        help='Seconds between checks on running submissions.')
+    parser.add_argument('-b', '--bulk', action='store_true',
+                        help='''Merge the loadfiles of all cohorts into one
+                        upload per entity type, rather than one per cohort.''')
+    parser.add_argument('--max-rows', type=int, default=DEFAULT_MAX_ROWS,
+                        help='''Maximum rows per merged loadfile upload when
+                        using --bulk.''')
+    parser.add_argument('--chunk-size', type=int, default=500,
+                        help='''Rows per upload request; the chunks of a
+                        loadfile are uploaded concurrently.''')
+    parser.add_argument('--restart', action='store_true',
+                        help='''Start over rather than resume an earlier,
+                        unfinished run with the same inputs.''')
+    parser.add_argument('-S', '--sync', action='store_true',
+                        help='''If the workspace already exists, update only
+                        the method configs, attributes and entities that
+                        differ from those that would be created, rather than
+                        deleting and recreating it.''')
+    parser.add_argument('--refresh-configs', action='store_true',
+                        help='''Read every method config from the methods
+                        workspace, rather than using those cached locally.''')
+    parser.add_argument('--refresh-index', action='store_true',
+                        help='''Check the workspaces used with FireCloud,
+                        rather than trusting the local index of them for up
+                        to {} minutes.'''.format(DEFAULT_TTL // 60))
+    parser.add_argument('--template', metavar='WORKSPACE', nargs='?',
+                        const='',
+                        help='''Create the workspace as a clone of a template
+                        workspace in the same project, holding the method
+                        configs and standard attributes, which is built or
+                        refreshed first if the workflow or method configs
+                        changed. WORKSPACE defaults to the workflow file's
+                        name followed by _template, e.g.
+                        stddata_template.''')
+    parser.add_argument('--delta', metavar='DATESTAMP',
+                        help='''Datestamp of an earlier stddata run under
+                        loadfile_root. Only the cohorts whose loadfiles
+                        changed since then are loaded and merged; the
+                        sample sets of the rest, with their merge outputs,
+                        are copied from that run's workspace.''')
+    parser.add_argument('--copy-batch-size', type=int, default=100,
+                        help='''Maximum number of Sample Sets copied, with
+                        their samples and participants, in one request, when
+                        using --delta.''')
+    parser.add_argument('--skip-validation', action='store_true',
+                        help='''Don't check the loadfiles for broken references
+                        and malformed rows before creating the workspace.''')
     parser.add_argument('loadfile_root',
                         help='Path to the datestamped loadfile directories.')
-    args = parser.parse_args()
+    parser.add_argument('--trace', metavar='FILE',
+                        help='''Record every FireCloud call to FILE, as JSON
+                        lines, and log a summary of call latencies at
+                        exit.''')
+    args = parser.parse_args(argv)
+    if args.trace:
+        trace.enable(args.trace)
     
     methods   = args.methods
     fromproject, fromspace = methods.split('/')
     toproject = args.project
     namespace = args.namespace
-    workflow  = args.workflow
+    workflow  = parse_dot(args.workflow)
     recover   = args.recovery_file
     loadfiles = os.path.realpath(os.path.join(args.loadfile_root,
                                               args.datestamp))
@@ -71,68 +132,206 @@ def main():
                       'loadfile_root arguments.', loadfiles)
         sys.exit(1)
     
-    logging.info('Checking for %s/%s ...', toproject, stddata)
-    if fissfc('space_exists', '-p', toproject, '-w', stddata):
-        if ask('{}/{} already exists, delete it and continue'.format(toproject,
-                                                                     stddata),
-               prompt='? [Y\\n]: '):
-            fissfc('-y', 'space_delete', '-p', toproject, '-w', stddata)
-        else:
-            logging.info('User chose not to delete existing space. Exiting.')
-            sys.exit()
+    if not args.skip_validation and validate_loadfiles(cohort_loadfiles(
+            glob_loadfiles(os.path.join(loadfiles, '*-*.*')))):
+        sys.exit(1)
+    
+    client = get_client()
+    if args.refresh_index:
+        set_index(MetadataIndex(ttl=0))
+    index = get_index()
+    configs = ConfigCache(fromproject, fromspace,
+                          max_age=0 if args.refresh_configs else
+                                  DEFAULT_MAX_AGE)
+    changed = reused = None
+    if args.delta:
+        earlier = os.path.realpath(os.path.join(args.loadfile_root,
+                                                args.delta))
+        earlier_space = 'stddata__' + os.path.basename(earlier)
+        if not os.path.isdir(earlier):
+            logging.error('%s was not found, please check your --delta '
+                          'datestamp.', earlier)
+            sys.exit(1)
+        if not index.space_exists(toproject, earlier_space):
+            logging.error('%s/%s, to copy unchanged cohorts from, does not '
+                          'exist.', toproject, earlier_space)
+            sys.exit(1)
+        changed, unchanged = changed_cohorts(loadfiles, earlier, args.jobs)
+        reused = sample_sets(loadfiles, unchanged)
+        logging.info('%d cohort(s) changed since %s, %d did not:\n\t'
+                     'changed: %s', len(changed), os.path.basename(earlier),
+                     len(unchanged), ', '.join(changed) or '-')
+    
+    journal = Journal(toproject, stddata,
+                      {'methods': methods, 'namespace': namespace,
+                       'workflow': workflow.to_dict(), 'bulk': args.bulk,
+                       'max_rows': args.max_rows, 'delta': args.delta,
+                       'loadfiles': [file_fingerprint(lf) for lf in
+                                     glob_loadfiles(os.path.join(loadfiles,
+                                                                 '*'))]})
+    with trace.phase('workspace'):
+        logging.info('Checking for %s/%s ...', toproject, stddata)
+        resume = sync = False
+        if index.space_exists(toproject, stddata):
+            # Only needed here, and slow to import
+            from firecloud.fiss import _confirm_prompt as ask
+            if args.sync:
+                logging.info('Comparing %s/%s with the desired state',
+                             toproject, stddata)
+                sync = True
+            elif journal.unfinished() and not args.restart:
+                logging.info('Resuming provisioning of %s/%s from %s',
+                             toproject, stddata, journal.path)
+                resume = True
+            elif ask('{}/{} already exists, delete it and continue'.format(
+                         toproject, stddata), prompt='? [Y\\n]: '):
+                client.space_delete(toproject, stddata)
+                index.record(toproject, stddata, exists=False)
+            else:
+                logging.info('User chose not to delete existing space. ' +
+                             'Exiting.')
+                sys.exit()
+    
+        if not (resume or sync):
+            # Create new workspace
+            journal.clear()
+            if args.template is None:
+                logging.info('Creating workspace %s/%s', toproject, stddata)
+                client.space_new(toproject, stddata)
+            else:
+                template = Template(toproject, args.template or
+                                    template_name(args.workflow),
+                                    workflow, configs, namespace,
+                                    {'package': 'true'}, args.jobs)
+                template.ensure()
+                template.clone(toproject, stddata,
+                               {'data_version': datestamp})
+                journal.record('space:clone', SUCCEEDED)
+            index.record(toproject, stddata)
+        # A clone already has its method configs and standard attributes
+        cloned = not sync and 'space:clone' in journal.succeeded()
     
-    # Create new workspace
-    logging.info('Creating workspace %s/%s', toproject, stddata)
-    fissfc('space_new', '-p', toproject, '-w', stddata)
+    # A sync recomputes what is left to do, so needs no journal
+    provisioner = Provisioner(args.jobs, None if sync else journal)
+    state = WorkspaceState(client, toproject, stddata) if sync else None
     
     # Add broadgdac group as owner
     # TODO: make this configurable
     group='GROUP_broadgdac@firecloud.org'
-    logging.info('Adding %s as workspace owner', group)
-    fissfc('space_set_acl', '-p', toproject, '-w', stddata, '-r', 'OWNER',
-           '--users', group)
+    if sync:
+        sync_acl(provisioner, state, [group], 'OWNER')
+    else:
+        provisioner.add('acl:owner', client.space_set_acl,
+                        (toproject, stddata, [group], 'OWNER'),
+                        description='Adding {} as workspace owner'.format(
+                            group))
     
     # Set workspace annotations
-    logging.info('Setting data_version to ' + datestamp)
-    fissfc('-y', 'attr_set', '-p', toproject, '-w', stddata,
-           '-a', 'data_version', '-v', datestamp)
-    
-    logging.info('Setting package to "true"')
-    fissfc('-y', 'attr_set', '-p', toproject, '-w', stddata, '-a', 'package',
-           '-v', 'true')
+    annotations = {'data_version': datestamp, 'package': 'true'}
+    if sync:
+        sync_attributes(provisioner, state, annotations)
+    elif not cloned:
+        provisioner.add('attr:workspace', client.attr_set,
+                        (toproject, stddata, annotations),
+                        description='Setting data_version to ' + datestamp +
+                                    ' and package to "true"')
     
     # Copy method configs
-    logging.info('Copying method configs from %s to %s/%s', methods, toproject,
-                 stddata)
-    for config in get_configs(workflow):
-        fissfc('config_copy', '-c', config, '-n', namespace, '-p', fromproject,
-               '-s', fromspace, '-P', toproject, '-S', stddata)
+    if sync:
+        sync_configs(provisioner, state, configs, namespace, workflow.nodes,
+                     args.jobs)
+    elif not cloned:
+        logging.info('Copying method configs from %s to %s/%s', methods,
+                     toproject, stddata)
+        for config in workflow.nodes:
+            provisioner.add('config:' + config, configs.copy,
+                            (config, namespace, toproject, stddata),
+                            description='Copying ' + config)
     
-    # Load loadfiles
+    # Load loadfiles. Cohorts load concurrently, but every loadfile of a type
+    # waits on all of the previous type, since aggregate cohorts may reference
+    # entities from other cohorts.
     # Note: should globs for each type of loadfile be configurable?
-    logging.info('Loading Participants')
-    for participants in glob(os.path.join(loadfiles,
-                                          '*-*.Participant.loadfile.txt')):
-        logging.info('... from ' + get_cohort(participants))
-        fissfc('entity_import', '-p', toproject, '-w', stddata,
-               '-f', participants)
-    
-    logging.info('Loading Samples')
-    for samples in glob(os.path.join(loadfiles, '*-*.Sample.loadfile.txt')):
-        logging.info('... from ' + get_cohort(samples))
-        fissfc('entity_import', '-p', toproject, '-w', stddata, '-f', samples)
-    
-    logging.info('Loading Sample_Sets')
-    for sample_sets in glob(os.path.join(loadfiles,
-                                         '*-*.Sample_Set.loadfile.txt')):
-        logging.info('... from ' + get_cohort(sample_sets))
-        fissfc('entity_import', '-p', toproject, '-w', stddata,
-               '-f', sample_sets)
+    merge_dir = tempfile.mkdtemp(prefix=stddata + '.') \
+                if args.bulk or sync else None
+    # Both bulk and per-cohort loadfiles are uploaded in concurrent chunks
+    upload = {'chunk_size': args.chunk_size, 'jobs': args.jobs}
+    previous = []
+    for etype in ('Participant', 'Sample', 'Sample_Set'):
+        current = []
+        etype_loadfiles = glob_loadfiles(os.path.join(loadfiles,
+                                                      '*-*.' + etype))
+        if changed is not None:
+            etype_loadfiles = [loadfile for loadfile in etype_loadfiles
+                               if get_cohort(loadfile) in changed]
+        if sync:
+            # Only load the rows that differ from the workspace's entities
+            etype_loadfiles = sync_loadfiles(state, etype_loadfiles,
+                                             merge_dir)
+        if args.bulk:
+            logging.info('Merging %d %s loadfiles', len(etype_loadfiles),
+                         etype)
+            merged = merge_loadfiles(etype_loadfiles, merge_dir,
+                                     args.max_rows)
+            for part, loadfile in enumerate(merged, 1):
+                current.append(provisioner.add(
+                    'import:{}:{}'.format(etype, part), client.entity_import,
+                    (toproject, stddata, loadfile), upload,
+                    requires=previous,
+                    description='Loading {}s ({}/{})'.format(etype, part,
+                                                             len(merged))))
+        else:
+            for loadfile in etype_loadfiles:
+                cohort = get_cohort(loadfile)
+                current.append(provisioner.add(
+                    'import:{}:{}'.format(etype, cohort), client.entity_import,
+                    (toproject, stddata, loadfile), upload,
+                    requires=previous,
+                    description='Loading {}s from {}'.format(etype, cohort)))
+        previous = current
+    
+    # Copy the sample sets of unchanged cohorts, once the others are loaded,
+    # in batches one after another so each links to the entities already
+    # there rather than racing to copy them
+    if reused:
+        to_copy = reused
+        if sync:
+            existing = state.entities('sample_set')
+            to_copy = [sset for sset in reused if sset not in existing]
+        size = max(1, args.copy_batch_size)
+        copies = []
+        for start in range(0, len(to_copy), size):
+            batch = to_copy[start:start + size]
+            copies.append(provisioner.add(
+                'copy:{}..{}'.format(batch[0], batch[-1]), copy_sample_sets,
+                (toproject, earlier_space, toproject, stddata, batch),
+                requires=previous + copies[-1:],
+                description='Copying {} unchanged sample set(s), {} to {}, '
+                            'from {}'.format(len(batch), batch[0], batch[-1],
+                                             earlier_space)))
+    
+    if sync:
+        show_plan(provisioner, toproject, stddata)
+    
+    try:
+        provisioner.execute()
+    except ProvisioningError:
+        sys.exit(1)
+    finally:
+        if merge_dir is not None:
+            shutil.rmtree(merge_dir, ignore_errors=True)
     
     # Initiate supervisor mode
     logging.info('Initiating stddata run. Recovery file is at:\n\t' + recover)
-    fissfc('-y', 'supervise', '-p', toproject, '-w', stddata,
-           '-n', namespace, '-j', recover, workflow)
+    ssets = client.sset_list(toproject, stddata)
+    if reused:
+        # Their merges were copied along with them
+        ssets = [sset for sset in ssets if sset not in set(reused)]
+    scheduler = Scheduler(toproject, stddata, namespace, workflow, ssets,
+                          args.max_submissions, args.poll_interval,
+                          recovery_file=recover, jobs=args.jobs)
+    if not scheduler.run():
+        sys.exit(1)
 
 if __name__ == '__main__':
     main()
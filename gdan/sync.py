@@ -0,0 +1,211 @@
+# encoding: utf-8
+'''
+Bring an existing workspace up to date rather than rebuilding it.
+
+The current state of the workspace (its attributes, ACL, method configs and
+entities) is read once into a WorkspaceState and compared with the state an
+entry point would otherwise create from scratch. Only the differences are
+added to a Provisioner as steps, so the steps it ends up holding are the
+change plan, which show_plan() logs before anything is applied.
+'''
+
+import os
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from io import open
+from six import text_type
+
+from gdan.loadfiles import read_header, open_loadfile
+
+# Method config fields that matter when deciding whether to update a config
+CONFIG_FIELDS = ('methodRepoMethod', 'rootEntityType', 'inputs', 'outputs',
+                 'prerequisites')
+
+class WorkspaceState(object):
+    """Snapshot of an existing workspace. Each part is read from FireCloud
+    at most once, on first use"""
+    def __init__(self, client, project, workspace):
+        self.client = client
+        self.project = project
+        self.workspace = workspace
+        self._attributes = None
+        self._acl = None
+        self._configs = None
+        self._entities = dict()
+
+    @property
+    def attributes(self):
+        if self._attributes is None:
+            self._attributes = self.client.space_get(
+                self.project, self.workspace,
+                fields='workspace.attributes')['workspace']['attributes']
+        return self._attributes
+
+    @property
+    def acl(self):
+        if self._acl is None:
+            self._acl = self.client.space_get_acl(self.project, self.workspace)
+        return self._acl
+
+    @property
+    def configs(self):
+        """Set of (namespace, name) of the workspace's method configs"""
+        if self._configs is None:
+            self._configs = set((config['namespace'], config['name']) for
+                                config in self.client.config_list(
+                                    self.project, self.workspace))
+        return self._configs
+
+    def entities(self, etype, fields=None):
+        """Map of the name of each entity of type etype to its attributes.
+        fields, if given, limits the attributes read"""
+        if etype not in self._entities:
+            self._entities[etype] = dict(
+                (entity['name'], entity.get('attributes', {})) for entity in
+                self.client.entity_iter(self.project, self.workspace, etype,
+                                        fields=fields))
+        return self._entities[etype]
+
+def same_value(desired, current):
+    """Whether a loadfile value matches an attribute value read back from
+    FireCloud, which may be a number, boolean, reference or list"""
+    if current is None:
+        return desired == ''
+    if isinstance(current, dict):
+        if 'entityName' in current:
+            current = current['entityName']
+        elif 'items' in current:
+            items = [item['entityName'] if isinstance(item, dict) else item
+                     for item in current['items']]
+            try:
+                return json.loads(desired) == items
+            except ValueError:
+                return False
+    if isinstance(current, bool):
+        current = 'true' if current else 'false'
+    if desired == text_type(current):
+        return True
+    try:
+        return float(desired) == float(current)
+    except (TypeError, ValueError):
+        return False
+
+def _attribute(column, attributes):
+    """Name of the entity attribute a loadfile column sets: reference columns
+    like participant_id set the participant attribute"""
+    if column not in attributes and column.endswith('_id') and \
+       column[:-3] in attributes:
+        return column[:-3]
+    return column
+
+def diff_loadfile(state, loadfile, outdir):
+    """Write the rows of loadfile that would change the workspace to a
+    loadfile of the same name, uncompressed, in outdir. Returns its path and the number of
+    rows in it, or (None, 0) if nothing would change"""
+    header = read_header(loadfile).split('\t')
+    kind, key = header[0].split(':', 1)
+    etype = key[:-3] if key.endswith('_id') else key
+    if kind == 'membership':
+        member = header[1][:-3] if header[1].endswith('_id') else header[1]
+        members = dict((name, set(item['entityName'] for item in
+                                  attrs.get(member + 's', {}).get('items', [])))
+                       for name, attrs in state.entities(etype).items())
+    else:
+        existing = state.entities(etype)
+
+    name = os.path.basename(loadfile)
+    diff = os.path.join(outdir, name[:-3] if name.endswith('.gz') else name)
+    rows = 0
+    with open_loadfile(loadfile) as lf, open(diff, 'w') as out:
+        out.write(lf.readline())
+        for line in lf:
+            fields = line.rstrip('\r\n').split('\t')
+            if not fields[0]:
+                continue
+            if kind == 'membership':
+                changed = fields[1] not in members.get(fields[0], ())
+            elif fields[0] not in existing:
+                changed = True
+            else:
+                attrs = existing[fields[0]]
+                changed = not all(same_value(value, attrs.get(
+                                      _attribute(column, attrs)))
+                                  for column, value in zip(header[1:],
+                                                           fields[1:]))
+            if changed:
+                out.write(line if line.endswith('\n') else line + u'\n')
+                rows += 1
+    if not rows:
+        os.remove(diff)
+        return None, 0
+    return diff, rows
+
+def sync_loadfiles(state, loadfiles, outdir):
+    """Diff each of loadfiles against the workspace, returning the paths of
+    the non-empty diffs, in the same order"""
+    diffs = []
+    for loadfile in loadfiles:
+        diff, rows = diff_loadfile(state, loadfile, outdir)
+        if diff is not None:
+            logging.info('%s: %d row(s) differ', os.path.basename(loadfile),
+                         rows)
+            diffs.append(diff)
+    return diffs
+
+def sync_acl(provisioner, state, users, role, name='acl'):
+    """Add a step granting role to those of users that don't have it"""
+    missing = [user for user in users if state.acl.get(user) != role]
+    if missing:
+        return provisioner.add('{}:{}'.format(name, role.lower()),
+                               state.client.space_set_acl,
+                               (state.project, state.workspace, missing, role),
+                               description='Adding {} as workspace {}'.format(
+                                   ', '.join(missing), role.lower()))
+
+def sync_attributes(provisioner, state, attributes, name='attr:workspace'):
+    """Add a step setting those workspace attributes that differ"""
+    changed = dict((attr, value) for attr, value in attributes.items()
+                   if not same_value(value, state.attributes.get(attr)))
+    if changed:
+        return provisioner.add(name, state.client.attr_set,
+                               (state.project, state.workspace, changed),
+                               description='Setting ' + ', '.join(
+                                   '{} to "{}"'.format(attr, value) for
+                                   attr, value in sorted(changed.items())))
+
+def sync_configs(provisioner, state, source, namespace, configs, jobs=8):
+    """Add a step for each of configs that is missing from the workspace or
+    differs from the one in source, the ConfigCache of the methods
+    workspace. Returns the names of the steps added"""
+    client = state.client
+    # List the workspace's configs once, before the comparisons need it
+    existing = state.configs
+
+    def compare(config):
+        source_config = source.get(namespace, config)
+        if (namespace, config) not in existing:
+            return source_config, 'Copying'
+        target = client.config_get(state.project, state.workspace, namespace,
+                                   config)
+        if any(source_config.get(field) != target.get(field)
+               for field in CONFIG_FIELDS):
+            return source_config, 'Updating'
+        return None, None
+
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        diffs = list(pool.map(compare, configs))
+    return [provisioner.add('config:' + config, client.config_put,
+                            (state.project, state.workspace, body),
+                            description='{} {}'.format(action, config))
+            for config, (body, action) in zip(configs, diffs)
+            if body is not None]
+
+def show_plan(provisioner, project, workspace):
+    """Log the steps a sync will take"""
+    if not provisioner.steps:
+        logging.info('%s/%s is up to date', project, workspace)
+        return
+    logging.info('Sync plan for %s/%s:\n\t%s', project, workspace,
+                 '\n\t'.join(step.description
+                             for step in provisioner.steps.values()))
@@ -0,0 +1,126 @@
+# encoding: utf-8
+'''
+Template workspaces, cloned to create new workspaces in one call.
+
+Provisioning a new workspace from scratch copies each method config of its
+workflow on its own and sets its standard attributes separately. A template
+workspace holds all of these already, one per workflow, e.g.
+broad-firecloud-gdac/Analyses_template, so a new workspace is a single
+server-side clone of it, followed only by what differs between runs: its
+data_version, entities and ACLs, which FireCloud does not clone.
+
+A template records a fingerprint of what it was built from, in its
+gdan_template attribute: the workflow's DOT graph, the methods workspace
+and namespace, the body of each of its method configs and the standard
+attributes. Config bodies come from a ConfigCache, so checking the
+fingerprint usually costs one listing of the methods workspace and one read
+of the template's attributes. When the fingerprint differs, the template is
+brought up to date in place before it is cloned.
+'''
+
+import os
+import json
+import hashlib
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from firecloud.errors import FireCloudServerError
+from gdan import trace
+from gdan.fcclient import get_client
+
+# Workspace attribute holding the fingerprint; clones keep it, recording
+# which build of the template they came from
+FINGERPRINT_ATTRIBUTE = 'gdan_template'
+
+def template_name(workflow):
+    """Default name of the template of the workflow in the DOT file at path
+    workflow, e.g. Analyses_template for Analyses.dot"""
+    return os.path.splitext(os.path.basename(workflow))[0] + '_template'
+
+class Template(object):
+    """Template workspace project/workspace for workflow, with the method
+    configs of its nodes copied from configs, a ConfigCache, and the given
+    workspace attributes"""
+    def __init__(self, project, workspace, workflow, configs, namespace,
+                 attributes=None, jobs=8, client=None):
+        self.project = project
+        self.workspace = workspace
+        self.workflow = workflow
+        self.configs = configs
+        self.namespace = namespace
+        self.attributes = dict(attributes or dict())
+        self.jobs = max(1, jobs)
+        self.client = client or get_client()
+
+    def fingerprint(self):
+        """Digest of everything the template is built from"""
+        with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            bodies = list(pool.map(
+                trace.wrap(lambda node: self.configs.get(self.namespace,
+                                                         node)),
+                sorted(self.workflow.nodes)))
+        key = json.dumps([self.configs.project, self.configs.workspace,
+                          self.namespace, self.workflow.to_dict(), bodies,
+                          self.attributes], sort_keys=True)
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+
+    def built(self):
+        """The fingerprint the template was last built with, '' if it was
+        never completely built, or None if it does not exist"""
+        try:
+            space = self.client.space_get(self.project, self.workspace,
+                                          'workspace.attributes')
+        except FireCloudServerError as e:
+            if e.code == 404:
+                return None
+            raise
+        return space['workspace']['attributes'].get(FINGERPRINT_ATTRIBUTE,
+                                                     '')
+
+    def ensure(self):
+        """Build or refresh the template, unless it is up to date. Returns
+        whether it was built or refreshed"""
+        client = self.client
+        # The template is read while the fingerprint is worked out
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            built = pool.submit(trace.wrap(self.built))
+            fingerprint = self.fingerprint()
+            built = built.result()
+        if built == fingerprint:
+            logging.info('Template %s/%s is up to date', self.project,
+                         self.workspace)
+            return False
+        if built is None:
+            logging.info('Building template %s/%s', self.project,
+                         self.workspace)
+            client.space_new(self.project, self.workspace, self.attributes)
+        else:
+            logging.info('Refreshing template %s/%s, as its workflow or '
+                         'method configs changed', self.project,
+                         self.workspace)
+            client.attr_set(self.project, self.workspace, self.attributes)
+            stale = [(config['namespace'], config['name']) for config in
+                     client.config_list(self.project, self.workspace)
+                     if config['namespace'] != self.namespace or
+                     config['name'] not in self.workflow.nodes]
+            for namespace, config in stale:
+                client.config_delete(self.project, self.workspace, namespace,
+                                     config)
+
+        def copy(node):
+            self.configs.copy(node, self.namespace, self.project,
+                              self.workspace)
+        with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            list(pool.map(trace.wrap(copy), self.workflow.nodes))
+        # Last, so that a template left partly built is built again
+        client.attr_set(self.project, self.workspace,
+                        {FINGERPRINT_ATTRIBUTE: fingerprint})
+        return True
+
+    def clone(self, project, workspace, attributes=None):
+        """Create project/workspace from the template, with attributes set
+        over the template's"""
+        logging.info('Creating workspace %s/%s from template %s/%s', project,
+                     workspace, self.project, self.workspace)
+        self.client.space_clone(self.project, self.workspace, project,
+                                workspace, attributes)
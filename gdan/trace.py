@@ -0,0 +1,175 @@
+# encoding: utf-8
+'''
+Tracing of FireCloud calls, to see where the time of a run goes.
+
+Once enable() is called, every FireCloudClient call is recorded as a span:
+its operation, workspace, entity, start, duration, number of retries and
+result, along with the phase of the run it was made in (workspace creation,
+ACLs, config copies, imports, ...). Spans are written to a JSON-lines trace
+file as they finish, and a table of latency percentiles per operation and
+of time spent per phase is logged when the process exits.
+
+Phases are per thread: phase() sets the phase of the current thread, and
+wrap() carries it over to functions run on worker threads. When tracing is
+not enabled, span() and traced() do nothing beyond calling through.
+'''
+
+import json
+import math
+import time
+import atexit
+import inspect
+import logging
+import threading
+import functools
+from contextlib import contextmanager
+from io import open
+from six import text_type
+
+_local = threading.local()
+_tracer = None
+
+def percentile(values, pct):
+    """Nearest-rank percentile of sorted values"""
+    if not values:
+        return None
+    rank = int(math.ceil(pct / 100.0 * len(values)))
+    return values[min(max(rank, 1), len(values)) - 1]
+
+class Tracer(object):
+    """Writes spans to a JSON-lines file and keeps what the summary needs"""
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'w')
+        self._lock = threading.Lock()
+        self._spans = []
+
+    def record(self, span):
+        with self._lock:
+            self._file.write(text_type(json.dumps(span)) + u'\n')
+            self._file.flush()
+            self._spans.append((span['op'], span['phase'], span['start'],
+                                span['duration'], span['retries'],
+                                span['result'] == 'ok'))
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+    def summary(self):
+        """Tables of latency per operation and of time per phase"""
+        with self._lock:
+            spans = list(self._spans)
+        ops = dict()
+        phases = dict()
+        for op, phase, start, duration, retries, ok in spans:
+            ops.setdefault(op, []).append((duration, retries, ok))
+            first, last, total = phases.get(phase, (start, start, 0.0))
+            phases[phase] = (min(first, start), max(last, start + duration),
+                             total + duration)
+
+        lines = ['{:<24}{:>7}{:>7}{:>8}{:>9}{:>9}{:>9}{:>9}{:>10}'.format(
+            'operation', 'calls', 'errors', 'retries', 'p50', 'p90', 'p99',
+            'max', 'total')]
+        for op in sorted(ops, key=lambda op: -sum(d for d, _, _ in ops[op])):
+            durations = sorted(d for d, _, _ in ops[op])
+            lines.append('{:<24}{:>7}{:>7}{:>8}{:>9.3f}{:>9.3f}{:>9.3f}'
+                         '{:>9.3f}{:>10.1f}'.format(
+                op, len(durations), sum(1 for _, _, ok in ops[op] if not ok),
+                sum(r for _, r, _ in ops[op]), percentile(durations, 50),
+                percentile(durations, 90), percentile(durations, 99),
+                durations[-1], sum(durations)))
+        lines.append('')
+        lines.append('{:<24}{:>12}{:>12}'.format('phase', 'elapsed',
+                                                 'call time'))
+        for phase, (first, last, total) in sorted(phases.items(),
+                                                  key=lambda p: p[1][0]):
+            lines.append('{:<24}{:>12.1f}{:>12.1f}'.format(phase or '-',
+                                                           last - first,
+                                                           total))
+        return '\n'.join(lines)
+
+def enable(path):
+    """Trace calls to path, logging a summary at exit"""
+    global _tracer
+    _tracer = Tracer(path)
+    atexit.register(_report, _tracer)
+    return _tracer
+
+def _report(tracer):
+    tracer.close()
+    logging.info('FireCloud calls, in seconds (trace in %s):\n%s',
+                 tracer.path, tracer.summary())
+
+def enabled():
+    return _tracer is not None
+
+def current_phase():
+    return getattr(_local, 'phase', None)
+
+@contextmanager
+def phase(name):
+    """Attribute calls made by this thread to the named phase"""
+    previous = current_phase()
+    _local.phase = name
+    try:
+        yield
+    finally:
+        _local.phase = previous
+
+def wrap(func):
+    """func, run in the current thread's phase whichever thread calls it"""
+    name = current_phase()
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with phase(name):
+            return func(*args, **kwargs)
+    return wrapper
+
+def retry():
+    """Count a retry against the innermost span of this thread"""
+    span = getattr(_local, 'span', None)
+    if span is not None:
+        span['retries'] += 1
+
+@contextmanager
+def span(op, workspace=None, entity=None):
+    """Record the enclosed block as a call to op"""
+    if _tracer is None:
+        yield None
+        return
+    if isinstance(entity, (list, tuple)):
+        entity = ','.join(entity)
+    record = {'op': op, 'phase': current_phase(), 'workspace': workspace,
+              'entity': entity, 'start': time.time(), 'retries': 0,
+              'result': 'ok'}
+    parent = getattr(_local, 'span', None)
+    _local.span = record
+    try:
+        yield record
+    except Exception as e:
+        record['result'] = str(getattr(e, 'code', type(e).__name__))
+        raise
+    finally:
+        _local.span = parent
+        record['duration'] = time.time() - record['start']
+        _tracer.record(record)
+
+def traced(op=None, workspace=('project', 'workspace'), entity=None):
+    """Decorator recording each call of a function as a span. workspace and
+    entity name the arguments holding the project and workspace, and the
+    entity, acted on"""
+    def decorator(func):
+        name = op or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _tracer is None:
+                return func(*args, **kwargs)
+            call = inspect.getcallargs(func, *args, **kwargs)
+            space = '/'.join(str(call.get(arg)) for arg in workspace)
+            with span(name, space, call.get(entity) if entity else None):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
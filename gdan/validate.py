@@ -0,0 +1,167 @@
+# encoding: utf-8
+'''
+Check loadfiles locally before anything is uploaded.
+
+Each cohort's Participant, Sample and Sample_Set loadfiles are checked in a
+separate process for:
+
+    - a header naming the expected entity type
+    - rows with a different number of fields than the header
+    - empty or duplicate IDs (or duplicate set memberships)
+    - samples referring to unknown participants, and sample set members
+      referring to unknown samples
+
+Files are streamed, keeping only the IDs of the cohort being checked.
+References a cohort cannot resolve itself, as in aggregate cohorts like
+TCGA-COADREAD, are then looked up in the other cohorts' loadfiles.
+'''
+
+import os
+import logging
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+from gdan.loadfiles import get_cohort, open_loadfile
+
+# Loadfile name component: entity type, for stddata and gdac_new naming
+ENTITY_TYPES = {'Participant': 'participant',
+                'Participants': 'participant',
+                'Sample': 'sample',
+                'Samples': 'sample',
+                'Sample_Set': 'sample_set',
+                'SampleSet': 'sample_set'}
+# Entity type: type its loadfile refers to
+REFERENCES = {'sample': 'participant', 'sample_set': 'sample'}
+# Errors reported per loadfile before the rest are only counted
+MAX_ERRORS = 20
+
+def cohort_loadfiles(loadfiles):
+    """Group loadfile paths as {cohort: {entity type: path}}. Paths not named
+    <cohort>.<type>.loadfile.txt[.gz] are ignored"""
+    cohorts = OrderedDict()
+    for loadfile in sorted(loadfiles):
+        parts = os.path.basename(loadfile).split('.')
+        if len(parts) < 3 or parts[1] not in ENTITY_TYPES:
+            continue
+        cohorts.setdefault(get_cohort(loadfile), dict())[
+            ENTITY_TYPES[parts[1]]] = loadfile
+    return cohorts
+
+def _scan(path, etype, errors, known=None, unresolved=None):
+    """Check a loadfile of etype, appending problems to errors, and return
+    the set of IDs it defines. References to IDs not in known are added to
+    unresolved as {ID: (path, line)}"""
+    name = os.path.basename(path)
+    found = [0]
+
+    def error(line, msg):
+        found[0] += 1
+        if found[0] <= MAX_ERRORS:
+            errors.append('{}:{}: {}'.format(name, line, msg))
+
+    ids = set()
+    with open_loadfile(path) as lf:
+        header = lf.readline().rstrip('\r\n').split('\t')
+        kind, _, key = header[0].partition(':')
+        if kind not in ('entity', 'membership', 'update') or \
+           key not in (etype + '_id', etype):
+            error(1, 'expected a {} loadfile header, found {!r}'.format(
+                etype, header[0]))
+            return ids
+        membership = kind == 'membership'
+        ref_col = None
+        if etype in REFERENCES:
+            ref = REFERENCES[etype]
+            cols = [i for i, col in enumerate(header)
+                    if col in (ref + '_id', ref)]
+            ref_col = cols[0] if cols else None
+        pairs = set()
+        for lineno, line in enumerate(lf, 2):
+            line = line.rstrip('\r\n')
+            if not line:
+                continue
+            fields = line.split('\t')
+            if len(fields) != len(header):
+                error(lineno, 'expected {} fields, found {}'.format(
+                    len(header), len(fields)))
+                continue
+            if not fields[0] or (membership and not fields[1]):
+                error(lineno, 'empty ID')
+                continue
+            if membership:
+                pair = (fields[0], fields[1])
+                if pair in pairs:
+                    error(lineno, 'duplicate membership {} {}'.format(*pair))
+                pairs.add(pair)
+            elif fields[0] in ids:
+                error(lineno, 'duplicate ID ' + fields[0])
+            ids.add(fields[0])
+            if ref_col is not None and fields[ref_col] and \
+               fields[ref_col] not in known:
+                unresolved.setdefault(fields[ref_col], (name, lineno))
+    if found[0] > MAX_ERRORS:
+        errors.append('{}: {} more error(s)'.format(name,
+                                                     found[0] - MAX_ERRORS))
+    return ids
+
+def check_cohort(loadfiles):
+    """Check one cohort's loadfiles, given as {entity type: path}.
+
+    Returns a list of errors and the references that could not be resolved
+    within the cohort, as {referenced type: {ID: (loadfile, line)}}"""
+    errors = []
+    unresolved = dict((ref, dict()) for ref in REFERENCES.values())
+    known = dict()
+    for etype in ('participant', 'sample', 'sample_set'):
+        if etype in loadfiles:
+            ref = REFERENCES.get(etype)
+            known[etype] = _scan(loadfiles[etype], etype, errors,
+                                 known.get(ref, set()), unresolved.get(ref))
+    return errors, unresolved
+
+def find_ids(loadfile, wanted):
+    """Those of wanted found in the ID column of loadfile"""
+    found = set()
+    with open_loadfile(loadfile) as lf:
+        lf.readline()
+        for line in lf:
+            entity = line.split('\t', 1)[0].rstrip('\r\n')
+            if entity in wanted:
+                found.add(entity)
+    return found
+
+def validate_loadfiles(cohorts, jobs=None):
+    """Check the loadfiles of every cohort, as grouped by cohort_loadfiles,
+    in up to jobs processes (default: one per CPU). Logs and returns the
+    list of errors found"""
+    errors = []
+    unresolved = dict((ref, dict()) for ref in REFERENCES.values())
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        for cohort_errors, cohort_unresolved in pool.map(check_cohort,
+                                                         cohorts.values()):
+            errors.extend(cohort_errors)
+            for ref, ids in cohort_unresolved.items():
+                for entity, where in ids.items():
+                    unresolved[ref].setdefault(entity, where)
+
+        # Look for references across cohorts in the other cohorts' loadfiles
+        for ref, ids in unresolved.items():
+            if not ids:
+                continue
+            wanted = frozenset(ids)
+            paths = [loadfiles[ref] for loadfiles in cohorts.values()
+                     if ref in loadfiles]
+            for found in pool.map(find_ids, paths, [wanted] * len(paths)):
+                for entity in found:
+                    ids.pop(entity, None)
+            for entity, (name, lineno) in sorted(ids.items()):
+                errors.append('{}:{}: unknown {} {}'.format(name, lineno, ref,
+                                                            entity))
+
+    if errors:
+        logging.error('Found %d problem(s) in the loadfiles of %d cohort(s):' +
+                      '\n\t%s', len(errors), len(cohorts),
+                      '\n\t'.join(errors))
+    else:
+        logging.info('Validated the loadfiles of %d cohort(s)', len(cohorts))
+    return errors
@@ -0,0 +1,196 @@
+# encoding: utf-8
+'''
+Firehose-style workflows of workflows, described in DOT.
+
+Each node of the graph names a method config; an edge A -> B means B runs on
+a sample set after A has been evaluated on it. The edge's satisfiedMode says
+whether B needs A to have succeeded ("OnComplete") or only to have finished
+("Always"). Only the subset of DOT used by these workflows is supported:
+node and edge statements with optional attribute lists, and comments.
+'''
+
+import re
+from collections import OrderedDict
+from io import open
+from six import string_types
+
+ON_COMPLETE = 'OnComplete'
+ALWAYS = 'Always'
+
+_TOKENS = re.compile(r'''
+      (?P<space>\s+|//[^\n]*|\#[^\n]*|/\*.*?\*/)
+    | (?P<quoted>"(?:[^"\\]|\\.)*")
+    | (?P<arrow>->|--)
+    | (?P<punct>[{}\[\];,=])
+    | (?P<id>[A-Za-z0-9_.]+)
+''', re.VERBOSE | re.DOTALL)
+
+class DotSyntaxError(ValueError):
+    pass
+
+def _tokenize(text):
+    pos = 0
+    while pos < len(text):
+        match = _TOKENS.match(text, pos)
+        if match is None:
+            line = text.count('\n', 0, pos) + 1
+            raise DotSyntaxError('Unexpected {!r} on line {}'.format(
+                text[pos], line))
+        pos = match.end()
+        kind = match.lastgroup
+        if kind == 'space':
+            continue
+        value = match.group(kind)
+        if kind == 'quoted':
+            value = value[1:-1].replace('\\"', '"')
+            kind = 'id'
+        yield kind, value
+
+class Workflow(object):
+    """A DAG of method config names.
+
+    nodes is the list of node names in the order they are declared, and
+    dependencies maps each node to a list of (upstream node, satisfiedMode)
+    pairs."""
+    def __init__(self, name=None):
+        self.name = name
+        self.dependencies = OrderedDict()
+
+    @property
+    def nodes(self):
+        return list(self.dependencies)
+
+    def add_node(self, node):
+        self.dependencies.setdefault(node, [])
+
+    def add_edge(self, upstream, node, mode=ON_COMPLETE):
+        self.add_node(upstream)
+        self.add_node(node)
+        self.dependencies[node].append((upstream, mode))
+
+    def downstream(self):
+        """Map of each node to the nodes that depend on it"""
+        down = OrderedDict((node, []) for node in self.dependencies)
+        for node, deps in self.dependencies.items():
+            for upstream, _ in deps:
+                down[upstream].append(node)
+        return down
+
+    def topological_order(self):
+        """Nodes ordered so that every node follows its dependencies"""
+        indegree = dict((node, len(deps))
+                        for node, deps in self.dependencies.items())
+        down = self.downstream()
+        order = [node for node in self.dependencies if indegree[node] == 0]
+        for node in order:
+            for dep in down[node]:
+                indegree[dep] -= 1
+                if indegree[dep] == 0:
+                    order.append(dep)
+        if len(order) != len(self.dependencies):
+            raise DotSyntaxError('Workflow {} contains a cycle'.format(
+                self.name))
+        return order
+
+    def critical_paths(self, runtimes, default=1.0):
+        """Length of the longest path from the start of each node to the end
+        of the workflow, given a map of node to runtime. Nodes missing from
+        runtimes are assumed to take default"""
+        down = self.downstream()
+        paths = dict()
+        for node in reversed(self.topological_order()):
+            paths[node] = runtimes.get(node, default) + \
+                          max([paths[dep] for dep in down[node]] or [0])
+        return paths
+
+    def to_dict(self):
+        return OrderedDict((node, [{'upstream_task': upstream,
+                                    'satisfiedMode': mode}
+                                   for upstream, mode in deps])
+                           for node, deps in self.dependencies.items())
+
+    @classmethod
+    def from_dict(cls, dependencies, name=None):
+        """Inverse of to_dict"""
+        workflow = cls(name)
+        for node in dependencies:
+            workflow.add_node(node)
+            for dep in dependencies[node]:
+                workflow.add_edge(dep['upstream_task'], node,
+                                  dep['satisfiedMode'].strip('"'))
+        return workflow
+
+def parse_dot(dotfile):
+    """Parse a DOT file (path or open file) into a Workflow"""
+    if isinstance(dotfile, string_types):
+        with open(dotfile) as dot:
+            text = dot.read()
+    else:
+        text = dotfile.read()
+        dotfile.close()
+
+    tokens = list(_tokenize(text))
+    pos = [0]
+
+    def peek():
+        return tokens[pos[0]] if pos[0] < len(tokens) else (None, None)
+
+    def take(kind=None, value=None):
+        tok = peek()
+        if tok[0] is None or (kind and tok[0] != kind) or \
+           (value and tok[1] != value):
+            raise DotSyntaxError('Expected {} but found {!r}'.format(
+                value or kind, tok[1]))
+        pos[0] += 1
+        return tok[1]
+
+    def attributes():
+        attrs = dict()
+        while peek() == ('punct', '['):
+            take('punct', '[')
+            while peek() != ('punct', ']'):
+                key = take('id')
+                take('punct', '=')
+                attrs[key] = take('id')
+                if peek()[1] in (',', ';'):
+                    take()
+            take('punct', ']')
+        return attrs
+
+    if peek() == ('id', 'strict'):
+        take()
+    if take('id') not in ('digraph', 'graph'):
+        raise DotSyntaxError('Expected a digraph')
+    workflow = Workflow(take('id') if peek()[0] == 'id' else None)
+    take('punct', '{')
+    edge_defaults = dict()
+    while peek() != ('punct', '}'):
+        if peek() == ('punct', ';'):
+            take()
+            continue
+        name = take('id')
+        if name in ('graph', 'node', 'edge') and peek() == ('punct', '['):
+            attrs = attributes()
+            if name == 'edge':
+                edge_defaults.update(attrs)
+            continue
+        if peek() == ('punct', '='):
+            # Graph attribute, e.g. rankdir=LR
+            take()
+            take('id')
+            continue
+        chain = [name]
+        while peek()[0] == 'arrow':
+            take()
+            chain.append(take('id'))
+        attrs = dict(edge_defaults)
+        attrs.update(attributes())
+        if len(chain) == 1:
+            workflow.add_node(name)
+        else:
+            mode = attrs.get('satisfiedMode', ON_COMPLETE)
+            for upstream, node in zip(chain, chain[1:]):
+                workflow.add_edge(upstream, node, mode)
+    take('punct', '}')
+    workflow.topological_order()
+    return workflow
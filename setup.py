@@ -15,16 +15,21 @@ setup(
     url = 'https://github.com/broadinstitute/HydrantFC',
     entry_points = {
         'console_scripts': [
+            'gdan = gdan.cli:main',
             'analyses_new = gdan.analyses_new:main',
             'stddata_new = gdan.stddata_new:main',
-            'gdac_new = gdan.gdac_new:main'
+            'gdac_new = gdan.gdac_new:main',
+            'gdan_recover = gdan.scheduler:main',
+            'gdan_resources = gdan.resources:main',
+            'gdan_benchmark = gdan.benchmark:main'
         ]
     },
     package_data = {'gdan': ['defaults/*']},
     use_scm_version=True,
     setup_requires=['setuptools_scm'],
     install_requires = [
-        'firecloud>=0.16.14'
+        'firecloud>=0.16.14',
+        'futures; python_version < "3"'
     ],
     classifiers = [
         "Programming Language :: Python :: 2",